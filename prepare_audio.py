@@ -10,19 +10,37 @@
 ########################################################################
 
 
+import os
+
 SPLITS_FOLDER = "splits"
 SEGMENTED = "segmented"
+WORD_STORE = "words.store"
 
 print("Preparing audiofiles")
 
+# Convert the word timestamps of all transcripts into a columnar store once,
+# it is read by both the segmentation and the diarization preparation.
+from src.wordstore import build_word_store
+
+if not os.path.exists(WORD_STORE):
+    build_word_store(WORD_STORE)
+
 # Convert the audiofiles into smaller segments of 2-20 seconds.
 from src.segment import run_segmentation
 
-_, _, _ = run_segmentation(SEGMENTED, SPLITS_FOLDER, min_duration=2, max_duration=20)
+# Each recording is segmented independently, one per CPU core.
+_, _, _ = run_segmentation(
+    SEGMENTED,
+    SPLITS_FOLDER,
+    min_duration=2,
+    max_duration=20,
+    workers=os.cpu_count(),
+    word_store=WORD_STORE,
+)
 
 # Convert the audio files into the diarization format.
 # The output is folder for each conversation with three files. Combined
 # audio file, and transcript in JSON  and RTTM format
 from src.convert2diarization import convert
 
-convert()
+convert(word_store=WORD_STORE)
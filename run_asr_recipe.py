@@ -85,12 +85,46 @@ transcribe_file(
     test_trans, hyp_test, finetuned_model, device="cuda", compute_type="float16"
 )
 transcribe_file(
-    dev_trans, hyp_dev, finetuned_model, device="cpu", compute_type="float16"
+    dev_trans, hyp_dev, finetuned_model, device="cuda", compute_type="float16"
 )
 
 # Use the following to decode in parallel.
 # transcribe_file_parallel(test_trans, hyp_test, whisper_model, device="cuda", compute_type="float16", batches=5)
 # transcribe_file_parallel(dev_trans, hyp_dev, whisper_model, device="cuda", compute_type="float16", batches=5)
+# On CPU, run `python -m src.autotune segmented/dev.trans <model>` once per machine
+# and pass the processes, workers and threads it found on:
+# from src.autotune import tuned_topology
+# transcribe_file_parallel(test_trans, hyp_test, finetuned_model, device="cpu", compute_type="int8", **tuned_topology())
+
+# Use the following to decode in batches of segments of similar duration.
+# transcribe_file(test_trans, hyp_test, finetuned_model, device="cpu", compute_type="int8", batch_size=16)
+
+# Use the following to skip segments already transcribed with the same model and settings.
+# from src.transcription_cache import TRANSCRIPTION_CACHE
+# transcribe_file(test_trans, hyp_test, finetuned_model, device="cpu", compute_type="int8", cache=TRANSCRIPTION_CACHE)
+
+# Use the following to keep the model loaded between runs. Start a server with
+# `python -m src.serve <model> --port 8765 --replicas 2` and send the segments to it.
+# The server decodes in batches, add `--max-batch-size 1` to decode as transcribe_file does.
+# transcribe_file(test_trans, hyp_test, finetuned_model, server="127.0.0.1:8765", prefetch=16)
+
+# Use the following to measure the speed of the CPU compute types, threads and modes
+# on a sample of the Test split. Writes results/benchmark.json.
+# python -m src.benchmark segmented/test.trans <model> --sample 50 --threads 4 8
+
+# Use the following to compare decoding settings on the Dev split, encoding every segment once.
+# python -m src.sweep_decoding segmented/dev.trans <model> --beam-sizes 1 5 8 --temperatures 0 0,0.2,0.4,0.6,0.8,1.0
+
+# Use the following to transcribe whole recordings without segmenting them first.
+# from src.longform import transcribe_longform
+# transcribe_longform(os.path.join(output_dir, "test_longform"), finetuned_model, source="full_conversations", split="test")
+
+# To compare all models and settings decoded so far on the Test split, in one table
+# with paired significance tests:
+# python -m src.score results/asr/*/test --compare --references segmented/test.trans
+
+# To follow the WER and CER while a split is being transcribed, run in another shell:
+# python -m src.score results/asr/<model>/test --follow --total segmented/test.trans
 
 # ########################################################################
 # Calculate the WER and CER of Dev and Test splits using jiwer
@@ -0,0 +1,463 @@
+########################################################################
+
+# Author   : David Erik Mollberg & Carlos Daniel Hernández Mena
+# Date     : November 1st, 2023
+# Location : Reykjavík University and Tiro ehf.
+
+# In-process audio slicing for the Spjallromur recordings. Each source
+# WAV file is opened once and memory-mapped, and segments are cut out by
+# sample offsets instead of starting one SoX process per segment.
+# Segments written in virtual or shards mode by `run_segmentation` are
+# read on demand, from their source recordings or tar shards, through
+# `SegmentReader`. `AudioPrefetcher` decodes segments into float arrays on
+# a background thread, so reading audio overlaps with transcription.
+
+########################################################################
+
+import io
+import mmap
+import os
+import queue
+import struct
+import threading
+import wave
+from typing import BinaryIO, Callable, Iterable, Tuple, Union
+
+import numpy as np
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+class UnsupportedAudioFormat(Exception):
+    """Raised when a file is not an uncompressed PCM WAV file."""
+
+
+def seconds_to_frames(seconds: float, sample_rate: int) -> int:
+    """
+    Convert a time in seconds to a frame index, rounding to the nearest
+    frame the same way SoX does for the trim effect.
+
+    Parameters:
+    - seconds (float): Time in seconds.
+    - sample_rate (int): Sample rate of the audio.
+
+    Returns:
+    - int: Frame index.
+    """
+    return int(seconds * sample_rate + 0.5)
+
+
+class WavFile:
+    """
+    A memory-mapped, read-only view of a PCM WAV file.
+
+    The RIFF header is parsed once and the data chunk is exposed through
+    `frames()` as a zero-copy slice of the mapping.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise UnsupportedAudioFormat(f"{path} is empty")
+        try:
+            self._parse_header()
+        except Exception:
+            self.close()
+            raise
+        self._view = memoryview(self._mmap)[
+            self._data_offset : self._data_offset + self._data_size
+        ]
+
+    def _parse_header(self):
+        mm = self._mmap
+        if len(mm) < 12 or mm[0:4] != b"RIFF" or mm[8:12] != b"WAVE":
+            raise UnsupportedAudioFormat(f"{self.path} is not a RIFF/WAVE file")
+
+        fmt = None
+        pos = 12
+        while pos + 8 <= len(mm):
+            chunk_id = mm[pos : pos + 4]
+            (chunk_size,) = struct.unpack("<I", mm[pos + 4 : pos + 8])
+            body = pos + 8
+            if chunk_id == b"fmt ":
+                fmt = mm[body : body + chunk_size]
+            elif chunk_id == b"data":
+                if fmt is None:
+                    raise UnsupportedAudioFormat(f"{self.path} has no fmt chunk")
+                self._data_offset = body
+                # Some writers leave the size of a streamed data chunk unset.
+                self._data_size = min(chunk_size, len(mm) - body)
+                break
+            pos = body + chunk_size + (chunk_size & 1)
+        else:
+            raise UnsupportedAudioFormat(f"{self.path} has no data chunk")
+
+        format_tag, channels, sample_rate, _, block_align, bits = struct.unpack(
+            "<HHIIHH", fmt[:16]
+        )
+        if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+            (format_tag,) = struct.unpack("<H", fmt[24:26])
+        if format_tag != WAVE_FORMAT_PCM:
+            raise UnsupportedAudioFormat(
+                f"{self.path} is not PCM encoded (format tag {format_tag:#06x})"
+            )
+
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.sample_width = bits // 8
+        self.block_align = block_align
+        self.num_frames = self._data_size // block_align
+
+    @property
+    def duration(self) -> float:
+        return self.num_frames / self.sample_rate
+
+    def frames(self, start_frame: int, end_frame: int) -> memoryview:
+        """
+        Return the raw PCM data between two frame indices, clipped to the file.
+
+        Parameters:
+        - start_frame (int): First frame to include.
+        - end_frame (int): Frame to stop at (exclusive).
+
+        Returns:
+        - memoryview: The PCM bytes of the range.
+        """
+        start_frame = max(0, min(start_frame, self.num_frames))
+        end_frame = max(start_frame, min(end_frame, self.num_frames))
+        return self._view[start_frame * self.block_align : end_frame * self.block_align]
+
+    def time_range(self, start_time: float, duration: float) -> Tuple[int, int]:
+        """
+        Convert a start time and duration in seconds to a frame range.
+
+        Parameters:
+        - start_time (float): Start of the range (in seconds).
+        - duration (float): Length of the range (in seconds).
+
+        Returns:
+        - Tuple[int, int]: Start and end frame.
+        """
+        start = seconds_to_frames(start_time, self.sample_rate)
+        return start, start + seconds_to_frames(duration, self.sample_rate)
+
+    def write_frames(
+        self, output_file: Union[str, BinaryIO], start_frame: int, end_frame: int
+    ):
+        """
+        Write a frame range to a new WAV file with the same format as the source.
+
+        Parameters:
+        - output_file (Union[str, BinaryIO]): Path to, or file object of, the destination.
+        - start_frame (int): First frame to include.
+        - end_frame (int): Frame to stop at (exclusive).
+        """
+        with wave.open(output_file, "wb") as out:
+            out.setnchannels(self.channels)
+            out.setsampwidth(self.sample_width)
+            out.setframerate(self.sample_rate)
+            out.writeframes(self.frames(start_frame, end_frame))
+
+    def wav_bytes(self, start_frame: int, end_frame: int) -> bytes:
+        """
+        Return a frame range as the bytes of a complete WAV file.
+
+        Parameters:
+        - start_frame (int): First frame to include.
+        - end_frame (int): Frame to stop at (exclusive).
+
+        Returns:
+        - bytes: The WAV file.
+        """
+        buffer = io.BytesIO()
+        self.write_frames(buffer, start_frame, end_frame)
+        return buffer.getvalue()
+
+    def close(self):
+        if getattr(self, "_view", None) is not None:
+            self._view.release()
+            self._view = None
+        if not self._mmap.closed:
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def extract_audio_segments(
+    input_file: str,
+    segments: Iterable[Tuple[str, float, float]],
+    overwrite: bool = False,
+) -> int:
+    """
+    Extract several segments from one audio file, reading the source only once.
+
+    Files that are not PCM WAV are handed to SoX one segment at a time.
+
+    Parameters:
+    - input_file (str): Path to the source audio file.
+    - segments (Iterable[Tuple[str, float, float]]): (output_file, start_time, duration)
+      for each segment, times in seconds.
+    - overwrite (bool): Whether to overwrite output files that already exist.
+
+    Returns:
+    - int: Number of segments written.
+    """
+    segments = [s for s in segments if overwrite or not os.path.exists(s[0])]
+    if not segments:
+        return 0
+
+    try:
+        source = WavFile(input_file)
+    except UnsupportedAudioFormat:
+        from src.segment import extract_audio_segment
+
+        for output_file, start_time, duration in segments:
+            extract_audio_segment(
+                input_file, output_file, start_time, duration, overwrite=overwrite
+            )
+        # SoX errors are only logged, count the segments that were written.
+        return sum(os.path.exists(output_file) for output_file, _, _ in segments)
+
+    with source:
+        for output_file, start_time, duration in segments:
+            source.write_frames(output_file, *source.time_range(start_time, duration))
+    return len(segments)
+
+
+def segment_table_path(trans_path: str, sidecar: str = ".segments") -> str:
+    """Path of a manifest, `.segments` or `.shards`, that belongs to a `.trans` file."""
+    return trans_path.replace(".trans", "") + sidecar
+
+
+def load_segment_table(trans_path: str) -> dict:
+    """
+    Load the `.segments` or `.shards` manifest written next to a `.trans`
+    file by `run_segmentation` in virtual or shards mode.
+
+    Parameters:
+    - trans_path (str): Path to the `.trans` file.
+
+    Returns:
+    - dict: Mapping from segment path to ("frames", source, start_frame, end_frame)
+      for virtual segments and ("shard", shard, offset, size) for segments in
+      tar shards. Empty if the segments were written as files.
+    """
+    table = {}
+    for sidecar, kind in [(".segments", "frames"), (".shards", "shard")]:
+        path = segment_table_path(trans_path, sidecar)
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            next(f)
+            for line in f:
+                segment, source, start, end = line.rstrip("\n").split("\t")
+                # The first one wins, as when segments are written as files.
+                table.setdefault(segment, (kind, source, int(start), int(end)))
+    return table
+
+
+class SegmentReader:
+    """
+    Reads virtual segments and segments packed in tar shards.
+
+    The most recently used source recording or shard is kept open, so
+    consecutive segments of the same recording are read without reopening
+    it and, for shards, with sequential I/O.
+    """
+
+    def __init__(self, table: dict):
+        self.table = table
+        self._source = None
+        self._shard = None
+
+    def _open_source(self, path: str) -> WavFile:
+        if self._source is None or self._source.path != path:
+            if self._source is not None:
+                self._source.close()
+            self._source = WavFile(path)
+        return self._source
+
+    def _open_shard(self, path: str) -> BinaryIO:
+        if self._shard is None or self._shard.name != path:
+            if self._shard is not None:
+                self._shard.close()
+            self._shard = open(path, "rb")
+        return self._shard
+
+    def wav_bytes(self, segment: str) -> bytes:
+        """
+        Read a segment as the bytes of a WAV file.
+
+        Parameters:
+        - segment (str): Segment path as written in the `.trans` file.
+
+        Returns:
+        - bytes: A complete WAV file.
+        """
+        kind, path, start, end = self.table[segment]
+        if kind == "shard":
+            shard = self._open_shard(path)
+            if shard.tell() != start:
+                shard.seek(start)
+            return shard.read(end)
+        source = self._open_source(path)
+        return source.wav_bytes(start, end)
+
+    def resolve(self, segment: str) -> Union[str, BinaryIO]:
+        """
+        Resolve a segment path from a `.trans` file to something that
+        Faster-Whisper and SoundFile can decode.
+
+        Parameters:
+        - segment (str): Segment path as written in the `.trans` file.
+
+        Returns:
+        - Union[str, BinaryIO]: The path itself if the segment is a file on disk,
+          otherwise an in-memory WAV file with the audio of the segment.
+        """
+        if segment not in self.table:
+            return segment
+        return io.BytesIO(self.wav_bytes(segment))
+
+    def close(self):
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+        if self._shard is not None:
+            self._shard.close()
+            self._shard = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_audio(source: Union[str, BinaryIO], sampling_rate: int = 16000) -> np.ndarray:
+    """
+    Decode audio into a mono float32 array in the range [-1, 1].
+
+    16 bit mono PCM WAV files at `sampling_rate`, which is what the corpus
+    consists of, are converted directly. Anything else is decoded and
+    resampled by Faster-Whisper.
+
+    Parameters:
+    - source (Union[str, BinaryIO]): Path to, or file object of, the audio,
+      e.g. from `SegmentReader.resolve`.
+    - sampling_rate (int): Sample rate of the array. Default is 16000.
+
+    Returns:
+    - np.ndarray: The samples.
+    """
+
+    try:
+        if isinstance(source, str):
+            with WavFile(source) as wav:
+                if (wav.channels, wav.sample_width, wav.sample_rate) == (
+                    1,
+                    2,
+                    sampling_rate,
+                ):
+                    frames = wav.frames(0, wav.num_frames)
+                    samples = np.frombuffer(frames, dtype="<i2")
+                    audio = samples.astype(np.float32) / 32768
+                    del samples
+                    frames.release()
+                    return audio
+        else:
+            with wave.open(source) as wav:
+                if (wav.getnchannels(), wav.getsampwidth(), wav.getframerate()) == (
+                    1,
+                    2,
+                    sampling_rate,
+                ):
+                    frames = wav.readframes(wav.getnframes())
+                    return np.frombuffer(frames, dtype="<i2").astype(np.float32) / 32768
+    except (UnsupportedAudioFormat, wave.Error, EOFError):
+        pass
+
+    from faster_whisper.audio import decode_audio
+
+    if not isinstance(source, str):
+        source.seek(0)
+    return decode_audio(source, sampling_rate=sampling_rate)
+
+
+class AudioPrefetcher:
+    """
+    Decodes the audio of upcoming items on a background thread.
+
+    Iterating gives (item, audio) pairs in the order of `items`, with at most
+    `depth` decoded items waiting at any time, so memory stays bounded while
+    reading and decoding overlap with whatever the consumer does.
+    """
+
+    _END = object()
+
+    def __init__(
+        self,
+        items: Iterable,
+        resolve: Callable = None,
+        sampling_rate: int = 16000,
+        depth: int = 8,
+    ):
+        self._items = items
+        self._resolve = resolve or (lambda item: item)
+        self._sampling_rate = sampling_rate
+        self._queue = queue.Queue(maxsize=max(1, depth))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _put(self, value) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for item in self._items:
+                audio = load_audio(self._resolve(item), self._sampling_rate)
+                if not self._put((item, audio)):
+                    return
+        except BaseException as e:
+            self._put((self._END, e))
+            return
+        self._put((self._END, None))
+
+    def __iter__(self):
+        try:
+            while True:
+                item, audio = self._queue.get()
+                if item is self._END:
+                    if audio is not None:
+                        raise audio
+                    return
+                yield item, audio
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,205 @@
+########################################################################
+
+# Author   : Carlos Daniel Hernández Mena & David Erik Mollberg
+# Date     : November 1st, 2023
+# Location : Reykjavík University and Tiro ehf.
+
+# Description:
+
+# Finds the fastest way to divide the cores of a machine between
+# transcription processes, model replicas (num_workers) and threads per
+# replica (cpu_threads) by transcribing a sample of a split with each
+# combination. The best one is stored per machine and can be passed on
+# to transcribe_file_parallel with tuned_topology().
+#
+# Usage: python -m src.autotune segmented/dev.trans <whisper_model> --sample 40
+
+########################################################################
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+
+from src.audio import segment_table_path
+from src.transcribe import segment_durations, transcribe_file_parallel
+
+TOPOLOGY_FILE = os.path.join(
+    os.path.expanduser("~"), ".cache", "spjallromur", "topology.json"
+)
+
+
+def machine_key(device: str = "cpu", compute_type: str = "int8") -> str:
+    """Key of the settings for this machine, device and compute type."""
+    return f"{platform.node()}:{os.cpu_count()}:{device}:{compute_type}"
+
+
+def candidate_topologies(cores: int) -> list:
+    """
+    Combinations of processes and workers per process, powers of two that
+    together use at most all cores, with the cores divided evenly between them.
+
+    Parameters:
+    - cores (int): Number of cores to use.
+
+    Returns:
+    - list: Dicts of batches, num_workers and cpu_threads, as taken by
+      `transcribe_file_parallel`.
+    """
+
+    powers = [2**i for i in range(cores.bit_length()) if 2**i <= cores]
+    return [
+        {
+            "batches": processes,
+            "num_workers": workers,
+            "cpu_threads": cores // (processes * workers),
+        }
+        for processes in powers
+        for workers in powers
+        if processes * workers <= cores
+    ]
+
+
+def sample_split(data_path: str, sample_size: int, folder: str, seed: int = 0) -> str:
+    """
+    Write a random sample of a `.trans` file, with its `.info` and segment
+    manifests, to another folder.
+
+    Returns:
+    - str: Path of the sampled `.trans` file.
+    """
+
+    lines = open(data_path).readlines()
+    random.Random(seed).shuffle(lines)
+    sample = os.path.join(folder, os.path.basename(data_path))
+    with open(sample, "w") as f:
+        f.writelines(lines[:sample_size])
+    for sidecar in [".info", ".segments", ".shards"]:
+        path = segment_table_path(data_path, sidecar)
+        if os.path.exists(path):
+            shutil.copy(path, segment_table_path(sample, sidecar))
+    return sample
+
+
+def autotune(
+    data_path: str,
+    whisper_model: str,
+    device: str = "cpu",
+    compute_type: str = "int8",
+    sample_size: int = 40,
+    cores: int = None,
+    output: str = TOPOLOGY_FILE,
+) -> dict:
+    """
+    Transcribe a sample of a split with every candidate topology and store the
+    fastest one for this machine.
+
+    Speed is measured as seconds of audio, or files if there is no `.info`
+    file, decoded per second from the first worker being ready until the last
+    one finished, so model loading doesn't count.
+
+    Parameters:
+    - data_path (str): Path to a `.trans` file, e.g. segmented/dev.trans.
+    - whisper_model (str): Path to the pretrained Faster-Whisper model.
+    - device (str, optional): Device to which the model is sent. Defaults to 'cpu'.
+    - compute_type (str, optional): Type of computation to be performed. Defaults to 'int8'.
+    - sample_size (int, optional): Number of files to transcribe. Defaults to 40.
+    - cores (int, optional): Number of cores to use. Defaults to all of them.
+    - output (str, optional): JSON file to store the best topology in.
+
+    Returns:
+    - dict: The best topology and the results of all candidates.
+    """
+
+    cores = cores or os.cpu_count()
+    durations = segment_durations(data_path)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        sample = sample_split(data_path, sample_size, tmp)
+        wav_ids = [
+            os.path.basename(line.split("\t")[0]).rstrip(".wav")
+            for line in open(sample)
+        ]
+        amount = sum(durations.get(wav_id, 1) for wav_id in wav_ids)
+        for topology in candidate_topologies(cores):
+            workers = transcribe_file_parallel(
+                sample,
+                os.path.join(tmp, "hyp"),
+                whisper_model,
+                device=device,
+                compute_type=compute_type,
+                **topology,
+            )
+            start = min(w["start"] for w in workers.values())
+            end = max(w["end"] for w in workers.values())
+            result = dict(
+                topology,
+                speed=round(amount / (end - start), 3),
+                load_time=round(max(w["load_time"] for w in workers.values()), 3),
+            )
+            print(json.dumps(result))
+            results.append(result)
+
+    best = max(results, key=lambda r: r["speed"])
+    tuned = {k: best[k] for k in ["batches", "num_workers", "cpu_threads"]}
+
+    settings = {}
+    if os.path.exists(output):
+        with open(output) as f:
+            settings = json.load(f)
+    settings[machine_key(device, compute_type)] = tuned
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output + ".tmp", "w") as f:
+        json.dump(settings, f, indent=4)
+    os.replace(output + ".tmp", output)
+    print(f"Best topology {tuned} saved to {output}")
+    return {"best": tuned, "results": results}
+
+
+def tuned_topology(
+    device: str = "cpu", compute_type: str = "int8", path: str = TOPOLOGY_FILE
+) -> dict:
+    """
+    The topology found by `autotune` for this machine.
+
+    Parameters:
+    - device (str, optional): Device to which the model is sent. Defaults to 'cpu'.
+    - compute_type (str, optional): Type of computation to be performed. Defaults to 'int8'.
+    - path (str, optional): JSON file the topologies are stored in.
+
+    Returns:
+    - dict: batches, num_workers and cpu_threads for `transcribe_file_parallel`,
+      or an empty dict if the machine hasn't been tuned.
+    """
+
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get(machine_key(device, compute_type), {})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find the fastest transcription topology for this machine."
+    )
+    parser.add_argument("data_path", help="A .trans file, e.g. segmented/dev.trans")
+    parser.add_argument("whisper_model")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--compute-type", default="int8")
+    parser.add_argument("--sample", type=int, default=40)
+    parser.add_argument("--cores", type=int, default=None)
+    parser.add_argument("--output", default=TOPOLOGY_FILE)
+    args = parser.parse_args()
+
+    autotune(
+        args.data_path,
+        args.whisper_model,
+        device=args.device,
+        compute_type=args.compute_type,
+        sample_size=args.sample,
+        cores=args.cores,
+        output=args.output,
+    )
@@ -0,0 +1,283 @@
+########################################################################
+
+# Author   : Carlos Daniel Hernández Mena & David Erik Mollberg
+# Date     : November 1st, 2023
+# Location : Reykjavík University and Tiro ehf.
+
+# Description:
+
+# Measures how fast transcribe_file and transcribe_file_parallel run on
+# this machine. A fixed sample of a split is transcribed on CPU with each
+# combination of compute type, number of threads and mode (one file at
+# a time, batched or parallel processes), every run in a fresh process.
+# Reported as JSON per run: real-time factor, p50/p95/p99 decoding time
+# per file, peak resident memory and model load time. Compute types that
+# CTranslate2 doesn't support on this CPU are reported as errors.
+#
+# Usage: python -m src.benchmark segmented/test.trans <whisper_model> \
+#            --sample 50 --threads 4 8 --modes sequential batched parallel
+
+########################################################################
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import tempfile
+import time
+from queue import Empty
+
+import ctranslate2
+import numpy as np
+
+from src.autotune import sample_split
+from src.transcribe import segment_durations, transcribe_file, transcribe_file_parallel
+
+MODES = ["sequential", "batched", "parallel"]
+
+
+def valid_compute_types(device: str = "cpu") -> list:
+    """Compute types CTranslate2 supports on this machine."""
+    return sorted(ctranslate2.get_supported_compute_types(device))
+
+
+def benchmark_runs(
+    compute_types: list,
+    threads: list,
+    modes: list = MODES,
+    batch_size: int = 16,
+    processes: int = 2,
+    workers: int = 1,
+) -> list:
+    """
+    The combinations to benchmark.
+
+    Parameters:
+    - compute_types (list): Compute types, e.g. from `valid_compute_types`.
+    - threads (list): Number of cores to use. In parallel mode they are divided
+      between the processes and their workers.
+    - modes (list): "sequential" for `transcribe_file`, "batched" for
+      `transcribe_file` with `batch_size` and "parallel" for
+      `transcribe_file_parallel`.
+    - batch_size (int): Batch size of the batched mode. Defaults to 16.
+    - processes (int): Processes of the parallel mode. Defaults to 2.
+    - workers (int): Workers per process of the parallel mode. Defaults to 1.
+
+    Returns:
+    - list: One dict of settings per run.
+    """
+
+    runs = []
+    for compute_type in compute_types:
+        for cores in threads:
+            for mode in modes:
+                if mode not in MODES:
+                    raise ValueError(f"Unknown mode {mode}, expected one of {MODES}")
+                run = {"mode": mode, "compute_type": compute_type, "threads": cores}
+                if mode == "batched":
+                    run["batch_size"] = batch_size
+                elif mode == "parallel":
+                    run.update(
+                        batches=processes,
+                        num_workers=workers,
+                        cpu_threads=max(1, cores // (processes * workers)),
+                    )
+                runs.append(run)
+    return runs
+
+
+def percentiles(latencies: list) -> dict:
+    """p50, p95 and p99 of a list of seconds, in milliseconds."""
+    if not latencies:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+    return {"p50": round(p50, 2), "p95": round(p95, 2), "p99": round(p99, 2)}
+
+
+def _run(run: dict, sample: str, whisper_model: str, results) -> None:
+    hyp_output = sample + f".{os.getpid()}.hyp"
+    start = time.perf_counter()
+    try:
+        if run["mode"] == "parallel":
+            stats = transcribe_file_parallel(
+                sample,
+                hyp_output,
+                whisper_model,
+                device="cpu",
+                compute_type=run["compute_type"],
+                batches=run["batches"],
+                cpu_threads=run["cpu_threads"],
+                num_workers=run["num_workers"],
+            )
+            load_time = max(w["load_time"] for w in stats.values())
+            latencies = [t for w in stats.values() for t in w["latencies"]]
+        else:
+            stats = transcribe_file(
+                sample,
+                hyp_output,
+                whisper_model,
+                device="cpu",
+                compute_type=run["compute_type"],
+                batch_size=run.get("batch_size", 1),
+                cpu_threads=run["threads"],
+            )
+            load_time = stats["load_time"]
+            latencies = stats["latencies"]
+    except Exception as e:
+        results.put({"error": f"{type(e).__name__}: {e}"})
+        return
+    wall_time = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux. For the children it is the peak of
+    # the largest one, i.e. of one worker process in parallel mode.
+    results.put(
+        {
+            "wall_time": wall_time,
+            "load_time": load_time,
+            "latencies": latencies,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "peak_worker_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            / 1024,
+        }
+    )
+
+
+def benchmark(
+    data_path: str,
+    whisper_model: str,
+    sample_size: int = 50,
+    compute_types: list = None,
+    threads: list = None,
+    modes: list = MODES,
+    batch_size: int = 16,
+    processes: int = 2,
+    workers: int = 1,
+    output: str = None,
+    seed: int = 0,
+) -> dict:
+    """
+    Benchmark transcription on CPU with a fixed sample of a split.
+
+    Parameters:
+    - data_path (str): Path to a `.trans` file, e.g. segmented/test.trans.
+    - whisper_model (str): Path to the pretrained Faster-Whisper model.
+    - sample_size (int, optional): Number of files to transcribe. Defaults to 50.
+    - compute_types (list, optional): Compute types to try. Defaults to all that
+      CTranslate2 supports on this CPU.
+    - threads (list, optional): Numbers of cores to try. Defaults to all cores.
+    - modes (list, optional): Modes to try, see `benchmark_runs`.
+    - batch_size (int, optional): Batch size of the batched mode. Defaults to 16.
+    - processes (int, optional): Processes of the parallel mode. Defaults to 2.
+    - workers (int, optional): Workers per process of the parallel mode. Defaults to 1.
+    - output (str, optional): JSON file to write the results to.
+    - seed (int, optional): Seed of the sample. Defaults to 0.
+
+    Returns:
+    - dict: The machine, the sample and the results of every run.
+    """
+
+    supported = valid_compute_types("cpu")
+    compute_types = compute_types or supported
+    threads = threads or [os.cpu_count()]
+    durations = segment_durations(data_path)
+    context = multiprocessing.get_context("spawn")
+
+    report = {
+        "machine": {
+            "node": platform.node(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "supported_compute_types": supported,
+        },
+        "data_path": data_path,
+        "whisper_model": whisper_model,
+        "runs": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        sample = sample_split(data_path, sample_size, tmp, seed)
+        wav_ids = [
+            os.path.basename(line.split("\t")[0]).rstrip(".wav")
+            for line in open(sample)
+        ]
+        audio_seconds = sum(durations.get(wav_id, 0) for wav_id in wav_ids)
+        report.update(sample_size=len(wav_ids), audio_seconds=round(audio_seconds, 3))
+
+        for run in benchmark_runs(
+            compute_types, threads, modes, batch_size, processes, workers
+        ):
+            if run["compute_type"] not in supported:
+                run["error"] = (
+                    f"compute_type {run['compute_type']} is not supported on this"
+                    f" CPU, use one of {supported}"
+                )
+            else:
+                # A fresh process per run, so memory and load time aren't
+                # shared between runs.
+                results = context.Queue()
+                p = context.Process(
+                    target=_run, args=(run, sample, whisper_model, results)
+                )
+                p.start()
+                result = None
+                while result is None:
+                    try:
+                        result = results.get(timeout=1)
+                    except Empty:
+                        if not p.is_alive():
+                            result = {"error": f"Exited with code {p.exitcode}"}
+                p.join()
+                if "error" in result:
+                    run["error"] = result["error"]
+                else:
+                    decode_time = result["wall_time"] - result["load_time"]
+                    run.update(
+                        wall_time=round(result["wall_time"], 3),
+                        model_load_time=round(result["load_time"], 3),
+                        rtf=(
+                            round(decode_time / audio_seconds, 4)
+                            if audio_seconds
+                            else None
+                        ),
+                        latency_ms=percentiles(result["latencies"]),
+                        peak_rss_mb=round(result["peak_rss_mb"], 1),
+                        peak_worker_rss_mb=round(result["peak_worker_rss_mb"], 1),
+                    )
+            print(json.dumps(run))
+            report["runs"].append(run)
+
+    if output:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(report, f, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark transcription on CPU.")
+    parser.add_argument("data_path", help="A .trans file, e.g. segmented/test.trans")
+    parser.add_argument("whisper_model")
+    parser.add_argument("--sample", type=int, default=50)
+    parser.add_argument("--compute-types", nargs="+", default=None)
+    parser.add_argument("--threads", type=int, nargs="+", default=None)
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="results/benchmark.json")
+    args = parser.parse_args()
+
+    benchmark(
+        args.data_path,
+        args.whisper_model,
+        sample_size=args.sample,
+        compute_types=args.compute_types,
+        threads=args.threads,
+        modes=args.modes,
+        batch_size=args.batch_size,
+        processes=args.processes,
+        workers=args.workers,
+        output=args.output,
+        seed=args.seed,
+    )
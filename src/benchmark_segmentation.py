@@ -0,0 +1,357 @@
+########################################################################
+
+# Author   : David Erik Mollberg & Carlos Daniel Hernández Mena
+# Date     : November 1st, 2023
+# Location : Reykjavík University and Tiro ehf.
+
+# Scaling benchmarks for the segmentation pipeline. A synthetic corpus of
+# transcripts and silent WAV files of a given size is generated and
+# `run_segmentation` is run on it. The time of each of its stages, as
+# recorded by its own `StageTimer`s: loading, planning, writing, audio
+# extraction and manifest writing, is reported with peak RSS and segments
+# per second and written as JSON, so regressions can be tracked.
+#
+# With --legacy the planner is instead compared against the original
+# split/insert/merge loops for both speed and equal results.
+#
+# Usage: python -m src.benchmark_segmentation --hours 0.1 10 100 --output bench.json
+#        python -m src.benchmark_segmentation --legacy --hours 1 5 20
+
+########################################################################
+
+import argparse
+import copy
+import json
+import os
+import random
+import resource
+import shutil
+import struct
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from src.segment import (
+    add_padding,
+    flatten,
+    load_transcript_columns,
+    merge_segments,
+    plan_segments,
+    run_segmentation,
+    segment_duration,
+    split_in_half,
+)
+
+
+def synthetic_transcript(hours: float, seed: int = 0) -> list:
+    """
+    Create a transcript in the format of the Spjallromur JSON files.
+
+    Sentences vary from a few words to a few minutes without punctuation,
+    so both the splitting and the merging of segments are exercised.
+
+    Parameters:
+    - hours (float): Length of the transcript in hours.
+    - seed (int): Seed for the random generator.
+
+    Returns:
+    - list: List of word objects.
+    """
+
+    rng = random.Random(seed)
+    words = []
+    time_stamp = 0.0
+    sentence_length = rng.randint(1, 40)
+    while time_stamp < hours * 3600:
+        time_stamp += rng.choice([0.0, 0.0, 0.05, 0.3, 1.5])
+        start = round(time_stamp, 2)
+        time_stamp += rng.uniform(0.1, 0.6)
+        end = round(time_stamp, 2)
+
+        word = rng.choice(["já", "nei", "hérna", "<unk>", "bara", "sko"])
+        sentence_length -= 1
+        if sentence_length <= 0:
+            word += rng.choice([".", "?", "!"])
+            sentence_length = rng.choice([rng.randint(1, 40), rng.randint(40, 600)])
+        words.append(
+            {"word": word, "norm_word": word.rstrip(".?!"), "start": start, "end": end}
+        )
+    return words
+
+
+def silent_wav(path: str, duration: float, sample_rate: int = 16000) -> None:
+    """
+    Write a silent 16 bit mono WAV file. The samples are left as a hole in a
+    sparse file, so even very long recordings take no time or disk to create.
+
+    Parameters:
+    - path (str): Path of the WAV file.
+    - duration (float): Length in seconds.
+    - sample_rate (int): Sample rate of the audio.
+    """
+
+    data_size = int(duration * sample_rate) * 2
+    header = b"RIFF" + struct.pack("<I", 36 + data_size) + b"WAVE"
+    header += b"fmt " + struct.pack(
+        "<IHHIIHH", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16
+    )
+    header += b"data" + struct.pack("<I", data_size)
+    with open(path, "wb") as f:
+        f.write(header)
+        f.truncate(len(header) + data_size)
+
+
+def synthetic_corpus(
+    root: str,
+    hours: float,
+    recording_hours: float = 0.5,
+    sample_rate: int = 16000,
+    seed: int = 0,
+) -> list:
+    """
+    Create a corpus of synthetic recordings in the layout of full_conversations.
+
+    Parameters:
+    - root (str): Directory to create the corpus in.
+    - hours (float): Total length of the corpus in hours.
+    - recording_hours (float): Length of each recording in hours.
+    - sample_rate (int): Sample rate of the audio.
+    - seed (int): Seed for the random generator.
+
+    Returns:
+    - list: Paths of the WAV files.
+    """
+
+    audio_files = []
+    remaining = hours
+    while remaining > 0:
+        length = min(recording_hours, remaining)
+        remaining -= length
+        idx = len(audio_files)
+        folder = os.path.join(root, "full_conversations", f"{idx:08x}")
+        os.makedirs(folder, exist_ok=True)
+        audio_file = os.path.join(folder, f"a_{idx:08x}_20-29_f.wav")
+
+        words = synthetic_transcript(length, seed + idx)
+        duration = words[-1]["end"] + 1 if words else length * 3600
+        metadata = {"age": "20-29", "gender": "female", "audio_duration": duration}
+        with open(audio_file.replace(".wav", ".json"), "w") as f:
+            json.dump({"metadata": metadata, "words": words}, f, ensure_ascii=False)
+        silent_wav(audio_file, duration, sample_rate)
+        audio_files.append(audio_file)
+    return audio_files
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the current process in megabytes."""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def benchmark_pipeline(
+    hours: float,
+    recording_hours: float = 0.5,
+    sample_rate: int = 16000,
+    output_mode: str = "files",
+    seed: int = 0,
+    workdir: str = None,
+) -> dict:
+    """
+    Time every stage of `run_segmentation` on a synthetic corpus.
+
+    Parameters:
+    - hours (float): Total length of the corpus in hours.
+    - recording_hours (float): Length of each recording in hours.
+    - sample_rate (int): Sample rate of the audio.
+    - output_mode (str): "files" or "shards" to cut the audio or "virtual" to only plan it.
+    - seed (int): Seed for the random generator.
+    - workdir (str): Directory for the corpus and output, a temporary one by default.
+
+    Returns:
+    - dict: Wall time of `run_segmentation` and the total time of each of its
+      stages in seconds, the number of recordings, words and segments,
+      segments per second and peak RSS.
+    """
+
+    root = tempfile.mkdtemp(prefix="spjallromur_bench_", dir=workdir)
+    cwd = os.getcwd()
+    try:
+        start = time.perf_counter()
+        audio_files = synthetic_corpus(root, hours, recording_hours, sample_rate, seed)
+        generate = time.perf_counter() - start
+        n_words = sum(
+            len(load_transcript_columns(f[: -len(".wav")] + ".json").word)
+            for f in audio_files
+        )
+
+        splits_folder = os.path.join(root, "splits")
+        os.makedirs(splits_folder)
+        for split in ["train", "dev", "test"]:
+            with open(os.path.join(splits_folder, split), "w") as f:
+                if split == "train":
+                    f.writelines(
+                        os.path.basename(a)[: -len(".wav")] + "\n" for a in audio_files
+                    )
+
+        # run_segmentation finds the recordings under the working directory.
+        os.chdir(root)
+        run_segmentation(
+            "segmented",
+            splits_folder,
+            output_mode=output_mode,
+            metrics_file="metrics.json",
+        )
+        with open(os.path.join("segmented", "metrics.json")) as f:
+            summary = json.load(f)
+
+        phases = dict(summary["stages"])
+        phases["manifest"] = summary["run"]["stages"].get("manifest", 0.0)
+        total = summary["wall_time"]
+        segments = summary.get("segments", 0)
+        return {
+            "hours": hours,
+            "output_mode": output_mode,
+            "recordings": len(audio_files),
+            "words": n_words,
+            "segments": segments,
+            "generate": round(generate, 4),
+            "phases": {k: round(v, 4) for k, v in phases.items()},
+            "total": round(total, 4),
+            "segments_per_second": round(segments / total, 1) if total else None,
+            "bytes_written": summary.get("bytes_written", 0),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def legacy_plan_segments(
+    transcript: list, min_duration: int = 2, max_duration: int = 20
+) -> list:
+    """
+    The segmentation loops `run_segmentation` used before `plan_segments`,
+    kept as a reference for correctness and speed.
+    """
+
+    segments = []
+    segment = []
+    for idx, item in enumerate(transcript):
+        segment.append(item)
+        if segment and item["word"][-1] in [".", "?", "!"]:
+            if idx + 1 < len(transcript):
+                segment[-1]["end"] = add_padding(
+                    segment[-1]["end"], transcript[idx + 1]["end"]
+                )
+            segments.append(segment)
+            segment = []
+    if segment:
+        segments.append(segment)
+
+    while [seg for seg in segments if segment_duration(seg) > max_duration]:
+        idx = 0
+        while idx < len(segments):
+            seg = segments[idx]
+            if segment_duration(seg) > max_duration:
+                a, b = split_in_half(seg)
+                del segments[idx]
+                segments.insert(idx, b)
+                segments.insert(idx, a)
+                idx += 2
+            else:
+                idx += 1
+
+    segments = [flatten(seg) for seg in segments]
+
+    idx = 0
+    while idx < len(segments) - 1:
+        combined_seg = merge_segments(segments[idx], segments[idx + 1])
+        if combined_seg["duration"] <= max_duration:
+            segments[idx] = combined_seg
+            del segments[idx + 1]
+        else:
+            idx += 1
+
+    segments = [seg for seg in segments if seg["duration"] >= min_duration]
+    return [seg for seg in segments if seg["text_norm"].strip().rstrip()]
+
+
+def benchmark_planner(hours: float, legacy: bool = True, seed: int = 0) -> dict:
+    """
+    Time the planner on a synthetic transcript.
+
+    Parameters:
+    - hours (float): Length of the transcript in hours.
+    - legacy (bool): Whether to also time the original loops and compare.
+    - seed (int): Seed for the random generator.
+
+    Returns:
+    - dict: Timings in seconds and the number of words and segments.
+    """
+
+    transcript = synthetic_transcript(hours, seed)
+    result = {"hours": hours, "words": len(transcript)}
+
+    start = time.perf_counter()
+    segments = plan_segments(
+        [w["word"] for w in transcript],
+        [w["norm_word"] for w in transcript],
+        [w["start"] for w in transcript],
+        [w["end"] for w in transcript],
+    )
+    result["plan_segments"] = round(time.perf_counter() - start, 4)
+    result["segments"] = len(segments)
+
+    if legacy:
+        transcript = copy.deepcopy(transcript)
+        start = time.perf_counter()
+        legacy_segments = legacy_plan_segments(transcript)
+        result["legacy"] = round(time.perf_counter() - start, 4)
+        result["equal"] = legacy_segments == segments
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the segmentation pipeline on synthetic corpora."
+    )
+    parser.add_argument("--hours", type=float, nargs="+", default=[0.1, 1, 10])
+    parser.add_argument(
+        "--legacy",
+        action="store_true",
+        help="Compare the planner with the original loops instead",
+    )
+    parser.add_argument("--recording-hours", type=float, default=0.5)
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    parser.add_argument(
+        "--output-mode",
+        choices=["files", "virtual", "shards"],
+        default="files",
+        help="Use virtual to skip cutting audio for very large corpora",
+    )
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = []
+    for hours in args.hours:
+        if args.legacy:
+            result = benchmark_planner(hours, seed=args.seed)
+        else:
+            # A fresh process for each size, so peak RSS is measured per size.
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(
+                    benchmark_pipeline,
+                    hours,
+                    args.recording_hours,
+                    args.sample_rate,
+                    args.output_mode,
+                    args.seed,
+                    args.workdir,
+                ).result()
+        print(json.dumps(result))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
@@ -17,6 +17,8 @@ import os
 import subprocess
 from glob import glob
 
+from src.wordstore import WORD_STORE, WordColumns, WordStore
+
 # Define paths
 ROOT = "."
 OUTPUT_ROOT = "combined"
@@ -43,67 +45,124 @@ def merge_audio_files(file1, file2, output_file):
         print("Error merging audio files.")
 
 
-def merge_transcripts(transcript_a, transcript_b):
+def load_columns(transcript, word_store=None):
     """
-    Combines the transcripts of two speakers into a single JSON file.
+    Loads the words and metadata of a transcript, from the word store when it
+    holds an up to date copy of the transcript and from the JSON file otherwise.
+
+    Args:
+        transcript (str): Path to the transcript.
+        word_store (WordStore): An open word store, or None.
+
+    Returns:
+        tuple: The metadata and the words as WordColumns.
+    """
+    if word_store is not None and word_store.is_current(transcript):
+        return word_store.metadata(transcript), word_store.columns(transcript)
+
+    with open(transcript, "r") as file:
+        data = json.load(file)
+    words = data["words"]
+    return data["metadata"], WordColumns(
+        [w["word"] for w in words],
+        [w["norm_word"] for w in words],
+        [w["start"] for w in words],
+        [w["end"] for w in words],
+        None,
+    )
+
+
+def merge_transcripts(transcript_a, transcript_b, word_store=None):
+    """
+    Combines the transcripts of two speakers into a single transcript.
 
     Args:
         transcript_a (str): Path to the transcript of the first speaker.
         transcript_b (str): Path to the transcript of the second speaker.
-        output_file (str): Path where the combined transcript will be saved.
+        word_store (WordStore): An open word store to read the transcripts from.
 
     Returns:
-        dict: The combined transcript data.
+        dict: The combined transcript data, with the words as WordColumns
+        sorted by start time.
     """
-    with open(transcript_a, "r") as file:
-        trans_a = json.load(file)
-    with open(transcript_b, "r") as file:
-        trans_b = json.load(file)
+    meta_a, words_a = load_columns(transcript_a, word_store)
+    meta_b, words_b = load_columns(transcript_b, word_store)
+
+    n_a = len(words_a.start)
+    starts = list(words_a.start) + list(words_b.start)
+    # A stable sort, so words of speaker a come first when the start times are equal.
+    order = sorted(range(len(starts)), key=starts.__getitem__)
 
-    for w in trans_a["words"]:
-        w["spk"] = "a"
-    for w in trans_b["words"]:
-        w["spk"] = "b"
+    def merged(column_a, column_b):
+        return [column_a[i] if i < n_a else column_b[i - n_a] for i in order]
 
-    combined = trans_a["words"] + trans_b["words"]
-    combined.sort(key=lambda s: s["start"])
+    combined = WordColumns(
+        merged(words_a.word, words_b.word),
+        merged(words_a.norm_word, words_b.norm_word),
+        [starts[i] for i in order],
+        merged(words_a.end, words_b.end),
+        ["a" if i < n_a else "b" for i in order],
+    )
 
     return {
         "metadata": {
             "speaker_a": {
-                "age": trans_a["metadata"]["age"],
-                "gender": trans_a["metadata"]["gender"],
+                "age": meta_a["age"],
+                "gender": meta_a["gender"],
             },
             "speaker_b": {
-                "age": trans_b["metadata"]["age"],
-                "gender": trans_b["metadata"]["gender"],
+                "age": meta_b["age"],
+                "gender": meta_b["gender"],
             },
         },
         "words": combined,
     }
 
 
+def to_json(data):
+    """
+    Converts a combined transcript to the structure of the combined JSON files.
+
+    Args:
+        data (dict): The combined transcript data.
+
+    Returns:
+        dict: The combined transcript with one dict per word.
+    """
+    words = data["words"]
+    return {
+        "metadata": data["metadata"],
+        "words": [
+            {"word": w, "norm_word": n, "start": s, "end": e, "spk": spk}
+            for w, n, s, e, spk in zip(
+                words.word, words.norm_word, words.start, words.end, words.spk
+            )
+        ],
+    }
+
+
 def convert2rttm(data, file_id):
     """
     Converts the combined transcript into the RTTM format.
 
     Args:
         data (dict): The combined transcript data.
-        output_file (str): Path where the RTTM file will be saved.
         file_id (str): A unique identifier for the audio file.
     """
     rttm = []
-    spk, curr_spk = data["words"][0]["spk"], data["words"][0]["spk"]
-    start = data["words"][0]["start"]
+    words = data["words"]
+    starts, ends, spks = words.start, words.end, words.spk
+    spk, curr_spk = spks[0], spks[0]
+    start = starts[0]
     spk_mapping = {
         "a": f"a_{data['metadata']['speaker_a']['age']}_{data['metadata']['speaker_a']['gender']}",
         "b": f"b_{data['metadata']['speaker_b']['age']}_{data['metadata']['speaker_b']['gender']}",
     }
     duration = 0.1
-    for idx, word in enumerate(data["words"]):
-        spk = word["spk"]
+    for idx in range(len(spks)):
+        spk = spks[idx]
         if idx > 0:
-            duration = round(data["words"][idx - 1]["end"] - start, 2)
+            duration = round(ends[idx - 1] - start, 2)
 
         if duration == 0.0:
             print("stop")
@@ -112,23 +171,28 @@ def convert2rttm(data, file_id):
             rttm.append(s)
 
             curr_spk = spk
-            start = word["start"]
+            start = starts[idx]
 
         # Add the last turn
-        if idx == len(data["words"]) - 1:
-            duration = round(word["end"] - start, 2)
+        if idx == len(spks) - 1:
+            duration = round(ends[idx] - start, 2)
             if duration > 0.2:
                 s1 = f"SPEAKER {file_id} 1 {start} {duration} <NA> <NA> {spk_mapping[spk]} <NA> <NA>"
                 rttm.append(s1)
     return rttm
 
 
-def convert():
+def convert(word_store=WORD_STORE):
     """
     Main execution function.
     Merges speaker transcripts and audio files, then converts the transcript to RTTM format.
+
+    Args:
+        word_store (str): Path to a word store, see `src.wordstore`. The JSON
+            transcripts are read when it doesn't exist.
     """
     os.makedirs(OUTPUT_ROOT, exist_ok=True)
+    store = WordStore(word_store) if os.path.exists(word_store) else None
 
     for folder in glob(f"{ROOT}/full_conversations/*"):
         print(f"Preparing '{folder}'")
@@ -145,13 +209,10 @@ def convert():
         merged_json = os.path.join(out_dir, f"{new_filename}.json")
         merged_rttm = os.path.join(out_dir, f"{new_filename}.rttm")
 
-        merged_data = merge_transcripts(
-            spk_a_trans,
-            spk_b_trans,
-        )
+        merged_data = merge_transcripts(spk_a_trans, spk_b_trans, word_store=store)
         if not os.path.exists(merged_json):
             with open(merged_json, "w") as file:
-                json.dump(merged_data, file, ensure_ascii=False, indent=4)
+                json.dump(to_json(merged_data), file, ensure_ascii=False, indent=4)
         else:
             print(f"{merged_json} already exists, wont overwrite.")
 
@@ -0,0 +1,116 @@
+########################################################################
+
+# Author   : Carlos Daniel Hernández Mena & David Erik Mollberg
+# Date     : November 1st, 2023
+# Location : Reykjavík University and Tiro ehf.
+
+# Description:
+
+# SHA-256 digests of audio files and model directories, used as keys by
+# the transcription cache, the decoding sweep and the feature store.
+# Digests of files are remembered in their own SQLite database while the
+# size and modification time of a file stay the same, so large files are
+# only read again when they change.
+
+########################################################################
+
+import hashlib
+import io
+import os
+import sqlite3
+
+DIGEST_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "spjallromur", "digests.sqlite"
+)
+
+
+class DigestCache:
+    """
+    Remembered SHA-256 digests of files, shared by every run that uses them.
+
+    Each digest is committed right away and the database is in WAL mode, so
+    concurrent runs don't wait on each other.
+    """
+
+    def __init__(self, path: str = DIGEST_CACHE):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=60.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS digests (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                digest TEXT NOT NULL
+            )
+            """)
+        self._db.commit()
+
+    def file_digest(self, path: str) -> str:
+        """
+        SHA-256 of a file, remembered as long as its size and modification
+        time stay the same.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self._db.execute(
+            "SELECT digest FROM digests WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, stat.st_size, stat.st_mtime_ns),
+        ).fetchone()
+        if row:
+            return row[0]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        digest = digest.hexdigest()
+        self._db.execute(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime_ns, digest),
+        )
+        self._db.commit()
+        return digest
+
+    def model_digest(self, whisper_model: str) -> str:
+        """
+        Digest of a CTranslate2 model directory, over the names and contents
+        of its files. Model names that aren't directories are used as is.
+        """
+        if not os.path.isdir(whisper_model):
+            return whisper_model
+        digest = hashlib.sha256()
+        for root, _, files in sorted(os.walk(whisper_model)):
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, whisper_model).encode("utf-8"))
+                digest.update(self.file_digest(path).encode("utf-8"))
+        return digest.hexdigest()
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def audio_digest(reader, wav_file: str, digests: DigestCache = None) -> str:
+    """
+    SHA-256 of the audio of a segment, read through a `src.audio.SegmentReader`
+    so virtual and sharded segments are hashed by their content too. Digests
+    of segments that are files are remembered in `digests` if given.
+    """
+    if digests is not None and wav_file not in reader.table:
+        return digests.file_digest(wav_file)
+    source = reader.resolve(wav_file)
+    if isinstance(source, io.BytesIO):
+        return hashlib.sha256(source.getbuffer()).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,183 @@
+########################################################################
+
+# Author   : Carlos Daniel Hernández Mena & David Erik Mollberg
+# Date     : November 1st, 2023
+# Location : Reykjavík University and Tiro ehf.
+
+# Description:
+
+# A persistent store of Whisper log-Mel features for finetuning, so the
+# audio of a segment is decoded and its features computed once rather
+# than on every launch of finetune. Features are kept in float16 in one
+# memory-mapped file per feature extractor configuration, with an index
+# from the SHA-256 of each segment's audio to its row. Only segments that
+# aren't in the store yet are computed.
+
+########################################################################
+
+import fcntl
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+import librosa
+import numpy as np
+from tqdm import tqdm
+
+from src.audio import SegmentReader
+from src.digests import DigestCache, audio_digest
+
+FEATURE_STORE = os.path.join(
+    os.path.expanduser("~"), ".cache", "spjallromur", "features"
+)
+
+
+def extractor_key(feature_extractor) -> str:
+    """Digest of the configuration of a `WhisperFeatureExtractor`."""
+    config = json.dumps(feature_extractor.to_dict(), sort_keys=True, default=str)
+    return hashlib.sha256(config.encode("utf-8")).hexdigest()[:16]
+
+
+class FeatureStore:
+    """
+    Log-Mel features of one feature extractor configuration.
+
+    `features.f16` holds one (feature_size, nb_max_frames) float16 record per
+    segment and `index.tsv` the audio digest of each record, one per line.
+    Records are appended before their index line, so an interrupted run
+    never leaves an index line without its features. Runs that share the
+    store take a lock on it to append, and pick up what the others added.
+
+    Parameters:
+    - feature_extractor (WhisperFeatureExtractor): The feature extractor.
+    - root (str, optional): Folder of the store. Defaults to `FEATURE_STORE`.
+    """
+
+    def __init__(self, feature_extractor, root: str = FEATURE_STORE):
+        self.feature_extractor = feature_extractor
+        self.folder = os.path.join(root, extractor_key(feature_extractor))
+        os.makedirs(self.folder, exist_ok=True)
+        self.shape = (feature_extractor.feature_size, feature_extractor.nb_max_frames)
+        self.record_size = int(np.prod(self.shape)) * 2
+        self.data_path = os.path.join(self.folder, "features.f16")
+        self.index_path = os.path.join(self.folder, "index.tsv")
+        self.rows = {}
+        self._records = 0
+        self._index_offset = 0
+        with self._locked():
+            config_path = os.path.join(self.folder, "config.json")
+            if not os.path.exists(config_path):
+                with open(config_path, "w") as f:
+                    f.write(feature_extractor.to_json_string())
+            self._sync()
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.folder, "lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _sync(self):
+        # With the lock held: read the index lines appended since the last
+        # call, by this or another run, and drop what an interrupted run left
+        # half written.
+        stored = (
+            os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        )
+        with open(self.index_path, "ab+") as f:
+            f.seek(self._index_offset)
+            for line in f:
+                if (
+                    not line.endswith(b"\n")
+                    or (self._records + 1) * self.record_size > stored
+                ):
+                    break
+                self.rows.setdefault(line[:-1].decode("utf-8"), self._records)
+                self._records += 1
+                self._index_offset += len(line)
+            f.truncate(self._index_offset)
+        # Drop features whose index line was never written.
+        with open(self.data_path, "ab") as f:
+            f.truncate(self._records * self.record_size)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, digest: str, features: np.ndarray) -> int:
+        """Append the features of a segment. Returns its row."""
+        features = np.asarray(features, dtype=np.float16)
+        if features.shape != self.shape:
+            raise ValueError(
+                f"Expected features of shape {self.shape}, got {features.shape}"
+            )
+        with self._locked():
+            self._sync()
+            if digest not in self.rows:
+                with open(self.data_path, "ab") as f:
+                    f.write(features.tobytes())
+                with open(self.index_path, "ab") as f:
+                    f.write(digest.encode("utf-8") + b"\n")
+                self._sync()
+        return self.rows[digest]
+
+    def features(self) -> np.memmap:
+        """All stored features, memory-mapped and read only."""
+        if not self._records:
+            return np.zeros((0, *self.shape), dtype=np.float16)
+        return np.memmap(
+            self.data_path,
+            dtype=np.float16,
+            mode="r",
+            shape=(self._records, *self.shape),
+        )
+
+
+def prepare_features(
+    audio_files: list,
+    feature_extractor,
+    segment_reader: SegmentReader = None,
+    root: str = FEATURE_STORE,
+) -> tuple:
+    """
+    Log-Mel features of segments, computed only for those not in the store.
+
+    Segments are identified by the SHA-256 of their audio. Digests of audio
+    files are remembered by `src.digests` while the files don't change, so
+    they are only read again if they do.
+
+    Parameters:
+    - audio_files (list): Paths of the segments, as in the `.trans` files.
+    - feature_extractor (WhisperFeatureExtractor): The feature extractor.
+    - segment_reader (SegmentReader, optional): Reader for virtual and sharded segments.
+    - root (str, optional): Folder of the store. Defaults to `FEATURE_STORE`.
+
+    Returns:
+    - tuple: The memory-mapped features and the row of each segment.
+    """
+
+    reader = segment_reader or SegmentReader({})
+    store = FeatureStore(feature_extractor, root)
+    sampling_rate = feature_extractor.sampling_rate
+
+    with DigestCache() as digest_cache:
+        digests = [
+            audio_digest(reader, path, digest_cache)
+            for path in tqdm(audio_files, desc="Hashing audio")
+        ]
+
+    missing = [i for i, digest in enumerate(digests) if digest not in store.rows]
+    print(
+        f"Feature store {store.folder}: {len(audio_files) - len(missing)} of"
+        f" {len(audio_files)} segments cached"
+    )
+    for i in tqdm(missing, desc="Computing features"):
+        if digests[i] in store.rows:
+            continue
+        array, _ = librosa.load(reader.resolve(audio_files[i]), sr=sampling_rate)
+        features = feature_extractor(array, sampling_rate=sampling_rate)
+        store.add(digests[i], features.input_features[0])
+    return store.features(), [store.rows[digest] for digest in digests]
@@ -3,6 +3,8 @@ from dataclasses import dataclass
 from typing import Any, Dict, List, Union
 
 import evaluate
+import librosa
+import numpy as np
 import torch
 from datasets import Audio, Dataset, IterableDatasetDict
 from transformers import (
@@ -15,6 +17,9 @@ from transformers import (
 )
 import os
 
+from src.audio import SegmentReader, load_segment_table
+from src.feature_store import FEATURE_STORE, prepare_features
+
 
 def convert(model_dir: str) -> str:
     output = f"{model_dir}_ct2"
@@ -52,6 +57,24 @@ def load_data(file_path):
     return data
 
 
+class FeatureDataset(torch.utils.data.Dataset):
+    """Segments with their log-Mel features read from a feature store."""
+
+    def __init__(self, features: np.memmap, rows: list, labels: list):
+        self.features = features
+        self.rows = rows
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        return {
+            "input_features": np.asarray(self.features[self.rows[i]], dtype=np.float32),
+            "labels": self.labels[i],
+        }
+
+
 @dataclass
 class DataCollatorSpeechSeq2SeqWithPadding:
     processor: Any
@@ -94,9 +117,25 @@ def finetune(
     test_trans: str = "segmented/train.trans",
     train_trans: str = "segmented/test.trans",
     output_dir: str = "./whisper-large-icelandic-30k-steps-1000h-spjallromur-test",
+    feature_store: str = FEATURE_STORE,
 ):
+    """
+    Finetune a Whisper model on the Spjallrómur segments.
+
+    With `feature_store` set, the log-Mel features of the segments are taken
+    from a persistent store, see `src.feature_store`, and only those of new
+    segments are computed. Otherwise they are computed on every run.
+    """
+
     def prepare_dataset(batch):
-        audio = batch["audio"]
+        if segment_reader is not None:
+            # virtual segments are read from their source recordings on demand
+            array, sampling_rate = librosa.load(
+                segment_reader.resolve(batch["audio"]), sr=16000
+            )
+            audio = {"array": array, "sampling_rate": sampling_rate}
+        else:
+            audio = batch["audio"]
 
         # compute log-Mel input features from input audio array
         batch["input_features"] = feature_extractor(
@@ -152,13 +191,33 @@ def finetune(
         }
     )
 
-    spjallromur = spjallromur.cast_column("audio", Audio(sampling_rate=16000))
+    # Segments written by run_segmentation in virtual mode have no audio
+    # files of their own, so they are decoded in prepare_dataset instead.
+    segment_table = {}
+    for trans in [train_trans, dev_trans, test_trans]:
+        segment_table.update(load_segment_table(trans))
+    segment_reader = SegmentReader(segment_table) if segment_table else None
+    if segment_reader is None:
+        spjallromur = spjallromur.cast_column("audio", Audio(sampling_rate=16000))
 
     feature_extractor = WhisperFeatureExtractor.from_pretrained(whisper_model)
     tokenizer = WhisperTokenizer.from_pretrained(
         whisper_model, language="Icelandic", task="transcribe"
     )
-    spjallromur = spjallromur.map(prepare_dataset).with_format("torch")
+    if feature_store:
+        splits = {"train": train_data, "dev": dev_data, "test": test_data}
+        spjallromur = {}
+        for split, data in splits.items():
+            features, rows = prepare_features(
+                [d["audio"] for d in data],
+                feature_extractor,
+                segment_reader,
+                feature_store,
+            )
+            labels = tokenizer([d["transcript"] for d in data]).input_ids
+            spjallromur[split] = FeatureDataset(features, rows, labels)
+    else:
+        spjallromur = spjallromur.map(prepare_dataset).with_format("torch")
 
     processor = WhisperProcessor.from_pretrained(
         whisper_model, language="Icelandic", task="transcribe"
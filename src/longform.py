@@ -0,0 +1,237 @@
+########################################################################
+
+# Author   : Carlos Daniel Hernández Mena & David Erik Mollberg
+# Date     : November 1st, 2023
+# Location : Reykjavík University and Tiro ehf.
+
+# Description:
+
+# Transcribes whole recordings, the per-speaker files in
+# full_conversations/ or the mixed files in combined/, without cutting
+# them into segment files first. Each recording is read into memory once,
+# chunked with its word timestamps, the same way run_segmentation plans
+# segments, or with voice activity detection, and the chunks are
+# transcribed in batches. The hypotheses are written in the usual
+# `wav_id\tref\thyp` format, next to an `.info` file with the absolute
+# start and end time of every chunk in its recording.
+
+########################################################################
+
+import os
+import re
+from glob import glob
+
+from faster_whisper import WhisperModel
+from tqdm import tqdm
+
+from src.audio import load_audio, seconds_to_frames
+from src.segment import load_transcript_columns, open_splits_files, plan_segments
+from src.transcribe import HypothesisWriter, transcribe_segments
+
+
+def find_recordings(
+    source: str = "full_conversations", split: str = None, splits_folder="splits"
+) -> list:
+    """
+    Find the recordings to transcribe and their transcripts.
+
+    Parameters:
+    - source (str): "full_conversations" for one recording per speaker or
+      "combined" for the mixed recordings of `src.convert2diarization`.
+    - split (str, optional): Only include recordings of speakers in this split,
+      e.g. "dev". For combined recordings a conversation is included if either
+      speaker is in the split.
+    - splits_folder (str): Folder containing split information.
+
+    Returns:
+    - list: (recording id, audio file, transcript file) of each recording.
+    """
+
+    fileId2split = open_splits_files(splits_folder) if split else {}
+
+    def in_split(file_ids):
+        return split is None or any(fileId2split.get(f) == split for f in file_ids)
+
+    recordings = []
+    if source == "full_conversations":
+        for audio_file in sorted(glob("full_conversations/*/*.wav")):
+            file_id = os.path.basename(audio_file)[: -len(".wav")]
+            if in_split([file_id]):
+                recordings.append(
+                    (file_id, audio_file, audio_file[: -len(".wav")] + ".json")
+                )
+    elif source == "combined":
+        for audio_file in sorted(glob("combined/*/combined_*.wav")):
+            conversation = os.path.basename(os.path.dirname(audio_file))
+            file_ids = [
+                os.path.basename(f)[: -len(".wav")]
+                for f in glob(f"full_conversations/{conversation}/*.wav")
+            ]
+            if in_split(file_ids):
+                recording_id = os.path.basename(audio_file)[: -len(".wav")]
+                recordings.append(
+                    (recording_id, audio_file, audio_file[: -len(".wav")] + ".json")
+                )
+    else:
+        raise ValueError(f"Unknown source {source}")
+    return recordings
+
+
+def word_chunks(
+    transcript_file: str, max_duration: int = 20, word_store: str = None
+) -> list:
+    """
+    Chunk a recording with its word timestamps, as `run_segmentation` does,
+    but without dropping short chunks.
+
+    Returns:
+    - list: (start, end, reference) of each chunk, times in seconds.
+    """
+
+    words = load_transcript_columns(transcript_file, word_store)
+    segments = plan_segments(
+        words.word, words.norm_word, words.start, words.end, 0, max_duration
+    )
+    return [(seg["start"], seg["end"], seg["text_norm"]) for seg in segments]
+
+
+def vad_chunks(
+    audio,
+    sampling_rate: int = 16000,
+    max_duration: int = 20,
+    transcript_file: str = None,
+    word_store: str = None,
+) -> list:
+    """
+    Chunk a recording with the Silero VAD of Faster-Whisper. Consecutive
+    stretches of speech are combined as long as the chunk stays within
+    `max_duration`.
+
+    Parameters:
+    - audio (np.ndarray): The recording.
+    - sampling_rate (int): Sample rate of the audio. Default is 16000.
+    - max_duration (int): Maximum chunk duration in seconds. Default is 20.
+    - transcript_file (str, optional): Transcript to take the reference of
+      each chunk from, the words whose middle falls within it.
+    - word_store (str, optional): Word store to read the transcript from.
+
+    Returns:
+    - list: (start, end, reference) of each chunk, times in seconds.
+    """
+
+    from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+    speech = get_speech_timestamps(
+        audio, VadOptions(max_speech_duration_s=max_duration)
+    )
+    chunks = []
+    for region in speech:
+        start, end = region["start"] / sampling_rate, region["end"] / sampling_rate
+        if chunks and end - chunks[-1][0] <= max_duration:
+            chunks[-1][1] = end
+        else:
+            chunks.append([start, end])
+
+    words = None
+    if transcript_file and os.path.exists(transcript_file):
+        words = load_transcript_columns(transcript_file, word_store)
+    result = []
+    for start, end in chunks:
+        reference = ""
+        if words is not None:
+            reference = " ".join(
+                n
+                for n, s, e in zip(words.norm_word, words.start, words.end)
+                if start <= (s + e) / 2 < end and n.strip()
+            )
+        result.append((round(start, 2), round(end, 2), reference))
+    return result
+
+
+def transcribe_longform(
+    hyp_output: str,
+    whisper_model: str,
+    source: str = "full_conversations",
+    chunking: str = "words",
+    split: str = None,
+    splits_folder: str = "splits",
+    device: str = "cpu",
+    compute_type: str = "int8",
+    batch_size: int = 16,
+    max_duration: int = 20,
+    language: str = None,
+    word_store: str = None,
+) -> None:
+    """
+    Transcribe whole recordings in memory, chunk by chunk.
+
+    Every chunk gets an id in the same form as the segments of
+    `run_segmentation`, `<recording>_<index>_<duration>`, and one line in
+    `hyp_output`. Its absolute start and end time are written to
+    `<hyp_output>.info` in the format of the `.info` files of the splits.
+
+    Parameters:
+    - hyp_output (str): Path to the output file where transcriptions will be written.
+    - whisper_model (str): Path to the pretrained Faster-Whisper model.
+    - source (str, optional): "full_conversations" or "combined". Defaults to
+      "full_conversations".
+    - chunking (str, optional): "words" to chunk with the word timestamps of the
+      transcripts or "vad" to chunk with voice activity detection. Defaults to "words".
+    - split (str, optional): Only transcribe recordings of this split.
+    - splits_folder (str, optional): Folder containing split information.
+    - device (str, optional): Device to which the model is sent. Defaults to 'cpu'.
+    - compute_type (str, optional): Type of computation to be performed. Defaults to 'int8'.
+    - batch_size (int, optional): Number of chunks to transcribe at a time. Defaults to 16.
+    - max_duration (int, optional): Maximum chunk duration in seconds, at most 30.
+      Defaults to 20.
+    - language (str, optional): Language of the recordings, detected if None.
+    - word_store (str, optional): Word store to read the transcripts from.
+    """
+
+    if chunking not in ["words", "vad"]:
+        raise ValueError(f"Unknown chunking {chunking}")
+    if max_duration > 30:
+        raise ValueError("Chunks can be at most 30 seconds long")
+
+    model = WhisperModel(whisper_model, device=device, compute_type=compute_type)
+    sampling_rate = model.feature_extractor.sampling_rate
+    recordings = find_recordings(source, split, splits_folder)
+
+    with HypothesisWriter(hyp_output) as writer, open(
+        hyp_output + ".info", "w"
+    ) as info:
+        info.write(" ".join(["file_id", "segment_id", "start", "end", "duration"]))
+        info.write("\n")
+        for recording_id, audio_file, transcript_file in tqdm(recordings):
+            audio = load_audio(audio_file, sampling_rate)
+            if chunking == "words":
+                chunks = word_chunks(transcript_file, max_duration, word_store)
+            else:
+                chunks = vad_chunks(
+                    audio, sampling_rate, max_duration, transcript_file, word_store
+                )
+
+            for i in range(0, len(chunks), batch_size):
+                batch = chunks[i : i + batch_size]
+                samples = [
+                    audio[
+                        seconds_to_frames(start, sampling_rate) : seconds_to_frames(
+                            end, sampling_rate
+                        )
+                    ]
+                    for start, end, _ in batch
+                ]
+                hyps = transcribe_segments(model, samples, language=language)
+                for idx, (start, end, reference), hyp in zip(
+                    range(i, i + len(batch)), batch, hyps
+                ):
+                    duration = round(end - start, 2)
+                    wav_id = f"{recording_id}_{idx}_{duration}"
+                    hyp = re.sub(r"\s+", " ", hyp).strip()
+                    writer.write(wav_id, reference, hyp)
+                    info.write(
+                        "\t".join(
+                            [recording_id, wav_id, str(start), str(end), str(duration)]
+                        )
+                        + "\n"
+                    )
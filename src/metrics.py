@@ -0,0 +1,98 @@
+########################################################################
+
+# Author   : David Erik Mollberg & Carlos Daniel Hernández Mena
+# Date     : November 1st, 2023
+# Location : Reykjavík University and Tiro ehf.
+
+# Lightweight instrumentation for the data preparation pipeline: wall
+# time per stage, counters and a JSON summary, in place of printing
+# progress for every file and segment.
+
+########################################################################
+
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+VERBOSITY_LEVELS = {0: logging.WARNING, 1: logging.INFO, 2: logging.DEBUG}
+
+
+def set_verbosity(logger: logging.Logger, verbose: int = 0) -> None:
+    """
+    Set how much a logger of the pipeline prints.
+
+    Only the level is set when logging is already configured, by the caller
+    or an earlier call. Otherwise a plain handler is added so the messages
+    are printed at all.
+
+    Parameters:
+    - logger (logging.Logger): The logger of a module.
+    - verbose (int): 0 for warnings only, 1 for a line per recording and
+      2 for a line per segment. Default is 0.
+    """
+    logger.setLevel(VERBOSITY_LEVELS[max(0, min(verbose, 2))])
+    if not logger.hasHandlers():
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+
+
+class StageTimer:
+    """Accumulates wall time and counters for named stages."""
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (
+                time.perf_counter() - start
+            )
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def summary(self) -> dict:
+        return {
+            "stages": {k: round(v, 6) for k, v in self.stages.items()},
+            **self.counts,
+        }
+
+
+def summarize(per_item: list, wall_time: float) -> dict:
+    """
+    Combine the summaries of individual items, e.g. recordings, into totals.
+
+    Parameters:
+    - per_item (list): Summaries from `StageTimer.summary`, one per item.
+    - wall_time (float): Wall time of the whole run in seconds.
+
+    Returns:
+    - dict: Total time per stage, summed counters, wall time and the items.
+    """
+    stages = {}
+    counts = {}
+    for item in per_item:
+        for stage, seconds in item.get("stages", {}).items():
+            stages[stage] = stages.get(stage, 0.0) + seconds
+        for key, value in item.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                counts[key] = counts.get(key, 0) + value
+    return {
+        "wall_time": round(wall_time, 6),
+        "stages": {k: round(v, 6) for k, v in stages.items()},
+        **counts,
+        "items": per_item,
+    }
+
+
+def write_summary(summary: dict, path: str) -> None:
+    """Write a summary from `summarize` as JSON."""
+    with open(path, "w") as f:
+        json.dump(summary, f, indent=4, ensure_ascii=False)
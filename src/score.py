@@ -8,10 +8,44 @@
 
 # This is script calculates the Word Error Rate (WER) of the Test
 # and Dev portions of the corpus "spjallromur_asr".
+#
+# A hypothesis file is read once and every utterance aligned at the word
+# and character level, with the same normalization as the defaults of
+# jiwer. The substitution, deletion and insertion counts and the word
+# alignment of each utterance are written to a sidecar file, and the WER
+# and CER of the file are summed from those counts.
+#
+# Slices of the utterances, by speaker age and gender, segment duration
+# or conversation, are scored from the cached counts, with bootstrap
+# confidence intervals computed for all resamples at once.
+#
+# In follow mode a hypothesis file is scored while it is being written,
+# each new line once, and the running WER and CER are published to a
+# status file.
+#
+# Several hypothesis files of the same split can be compared in one run,
+# scored in parallel against references tokenized once, with paired
+# bootstrap tests between every two systems.
+#
+# Usage: python -m src.score results/asr/<model>/test --compare-jiwer
+#        python -m src.score results/asr/<model>/test --slices age gender --bootstrap 1000
+#        python -m src.score results/asr/<model>/test --follow --total segmented/test.trans
+#        python -m src.score results/asr/*/test --compare --references segmented/test.trans
 ########################################################################
 
+import argparse
+import json
+import os
+import re
+import time
+from multiprocessing import Pool
 
 import jiwer
+import numpy as np
+from rapidfuzz.distance import Levenshtein
+
+# Columns of the per-utterance counts.
+COUNTS = ["sub", "del", "ins", "ref"]
 
 
 def jiwer_wer(reference, hypothesis):
@@ -28,14 +62,696 @@ def jiwer_cer(reference, hypothesis):
     return str(CER)
 
 
-def calculate_wer(asr_results: str, results_file: str, split: str) -> None:
-    hyp = [x.split("\t")[2].rstrip() for x in open(asr_results)]
-    ref = [x.split("\t")[1].rstrip() for x in open(asr_results)]
+def words(text: str) -> list:
+    """Words of a sentence, as the default WER transform of jiwer splits them."""
+    return [w for w in re.sub(r"\s\s+", " ", text).strip().split(" ") if w]
+
+
+def chars(text: str) -> list:
+    """Characters of a sentence, as the default CER transform of jiwer splits them."""
+    return list(text.strip())
+
+
+def edit_opcodes(ref: list, hyp: list) -> list:
+    """
+    Align two sequences with the Levenshtein distance of rapidfuzz, as jiwer
+    does, so the counts of each kind of edit are the same as in jiwer.
+
+    Returns:
+    - list: (tag, ref_start, ref_end, hyp_start, hyp_end) of each run of
+      "equal", "replace", "delete" or "insert" operations.
+    """
+    return [tuple(op) for op in Levenshtein.opcodes(ref, hyp)]
+
+
+def error_counts(opcodes: list, ref_length: int) -> list:
+    """Substitutions, deletions, insertions and reference length of an alignment."""
+    counts = [0, 0, 0, ref_length]
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "replace":
+            counts[0] += i2 - i1
+        elif tag == "delete":
+            counts[1] += i2 - i1
+        elif tag == "insert":
+            counts[2] += j2 - j1
+    return counts
+
+
+def error_rate(counts: np.ndarray) -> float:
+    """
+    Error rate in percent from rows of `COUNTS`, summed over all rows. With
+    no reference words at all it is the number of insertions, as in jiwer.
+    """
+    sub, dele, ins, ref = np.asarray(counts).reshape(-1, 4).sum(axis=0)
+    errors = sub + dele + ins
+    return round(float(100.0 * (errors / ref if ref else errors)), 3)
+
+
+class Scores:
+    """
+    Word and character error counts of every utterance of a hypothesis file.
+
+    `word_counts` and `char_counts` are integer arrays with one row per
+    utterance and the columns of `COUNTS`.
+    """
+
+    def __init__(self, ids: list, word_counts, char_counts):
+        self.ids = list(ids)
+        self.word_counts = np.asarray(word_counts, dtype=np.int64).reshape(-1, 4)
+        self.char_counts = np.asarray(char_counts, dtype=np.int64).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def wer(self) -> float:
+        return error_rate(self.word_counts)
+
+    def cer(self) -> float:
+        return error_rate(self.char_counts)
+
+    @classmethod
+    def load(cls, alignments_file: str) -> "Scores":
+        """Read the counts back from a sidecar file written by `score_file`."""
+        ids, word_counts, char_counts = [], [], []
+        with open(alignments_file, encoding="utf-8") as f:
+            for line in f:
+                utterance = json.loads(line)
+                ids.append(utterance["id"])
+                word_counts.append([utterance["words"][c] for c in COUNTS])
+                char_counts.append([utterance["chars"][c] for c in COUNTS])
+        return cls(ids, word_counts, char_counts)
+
+
+def read_hypotheses(asr_results: str) -> tuple:
+    """
+    Read a `wav_id\\tref\\thyp` file in one pass.
+
+    Returns:
+    - tuple: Lists of the ids, references and hypotheses.
+    """
+    ids, refs, hyps = [], [], []
+    with open(asr_results, encoding="utf-8") as f:
+        for line in f:
+            fields = line.split("\t")
+            ids.append(fields[0])
+            refs.append(fields[1].rstrip())
+            hyps.append(fields[2].rstrip())
+    return ids, refs, hyps
+
+
+def score_utterance(ref: str, hyp: str) -> dict:
+    """
+    Word and character error counts, and the word alignment, of one utterance.
+    """
+    ref_words, hyp_words = words(ref), words(hyp)
+    alignment = edit_opcodes(ref_words, hyp_words)
+    ref_chars = chars(ref)
+    char_alignment = edit_opcodes(ref_chars, chars(hyp))
+    return {
+        "words": dict(zip(COUNTS, error_counts(alignment, len(ref_words)))),
+        "chars": dict(zip(COUNTS, error_counts(char_alignment, len(ref_chars)))),
+        "alignment": [list(op) for op in alignment],
+    }
+
+
+def alignments_path(asr_results: str) -> str:
+    return asr_results + ".alignments"
+
+
+_scores = {}
+
+
+def score_file(asr_results: str, alignments_file: str = None) -> Scores:
+    """
+    Score a hypothesis file at the word and character level in one pass.
+
+    Every utterance is written as a JSON line to `alignments_file` with its
+    id, its word and character counts of `COUNTS` and its word alignment.
+    The scores of a file are remembered while it is unchanged, so scoring
+    the same file for WER and then CER reads it once.
+
+    Parameters:
+    - asr_results (str): Path to a hypothesis file, `wav_id\\tref\\thyp` per line.
+    - alignments_file (str, optional): Sidecar file. Defaults to
+      `<asr_results>.alignments`.
+
+    Returns:
+    - Scores: The counts of every utterance.
+    """
+
+    alignments_file = alignments_file or alignments_path(asr_results)
+    stat = os.stat(asr_results)
+    key = (os.path.abspath(asr_results), stat.st_size, stat.st_mtime_ns)
+    if key in _scores:
+        return _scores[key]
+
+    ids, word_counts, char_counts = [], [], []
+    with open(asr_results, encoding="utf-8") as f, open(
+        alignments_file + ".tmp", "w", encoding="utf-8"
+    ) as f_out:
+        for line in f:
+            fields = line.split("\t")
+            utterance = score_utterance(fields[1].rstrip(), fields[2].rstrip())
+            ids.append(fields[0])
+            word_counts.append([utterance["words"][c] for c in COUNTS])
+            char_counts.append([utterance["chars"][c] for c in COUNTS])
+            f_out.write(
+                json.dumps({"id": fields[0], **utterance}, ensure_ascii=False) + "\n"
+            )
+    os.replace(alignments_file + ".tmp", alignments_file)
+
+    scores = Scores(ids, word_counts, char_counts)
+    _scores.clear()
+    _scores[key] = scores
+    return scores
+
+
+def load_scores(asr_results: str) -> Scores:
+    """
+    The counts of a hypothesis file, from its sidecar file if that is newer
+    than the file, otherwise from `score_file`.
+    """
+    alignments_file = alignments_path(asr_results)
+    if (
+        os.path.exists(alignments_file)
+        and os.stat(alignments_file).st_mtime_ns >= os.stat(asr_results).st_mtime_ns
+    ):
+        return Scores.load(alignments_file)
+    return score_file(asr_results)
+
+
+# Segment ids are `<side>_<conversation>_<age>_<gender>_<index>_<duration>`,
+# e.g. a_2f1655ff_40-49_f_0_14.09.
+SEGMENT_ID = re.compile(
+    r"^(?P<side>[ab])_(?P<conversation>[0-9a-f]+)_(?P<age>[^_]+)_(?P<gender>[^_]+)"
+    r"(?:_(?P<index>\d+)_(?P<duration>\d+(?:\.\d+)?))?$"
+)
+SLICES = ["age", "gender", "duration", "conversation", "speaker"]
+DURATION_BUCKETS = [0, 5, 10, 15, 20, 30]
+
+
+def utterance_attributes(ids: list, duration_buckets: list = DURATION_BUCKETS) -> dict:
+    """
+    Speaker and segment attributes parsed from segment ids.
+
+    Parameters:
+    - ids (list): Segment ids.
+    - duration_buckets (list): Edges of the duration buckets in seconds.
+
+    Returns:
+    - dict: An array of labels per attribute of `SLICES`, "unknown" where
+      the id doesn't say.
+    """
+
+    edges = np.asarray(duration_buckets, dtype=np.float64)
+    labels = [f"{a:g}-{b:g}" for a, b in zip(edges[:-1], edges[1:])]
+    attributes = {name: [] for name in SLICES}
+    for wav_id in ids:
+        match = SEGMENT_ID.match(wav_id)
+        fields = match.groupdict() if match else {}
+        attributes["age"].append(fields.get("age") or "unknown")
+        attributes["gender"].append(fields.get("gender") or "unknown")
+        attributes["conversation"].append(fields.get("conversation") or "unknown")
+        attributes["speaker"].append(
+            f"{fields['side']}_{fields['conversation']}" if match else "unknown"
+        )
+        duration = "unknown"
+        if fields.get("duration"):
+            bucket = np.searchsorted(edges, float(fields["duration"]), side="right")
+            if bucket == len(edges):
+                duration = f">{edges[-1]:g}"
+            elif bucket > 0:
+                duration = labels[bucket - 1]
+        attributes["duration"].append(duration)
+    return {name: np.asarray(values) for name, values in attributes.items()}
+
+
+def bootstrap_error_rates(
+    word_counts: np.ndarray,
+    char_counts: np.ndarray,
+    resamples: int = 1000,
+    rng: np.random.Generator = None,
+    block_size: int = 1 << 22,
+) -> np.ndarray:
+    """
+    WER and CER of bootstrap resamples of utterances.
+
+    Each resample is turned into counts of how often every utterance is
+    picked, with one `np.bincount` for a block of resamples, so the error
+    and reference totals of all resamples are one matrix product. The same
+    resamples are used for words and characters.
+
+    Parameters:
+    - word_counts (np.ndarray): Word counts of the utterances, see `COUNTS`.
+    - char_counts (np.ndarray): Character counts of the utterances.
+    - resamples (int): Number of resamples. Defaults to 1000.
+    - rng (np.random.Generator, optional): Random generator.
+    - block_size (int): Maximum number of weights drawn at a time, to bound memory.
+
+    Returns:
+    - np.ndarray: WER and CER in percent of each resample, shape (resamples, 2).
+    """
+
+    rng = rng or np.random.default_rng(0)
+    n = len(word_counts)
+    totals = np.stack(
+        [
+            word_counts[:, :3].sum(axis=1),
+            word_counts[:, 3],
+            char_counts[:, :3].sum(axis=1),
+            char_counts[:, 3],
+        ],
+        axis=1,
+    ).astype(np.float64)
+    rates = np.empty((resamples, 2))
+    step = max(1, block_size // max(n, 1))
+    for start in range(0, resamples, step):
+        size = min(step, resamples - start)
+        picks = rng.integers(0, n, size=(size, n)) + n * np.arange(size)[:, None]
+        weights = np.bincount(picks.ravel(), minlength=size * n).reshape(size, n)
+        sums = weights @ totals
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rates[start : start + size] = 100 * np.where(
+                sums[:, [1, 3]] > 0, sums[:, [0, 2]] / sums[:, [1, 3]], sums[:, [0, 2]]
+            )
+    return rates
+
+
+def sliced_scores(
+    scores: Scores,
+    slices: list = SLICES,
+    resamples: int = 1000,
+    confidence: float = 0.95,
+    duration_buckets: list = DURATION_BUCKETS,
+    seed: int = 0,
+) -> list:
+    """
+    WER and CER of slices of the utterances with bootstrap confidence intervals.
+
+    Parameters:
+    - scores (Scores): Counts of every utterance, e.g. from `load_scores`.
+    - slices (list): Attributes to slice by, of `SLICES`.
+    - resamples (int): Bootstrap resamples per group, 0 for no intervals.
+      Defaults to 1000.
+    - confidence (float): Coverage of the intervals. Defaults to 0.95.
+    - duration_buckets (list): Edges of the duration buckets in seconds.
+    - seed (int): Seed of the resamples. Defaults to 0.
+
+    Returns:
+    - list: One dict per group of each slice, with the number of utterances,
+      reference words, WER and CER and their intervals. The first is all
+      utterances.
+    """
+
+    attributes = utterance_attributes(scores.ids, duration_buckets)
+    rng = np.random.default_rng(seed)
+    tail = 100 * (1 - confidence) / 2
+    groups = [("all", "all", np.ones(len(scores), bool))]
+    for name in slices:
+        if name not in attributes:
+            raise ValueError(f"Unknown slice {name}, expected one of {SLICES}")
+        values = np.unique(attributes[name])
+        if name == "duration":
+            # Buckets in order of duration rather than alphabetically.
+            values = sorted(
+                values,
+                key=lambda v: [float(x) for x in re.findall(r"[\d.]+", v)] or [np.inf],
+            )
+        for value in values:
+            groups.append((name, str(value), attributes[name] == value))
+
+    results = []
+    for name, value, mask in groups:
+        word_counts, char_counts = scores.word_counts[mask], scores.char_counts[mask]
+        result = {
+            "slice": name,
+            "group": value,
+            "utterances": int(mask.sum()),
+            "words": int(word_counts[:, 3].sum()),
+            "wer": error_rate(word_counts),
+            "cer": error_rate(char_counts),
+        }
+        if resamples and mask.any():
+            rates = bootstrap_error_rates(word_counts, char_counts, resamples, rng)
+            low, high = np.percentile(rates, [tail, 100 - tail], axis=0)
+            result["wer_ci"] = [round(float(low[0]), 3), round(float(high[0]), 3)]
+            result["cer_ci"] = [round(float(low[1]), 3), round(float(high[1]), 3)]
+        results.append(result)
+    return results
+
 
-    assert len(ref) == len(hyp), f"Transcripts and hypothesis are not equally long"
-    wer = jiwer_wer(ref, hyp)
+class FollowScorer:
+    """
+    Running WER and CER of a hypothesis file that is still being written.
 
-    res = f"wer ({split}): {wer}% [ {len(hyp)} hyp / {len(ref)} {asr_results}]"
+    Every `poll` reads the complete lines added since the last one, from
+    where it stopped, and adds their counts to the totals. If the file is
+    replaced, as `reorder_hypotheses` does when a transcription finishes,
+    it is read again from the start but lines of utterances that were
+    already scored are skipped without being aligned again. If it is
+    truncated or written again from the start in place, as `HypothesisWriter`
+    does without `resume`, the totals are reset and it is scored again.
+    """
+
+    # Bytes before the read position that are compared with the file on
+    # every poll, to notice it being rewritten past where it was read to.
+    TAIL = 4096
+
+    def __init__(self, asr_results: str):
+        self.path = asr_results
+        self.started = time.time()
+        self._file = None
+        self._inode = None
+        self._reset()
+
+    def _reset(self):
+        self.word_counts = np.zeros(4, dtype=np.int64)
+        self.char_counts = np.zeros(4, dtype=np.int64)
+        self.scored = set()
+        self._partial = b""
+        self._tail = b""
+
+    def _rewritten(self, size: int) -> bool:
+        offset = self._file.tell()
+        if size < offset:
+            return True
+        start = offset - len(self._tail)
+        return os.pread(self._file.fileno(), len(self._tail), start) != self._tail
+
+    def _reopen(self) -> bool:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if self._file is None or stat.st_ino != self._inode:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.path, "rb")
+            self._inode = stat.st_ino
+            self._partial = b""
+            self._tail = b""
+        elif self._rewritten(stat.st_size):
+            # Truncated, e.g. by a new run into the same file or a resumed run
+            # dropping a cut off line, and maybe written again since. What was
+            # scored may not be in the file anymore, so start over.
+            self._file.seek(0)
+            self._reset()
+        return True
+
+    def poll(self) -> int:
+        """Score the lines added since the last call. Returns how many were new."""
+        if not self._reopen():
+            return 0
+        read = self._file.read()
+        self._tail = (self._tail + read)[-self.TAIL :]
+        data = self._partial + read
+        complete = data.rfind(b"\n") + 1
+        self._partial = data[complete:]
+        new = 0
+        for line in data[:complete].decode("utf-8").splitlines():
+            fields = line.split("\t")
+            if len(fields) < 3 or fields[0] in self.scored:
+                continue
+            utterance = score_utterance(fields[1].rstrip(), fields[2].rstrip())
+            self.word_counts += [utterance["words"][c] for c in COUNTS]
+            self.char_counts += [utterance["chars"][c] for c in COUNTS]
+            self.scored.add(fields[0])
+            new += 1
+        return new
+
+    def status(self) -> dict:
+        return {
+            "file": self.path,
+            "utterances": len(self.scored),
+            "wer": error_rate(self.word_counts),
+            "cer": error_rate(self.char_counts),
+            "words": dict(zip(COUNTS, self.word_counts.tolist())),
+            "chars": dict(zip(COUNTS, self.char_counts.tolist())),
+            "elapsed": round(time.time() - self.started, 1),
+            "updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def write_status(status: dict, status_file: str) -> None:
+    """Replace a status file atomically, so readers never see half of it."""
+    with open(status_file + ".tmp", "w") as f:
+        json.dump(status, f, indent=4)
+    os.replace(status_file + ".tmp", status_file)
+
+
+def follow(
+    asr_results: str,
+    status_file: str = None,
+    interval: float = 30.0,
+    poll_interval: float = 1.0,
+    total: int = None,
+    idle_timeout: float = None,
+) -> dict:
+    """
+    Score a hypothesis file while it is being written, e.g. by `transcribe_file`.
+
+    The current WER and CER and the counts behind them are written to
+    `status_file` and printed every `interval` seconds and when following ends.
+
+    Parameters:
+    - asr_results (str): Path to the hypothesis file. It may not exist yet.
+    - status_file (str, optional): JSON file for the status. Defaults to
+      `<asr_results>.status`.
+    - interval (float, optional): Seconds between status updates. Defaults to 30.
+    - poll_interval (float, optional): Seconds between reads of the file. Defaults to 1.
+    - total (int, optional): Stop once this many utterances have been scored,
+      e.g. the number of lines of the `.trans` file.
+    - idle_timeout (float, optional): Stop when the file hasn't grown for this
+      many seconds. Follows until interrupted if neither is given.
+
+    Returns:
+    - dict: The last status.
+    """
+
+    status_file = status_file or asr_results + ".status"
+    scorer = FollowScorer(asr_results)
+    last_update = last_growth = time.monotonic()
+    published = -1
+    try:
+        while True:
+            if scorer.poll():
+                last_growth = time.monotonic()
+            now = time.monotonic()
+            done = (total is not None and len(scorer.scored) >= total) or (
+                idle_timeout is not None and now - last_growth >= idle_timeout
+            )
+            if done or now - last_update >= interval:
+                status = scorer.status()
+                write_status(status, status_file)
+                if status["utterances"] != published:
+                    print(
+                        f"{asr_results}: wer {status['wer']}% cer {status['cer']}%"
+                        f" [ {status['utterances']} utterances ]"
+                    )
+                    published = status["utterances"]
+                last_update = now
+            if done:
+                return status
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        status = scorer.status()
+        write_status(status, status_file)
+        return status
+    finally:
+        scorer.close()
+
+
+_references = None
+
+
+def _init_references(references: dict):
+    global _references
+    _references = references
+
+
+def read_references(reference_file: str) -> dict:
+    """
+    Tokenize the references of a split once.
+
+    Parameters:
+    - reference_file (str): A `.trans` file, `path\ttranscript` per line, or a
+      hypothesis file, `wav_id\tref\thyp` per line.
+
+    Returns:
+    - dict: The words and characters of each utterance, by wav_id, in order.
+    """
+    references = {}
+    with open(reference_file, encoding="utf-8") as f:
+        for line in f:
+            fields = line.split("\t")
+            wav_id = fields[0]
+            if wav_id.endswith(".wav"):
+                wav_id = os.path.basename(wav_id).rstrip(".wav")
+            ref = fields[1].rstrip()
+            references[wav_id] = (words(ref), chars(ref))
+    return references
+
+
+def _score_run(asr_results: str) -> tuple:
+    hyps = {}
+    with open(asr_results, encoding="utf-8") as f:
+        for line in f:
+            fields = line.split("\t")
+            hyps.setdefault(fields[0], fields[2].rstrip())
+    word_counts = np.zeros((len(_references), 4), dtype=np.int64)
+    char_counts = np.zeros((len(_references), 4), dtype=np.int64)
+    missing = 0
+    for i, (wav_id, (ref_words, ref_chars)) in enumerate(_references.items()):
+        if wav_id not in hyps:
+            missing += 1
+        hyp = hyps.get(wav_id, "")
+        word_counts[i] = error_counts(
+            edit_opcodes(ref_words, words(hyp)), len(ref_words)
+        )
+        char_counts[i] = error_counts(
+            edit_opcodes(ref_chars, chars(hyp)), len(ref_chars)
+        )
+    extra = len(set(hyps) - set(_references))
+    return word_counts, char_counts, missing, extra
+
+
+def paired_bootstrap(
+    word_counts: list, resamples: int = 1000, seed: int = 0, block_size: int = 1 << 22
+) -> np.ndarray:
+    """
+    Two-sided p-values of the WER difference of every pair of systems.
+
+    The same resamples of utterances are used for all systems, drawn in
+    blocks as in `bootstrap_error_rates`. The p-value of a pair is twice the
+    fraction of resamples where the difference doesn't have the sign it has
+    on the whole set, at most 1.
+
+    Parameters:
+    - word_counts (list): Word counts of each system, see `COUNTS`, for the
+      same utterances in the same order.
+    - resamples (int): Number of resamples. Defaults to 1000.
+    - seed (int): Seed of the resamples. Defaults to 0.
+
+    Returns:
+    - np.ndarray: Matrix of p-values between systems.
+    """
+
+    rng = np.random.default_rng(seed)
+    n = len(word_counts[0])
+    # Errors of each system and the reference length, which they share.
+    totals = np.stack(
+        [counts[:, :3].sum(axis=1) for counts in word_counts] + [word_counts[0][:, 3]],
+        axis=1,
+    ).astype(np.float64)
+    observed = totals[:, :-1].sum(axis=0)
+    below = np.zeros((len(word_counts), len(word_counts)))
+    above = np.zeros((len(word_counts), len(word_counts)))
+    step = max(1, block_size // max(n, len(word_counts) ** 2, 1))
+    for start in range(0, resamples, step):
+        size = min(step, resamples - start)
+        picks = rng.integers(0, n, size=(size, n)) + n * np.arange(size)[:, None]
+        weights = np.bincount(picks.ravel(), minlength=size * n).reshape(size, n)
+        # Same reference length for all systems, so errors can be compared.
+        errors = (weights @ totals)[:, :-1]
+        diff = errors[:, :, None] - errors[:, None, :]
+        below += (diff <= 0).sum(axis=0)
+        above += (diff >= 0).sum(axis=0)
+    sign = np.sign(observed[:, None] - observed[None, :])
+    # Resamples that agree with the difference on the whole set don't count.
+    disagree = np.where(sign > 0, below, np.where(sign < 0, above, resamples))
+    p_values = np.minimum(1.0, 2 * disagree / resamples)
+    np.fill_diagonal(p_values, 1.0)
+    return p_values
+
+
+def compare_runs(
+    hyp_files: list,
+    names: list = None,
+    reference_file: str = None,
+    processes: int = None,
+    resamples: int = 1000,
+    output: str = None,
+) -> dict:
+    """
+    Score several hypothesis files of the same split against one set of
+    references and test the differences between them.
+
+    The references are tokenized once and shared with the worker processes,
+    which score one file each.
+
+    Parameters:
+    - hyp_files (list): Hypothesis files, `wav_id\tref\thyp` per line.
+    - names (list, optional): Name of each system. Defaults to the last two
+      parts of each path, e.g. `<model>/test`.
+    - reference_file (str, optional): `.trans` file of the split. Defaults to
+      the references in the first hypothesis file.
+    - processes (int, optional): Worker processes. Defaults to one per file, at
+      most the number of cores.
+    - resamples (int, optional): Resamples of the paired bootstrap. Defaults to 1000.
+    - output (str, optional): JSON file to write the comparison to.
+
+    Returns:
+    - dict: WER, CER and counts of each system and the p-values between them.
+    """
+
+    names = names or [
+        os.path.join(*os.path.normpath(f).split(os.sep)[-2:]) for f in hyp_files
+    ]
+    if len(names) != len(hyp_files):
+        raise ValueError("Expected one name per hypothesis file")
+    references = read_references(reference_file or hyp_files[0])
+    processes = processes or min(len(hyp_files), os.cpu_count())
+    with Pool(processes, initializer=_init_references, initargs=(references,)) as pool:
+        runs = pool.map(_score_run, hyp_files)
+
+    systems = []
+    for name, hyp_file, (word_counts, char_counts, missing, extra) in zip(
+        names, hyp_files, runs
+    ):
+        systems.append(
+            {
+                "name": name,
+                "hyp_file": hyp_file,
+                "wer": error_rate(word_counts),
+                "cer": error_rate(char_counts),
+                "words": dict(zip(COUNTS, word_counts.sum(axis=0).tolist())),
+                "missing": missing,
+                "extra": extra,
+            }
+        )
+    p_values = paired_bootstrap([run[0] for run in runs], resamples)
+    comparison = {
+        "utterances": len(references),
+        "systems": systems,
+        "p_values": {
+            a: {b: round(float(p_values[i, j]), 4) for j, b in enumerate(names)}
+            for i, a in enumerate(names)
+        },
+    }
+
+    order = sorted(range(len(systems)), key=lambda i: systems[i]["wer"])
+    print("rank\tname\twer\tcer\tmissing\tp (vs. best)")
+    for rank, i in enumerate(order, 1):
+        s = systems[i]
+        p = "" if i == order[0] else round(float(p_values[order[0], i]), 4)
+        print(f"{rank}\t{s['name']}\t{s['wer']}\t{s['cer']}\t{s['missing']}\t{p}")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(comparison, f, indent=4, ensure_ascii=False)
+    return comparison
+
+
+def calculate_wer(asr_results: str, results_file: str, split: str) -> None:
+    scores = score_file(asr_results)
+    wer = scores.wer()
+
+    res = f"wer ({split}): {wer}% [ {len(scores)} hyp / {len(scores)} {asr_results}]"
     with open(results_file, "a") as f_out:
         f_out.write(res + "\n")
 
@@ -43,14 +759,156 @@ def calculate_wer(asr_results: str, results_file: str, split: str) -> None:
 
 
 def calculate_cer(asr_results: str, results_file: str, split: str) -> None:
-    hyp = [x.split("\t")[2].rstrip() for x in open(asr_results)]
-    ref = [x.split("\t")[1].rstrip() for x in open(asr_results)]
+    scores = score_file(asr_results)
+    cer = scores.cer()
 
-    assert len(ref) == len(hyp), f"Transcripts and hypothesis are not equally long"
-    cer = jiwer_cer(ref, hyp)
-
-    res = f"cer ({split}): {cer}% [ {len(hyp)} hyp / {len(ref)} {asr_results}]"
+    res = f"cer ({split}): {cer}% [ {len(scores)} hyp / {len(scores)} {asr_results}]"
     with open(results_file, "a") as f_out:
         f_out.write(res + "\n")
 
     print(res)
+
+
+def compare_jiwer(asr_results: str) -> dict:
+    """
+    Check that `score_file` gives the same counts as jiwer and time both.
+
+    Returns:
+    - dict: The WER and CER and the seconds taken by each.
+    """
+
+    _, refs, hyps = read_hypotheses(asr_results)
+    start = time.perf_counter()
+    word_output = jiwer.process_words(refs, hyps)
+    char_output = jiwer.process_characters(refs, hyps)
+    jiwer_time = time.perf_counter() - start
+
+    _scores.clear()
+    start = time.perf_counter()
+    scores = score_file(asr_results)
+    engine_time = time.perf_counter() - start
+
+    for name, output, counts in [
+        ("words", word_output, scores.word_counts),
+        ("chars", char_output, scores.char_counts),
+    ]:
+        expected = [output.substitutions, output.deletions, output.insertions]
+        if counts[:, :3].sum(axis=0).tolist() != expected:
+            raise AssertionError(
+                f"{name}: {counts[:, :3].sum(axis=0).tolist()} != jiwer {expected}"
+            )
+    return {
+        "wer": scores.wer(),
+        "cer": scores.cer(),
+        "jiwer_wer": round(100 * word_output.wer, 3),
+        "jiwer_cer": round(100 * char_output.cer, 3),
+        "seconds": round(engine_time, 4),
+        "jiwer_seconds": round(jiwer_time, 4),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score hypothesis files.")
+    parser.add_argument("asr_results", nargs="+", help="wav_id\\tref\\thyp files")
+    parser.add_argument(
+        "--compare-jiwer",
+        action="store_true",
+        help="Check the counts against jiwer and time both",
+    )
+    parser.add_argument(
+        "--slices",
+        nargs="*",
+        choices=SLICES,
+        default=None,
+        help="Score slices of the utterances by these attributes",
+    )
+    parser.add_argument("--bootstrap", type=int, default=1000)
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument(
+        "--duration-buckets", type=float, nargs="+", default=DURATION_BUCKETS
+    )
+    parser.add_argument("--output", default=None, help="JSON file for the slices")
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Score a hypothesis file as it is written and publish a status file",
+    )
+    parser.add_argument("--status-file", default=None)
+    parser.add_argument("--interval", type=float, default=30.0)
+    parser.add_argument(
+        "--total",
+        default=None,
+        help="Stop after this many utterances, or as many as lines in this .trans file",
+    )
+    parser.add_argument("--idle-timeout", type=float, default=None)
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="Compare the hypothesis files with each other",
+    )
+    parser.add_argument("--names", nargs="+", default=None)
+    parser.add_argument("--references", default=None, help="A .trans file")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_runs(
+            args.asr_results,
+            args.names,
+            args.references,
+            args.processes,
+            args.bootstrap,
+            args.output,
+        )
+        args.asr_results = []
+
+    if args.follow:
+        if len(args.asr_results) != 1:
+            parser.error("--follow takes one hypothesis file")
+        total = args.total
+        if total is not None and not total.isdigit():
+            total = sum(1 for _ in open(total))
+        follow(
+            args.asr_results[0],
+            args.status_file,
+            args.interval,
+            total=int(total) if total is not None else None,
+            idle_timeout=args.idle_timeout,
+        )
+        args.asr_results = []
+
+    for asr_results in args.asr_results:
+        if args.compare_jiwer:
+            print(asr_results, json.dumps(compare_jiwer(asr_results)))
+        elif args.slices is not None:
+            results = sliced_scores(
+                load_scores(asr_results),
+                args.slices or SLICES,
+                args.bootstrap,
+                args.confidence,
+                args.duration_buckets,
+            )
+            print(asr_results)
+            print("slice\tgroup\tutterances\twords\twer\twer_ci\tcer\tcer_ci")
+            for r in results:
+                print(
+                    "\t".join(
+                        str(r.get(k, ""))
+                        for k in [
+                            "slice",
+                            "group",
+                            "utterances",
+                            "words",
+                            "wer",
+                            "wer_ci",
+                            "cer",
+                            "cer_ci",
+                        ]
+                    )
+                )
+            if args.output:
+                with open(args.output, "w") as f:
+                    json.dump(results, f, indent=4, ensure_ascii=False)
+        else:
+            scores = score_file(asr_results)
+            print(f"{asr_results}: wer {scores.wer()}% cer {scores.cer()}%")
@@ -8,13 +8,28 @@
 
 ########################################################################
 
+import hashlib
+import io
 import json
+import logging
 import os
 import re
 import subprocess
+import tarfile
+import tempfile
+import time
+from bisect import bisect_right
+from functools import partial
 from glob import glob
+from multiprocessing import Pool
 from typing import Tuple
 
+from src.audio import UnsupportedAudioFormat, WavFile, extract_audio_segments
+from src.metrics import StageTimer, set_verbosity, summarize, write_summary
+from src.wordstore import WordColumns, open_word_store
+
+logger = logging.getLogger(__name__)
+
 
 def compile_files() -> list:
     """
@@ -29,11 +44,11 @@ def compile_files() -> list:
     paths = []
     if os.path.exists("full_conversations"):
         paths += [x for x in glob("full_conversations/*/*.wav")]
-        print("Using full coversations")
+        logger.info("Using full coversations")
 
     if os.path.exists("half_conversations"):
         paths += [x for x in glob("half_conversations/*/*.wav")]
-        print("Using half coversations")
+        logger.info("Using half coversations")
 
     if paths:
         return paths
@@ -51,6 +66,9 @@ def extract_audio_segment(
     """
     Extract a segment from an audio file using the SoX tool.
 
+    `src.audio.extract_audio_segments` is used by `run_segmentation` and only
+    falls back to this function for files that are not PCM WAV.
+
     Parameters:
     - input_file (str): Path to the source audio file.
     - output_file (str): Path to the destination audio file.
@@ -71,11 +89,11 @@ def extract_audio_segment(
             str(duration),
         ]
         subprocess.run(command, check=True)
-        print(f"Success: Audio segment saved to {output_file}")
+        logger.debug(f"Success: Audio segment saved to {output_file}")
     except subprocess.CalledProcessError as e:
-        print(f"Error: {e}")
+        logger.error(f"Error: {e}")
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        logger.error(f"An unexpected error occurred: {e}")
 
 
 def load_transcript(file: str) -> list:
@@ -93,6 +111,34 @@ def load_transcript(file: str) -> list:
     return data
 
 
+def load_transcript_columns(file: str, word_store: str = None) -> WordColumns:
+    """
+    Load the words of a transcript as columns, from the word store when it
+    holds an up to date copy of the transcript and from the JSON file otherwise.
+
+    Parameters:
+    - file (str): Path to the JSON file.
+    - word_store (str): Path to a store written by `src.wordstore.build_word_store`.
+
+    Returns:
+    - WordColumns: Words, normalized words, start and end times and speaker codes.
+    """
+
+    if word_store and os.path.exists(word_store):
+        store = open_word_store(word_store)
+        if store.is_current(file):
+            return store.columns(file)
+
+    data = load_transcript(file)
+    return WordColumns(
+        [w["word"] for w in data],
+        [w["norm_word"] for w in data],
+        [w["start"] for w in data],
+        [w["end"] for w in data],
+        None,
+    )
+
+
 def flatten(seg: list) -> dict:
     """
     Convert a list of word objects into a single text segment with timestamps.
@@ -220,20 +266,690 @@ def merge_segments(seg1: list, seg2: list) -> list:
     }
 
 
+SENTENCE_END = (".", "?", "!")
+
+
+def sentence_ranges(words: list, ends: list) -> list:
+    """
+    Split a transcript into sentences and pad the end of each sentence.
+
+    The last word of every sentence gets its end timestamp padded in place
+    with `add_padding`.
+
+    Parameters:
+    - words (list): The words of the transcript.
+    - ends (list): End timestamp of each word, modified in place.
+
+    Returns:
+    - list: (first, last) word index ranges, `last` being exclusive.
+    """
+
+    ranges = []
+    first = 0
+    for idx, word in enumerate(words):
+        if word[-1] in SENTENCE_END:
+            if idx + 1 < len(words):
+                ends[idx] = add_padding(ends[idx], ends[idx + 1])
+            ranges.append((first, idx + 1))
+            first = idx + 1
+
+    if first < len(words):
+        ranges.append((first, len(words)))
+    return ranges
+
+
+def split_long_ranges(
+    ranges: list, starts: list, ends: list, max_duration: int = 20
+) -> list:
+    """
+    Split ranges that are longer than `max_duration` roughly in half by time,
+    the same way `split_in_half` does, until every range is short enough.
+
+    Word end times are assumed to be non-decreasing within a range, apart from
+    the padded last word, so each half is a contiguous range and the split
+    point can be found with a binary search.
+
+    Parameters:
+    - ranges (list): (first, last) word index ranges.
+    - starts (list): Start timestamp of each word.
+    - ends (list): End timestamp of each word.
+    - max_duration (int): Maximum acceptable segment duration. Default is 20 seconds.
+
+    Returns:
+    - list: The ranges after splitting, in order.
+    """
+
+    split = []
+    for rng in ranges:
+        stack = [rng]
+        while stack:
+            first, last = stack.pop()
+            duration = round(ends[last - 1] - starts[first], 2)
+            if duration <= max_duration:
+                split.append((first, last))
+                continue
+
+            middle_timestamp = starts[first] + duration / 2
+            # The padded last word always ends after the middle of the range.
+            middle = bisect_right(ends, middle_timestamp, first, last - 1)
+            if middle == first:
+                # A single word longer than half the range, which can't be split.
+                split.append((first, last))
+                continue
+            stack.append((middle, last))
+            stack.append((first, middle))
+    return split
+
+
+def merge_ranges(
+    ranges: list, starts: list, ends: list, max_duration: int = 20
+) -> list:
+    """
+    Combine consecutive ranges as long as the result stays within
+    `max_duration`, the same way repeated `merge_segments` calls do.
+
+    Parameters:
+    - ranges (list): (first, last) word index ranges.
+    - starts (list): Start timestamp of each word.
+    - ends (list): End timestamp of each word.
+    - max_duration (int): Maximum acceptable segment duration. Default is 20 seconds.
+
+    Returns:
+    - list: (first, last, merged) for each combined range, where `merged`
+      tells whether more than one range was combined.
+    """
+
+    if not ranges:
+        return []
+
+    merged = []
+    first, last = ranges[0]
+    combined = False
+    for next_first, next_last in ranges[1:]:
+        if round(ends[next_last - 1] - starts[first], 2) <= max_duration:
+            last = next_last
+            combined = True
+        else:
+            merged.append((first, last, combined))
+            first, last, combined = next_first, next_last, False
+    merged.append((first, last, combined))
+    return merged
+
+
+def materialize_segments(
+    ranges: list, words: list, norm_words: list, starts: list, ends: list
+) -> list:
+    """
+    Turn word index ranges into segments with text and timestamps.
+
+    Parameters:
+    - ranges (list): (first, last, merged) ranges from `merge_ranges`.
+    - words (list): The words of the transcript.
+    - norm_words (list): The normalized words of the transcript.
+    - starts (list): Start timestamp of each word.
+    - ends (list): End timestamp of each word.
+
+    Returns:
+    - list: Segments in the same format as `flatten` and `merge_segments` produce.
+    """
+
+    segments = []
+    for first, last, merged in ranges:
+        text = " ".join(words[first:last])
+        text_norm = " ".join(norm_words[first:last])
+        if merged:
+            text = re.sub(r"\s+", " ", text)
+            text_norm = re.sub(r"\s+", " ", text_norm)
+        segments.append(
+            {
+                "text": text,
+                "text_norm": text_norm,
+                "start": starts[first],
+                "end": ends[last - 1],
+                "duration": round(ends[last - 1] - starts[first], 2),
+            }
+        )
+    return segments
+
+
+def filter_segments(segments: list, min_duration: int = 2) -> list:
+    """
+    Remove segments that are shorter than `min_duration` or only contain
+    <unk> or [hik: ...].
+
+    Parameters:
+    - segments (list): Segments from `materialize_segments`.
+    - min_duration (int): Minimum acceptable segment duration. Default is 2 seconds.
+
+    Returns:
+    - list: The segments that are kept.
+    """
+
+    return [
+        seg
+        for seg in segments
+        if seg["duration"] >= min_duration and seg["text_norm"].strip()
+    ]
+
+
+def plan_segments(
+    words: list,
+    norm_words: list,
+    starts: list,
+    ends: list,
+    min_duration: int = 2,
+    max_duration: int = 20,
+) -> list:
+    """
+    Plan the segments of a recording in a single pass over word index ranges.
+
+    The transcript is split on sentence boundaries, long sentences are split
+    in half until they are at most `max_duration` long, consecutive segments
+    are combined up to `max_duration` and segments that are too short or
+    have no normalized text are removed. Text is only joined at the end.
+
+    Parameters:
+    - words (list): The words of the transcript.
+    - norm_words (list): The normalized words of the transcript.
+    - starts (list): Start timestamp of each word.
+    - ends (list): End timestamp of each word. Not modified.
+    - min_duration (int): Minimum acceptable segment duration. Default is 2 seconds.
+    - max_duration (int): Maximum acceptable segment duration. Default is 20 seconds.
+
+    Returns:
+    - list: The planned segments, in order.
+    """
+
+    ends = list(ends)
+    ranges = sentence_ranges(words, ends)
+    ranges = split_long_ranges(ranges, starts, ends, max_duration)
+    ranges = merge_ranges(ranges, starts, ends, max_duration)
+    segments = materialize_segments(ranges, words, norm_words, starts, ends)
+    return filter_segments(segments, min_duration)
+
+
+def segment_info(file_id: str, filename: str, segment: dict, out_folder: str) -> list:
+    """
+    Create the line of segment information that the manifests are written from.
+
+    Parameters:
+    - file_id (str): Id of the recording.
+    - filename (str): Id of the segment.
+    - segment (dict): The segment.
+    - out_folder (str): Folder of the segments of the recording.
+
+    Returns:
+    - list: Segment information.
+    """
+    return [
+        file_id,
+        filename,
+        segment["text_norm"],
+        segment["text"],
+        str(segment["start"]),
+        str(segment["end"]),
+        str(segment["duration"]),
+        os.path.join(out_folder, filename) + ".wav",
+    ]
+
+
+def write_shard(shard: str, audio_file: str, info: list, segments: list) -> dict:
+    """
+    Write the segments of a recording to a single tar archive.
+
+    Each segment is stored as three consecutive members, `<segment_id>.wav`,
+    `<segment_id>.txt` and `<segment_id>_norm.txt`, in segment order, so the
+    shard can be read with sequential I/O.
+
+    Parameters:
+    - shard (str): Path of the tar archive.
+    - audio_file (str): Path to the recording.
+    - info (list): Segment information from `segment_info`.
+    - segments (list): The planned segments.
+
+    Returns:
+    - dict: Mapping from segment id to (shard, offset, size) of its audio
+      in the archive. Segments that SoX failed to cut are left out.
+    """
+
+    os.makedirs(os.path.dirname(shard), exist_ok=True)
+
+    def add(tar, name, data):
+        member = tarfile.TarInfo(name)
+        member.size = len(data)
+        tar.addfile(member, io.BytesIO(data))
+
+    try:
+        with tarfile.open(shard + ".tmp", "w", format=tarfile.GNU_FORMAT) as tar:
+            try:
+                source = WavFile(audio_file)
+            except UnsupportedAudioFormat:
+                source = None
+            try:
+                for line, segment in zip(info, segments):
+                    filename = line[1]
+                    if source is not None:
+                        audio = source.wav_bytes(
+                            *source.time_range(segment["start"], segment["duration"])
+                        )
+                    else:
+                        with tempfile.TemporaryDirectory() as tmp:
+                            out_f = os.path.join(tmp, "segment.wav")
+                            extract_audio_segment(
+                                audio_file, out_f, segment["start"], segment["duration"]
+                            )
+                            if not os.path.exists(out_f):
+                                # SoX failed and logged why, as in files mode.
+                                continue
+                            with open(out_f, "rb") as f:
+                                audio = f.read()
+                    add(tar, filename + ".wav", audio)
+                    add(tar, filename + ".txt", segment["text"].encode("utf-8"))
+                    add(
+                        tar,
+                        filename + "_norm.txt",
+                        segment["text_norm"].encode("utf-8"),
+                    )
+            finally:
+                if source is not None:
+                    source.close()
+    except BaseException:
+        if os.path.exists(shard + ".tmp"):
+            os.remove(shard + ".tmp")
+        raise
+    os.replace(shard + ".tmp", shard)
+
+    with tarfile.open(shard) as tar:
+        return {
+            member.name[: -len(".wav")]: (shard, member.offset_data, member.size)
+            for member in tar.getmembers()
+            if member.name.endswith(".wav")
+        }
+
+
+def segment_recording(
+    audio_file: str,
+    output_folder: str,
+    fileId2split: dict,
+    min_duration: int = 2,
+    max_duration: int = 20,
+    output_mode: str = "files",
+    word_store: str = None,
+    timer: StageTimer = None,
+) -> list:
+    """
+    Segment a single recording and write its audio and text files.
+
+    Each recording is independent of the others, which lets `run_segmentation`
+    process them in parallel. With `output_mode="virtual"` nothing is written
+    and each segment refers to a frame range of the source recording instead.
+    With `output_mode="shards"` all segments of the recording are packed into
+    one tar archive, see `write_shard`.
+
+    Parameters:
+    - audio_file (str): Path to the recording.
+    - output_folder (str): Directory to save segmented audio and its transcripts.
+    - fileId2split (dict): Mapping from file_id to its respective split.
+    - min_duration (int): Minimum acceptable segment duration. Default is 2 seconds.
+    - max_duration (int): Maximum acceptable segment duration. Default is 20 seconds.
+    - output_mode (str): "files", "virtual" or "shards". Default is "files".
+    - word_store (str): Optional path to a word store to read the transcript from.
+    - timer (StageTimer): Optional timer that gets the time spent loading,
+      planning and writing, the number of segments, their total duration and
+      the number of bytes written.
+
+    Returns:
+    - list: One line of segment information per segment, in segment order.
+      The last item is the (source, start_frame, end_frame) of the segment
+      in virtual mode, the (shard, offset, size) of its audio in shards mode
+      and None otherwise.
+    """
+
+    timer = StageTimer() if timer is None else timer
+    info = []
+    file_id = os.path.basename(audio_file).rstrip(".wav")
+    logger.info(audio_file.replace(".wav", ".json"))
+    with timer.stage("load"):
+        transcript = load_transcript_columns(
+            audio_file.replace(".wav", ".json"), word_store
+        )
+
+    with timer.stage("plan"):
+        segments = plan_segments(
+            transcript.word,
+            transcript.norm_word,
+            transcript.start,
+            transcript.end,
+            min_duration,
+            max_duration,
+        )
+    timer.count("segments", len(segments))
+    timer.count("audio_seconds", round(sum(seg["duration"] for seg in segments), 2))
+    logger.debug(
+        f"Planned {len(segments)} segments of {min_duration}-{max_duration} seconds"
+    )
+
+    out_folder = os.path.join(output_folder, fileId2split[file_id], file_id)
+    if output_mode == "virtual":
+        with timer.stage("write"), WavFile(audio_file) as source:
+            for idx, segment in enumerate(segments):
+                filename = f"{file_id}_{str(idx)}_{str(segment['duration'])}"
+                start_frame, end_frame = source.time_range(
+                    segment["start"], segment["duration"]
+                )
+                end_frame = min(end_frame, source.num_frames)
+                info.append(
+                    segment_info(file_id, filename, segment, out_folder)
+                    + [(audio_file, start_frame, end_frame)]
+                )
+        logger.info(f"Planned {len(info)} virtual segments of {audio_file}")
+        return info
+
+    if output_mode == "shards":
+        conversation = os.path.basename(os.path.dirname(audio_file))
+        shard = os.path.join(
+            output_folder, fileId2split[file_id], f"{conversation}_{file_id}.tar"
+        )
+        for idx, segment in enumerate(segments):
+            filename = f"{file_id}_{str(idx)}_{str(segment['duration'])}"
+            info.append(segment_info(file_id, filename, segment, out_folder))
+        with timer.stage("write"):
+            members = write_shard(shard, audio_file, info, segments)
+        info = [line + [members[line[1]]] for line in info if line[1] in members]
+        timer.count("bytes_written", os.path.getsize(shard))
+        logger.info(f"Wrote {len(info)} segments of {audio_file} to {shard}")
+        return info
+
+    os.makedirs(out_folder, exist_ok=True)
+    logger.debug(f"Saving the segments to {out_folder}")
+    audio_segments = []
+    with timer.stage("write"):
+        for idx, segment in enumerate(segments):
+            filename = f"{file_id}_{str(idx)}_{str(segment['duration'])}"
+
+            out_f = os.path.join(out_folder, filename)
+
+            audio_segments.append(
+                (out_f + ".wav", segment["start"], segment["duration"])
+            )
+            for path, content in [
+                (out_f + "_norm.txt", segment["text_norm"]),
+                (out_f + ".txt", segment["text"]),
+            ]:
+                if not os.path.exists(path):
+                    with open(path, "w") as f:
+                        f.write(content)
+                        timer.count("bytes_written", f.tell())
+                else:
+                    logger.debug(f"{path} exists, wont overwrite")
+            info.append(segment_info(file_id, filename, segment, out_folder) + [None])
+
+    with timer.stage("extract"):
+        pending = [s[0] for s in audio_segments if not os.path.exists(s[0])]
+        written = extract_audio_segments(audio_file, audio_segments)
+    timer.count(
+        "bytes_written", sum(os.path.getsize(f) for f in pending if os.path.exists(f))
+    )
+    logger.info(f"Wrote {written} audio segments from {audio_file}")
+    return info
+
+
+def file_digest(path: str, known: dict = None) -> list:
+    """
+    Compute the SHA-256 digest of a file.
+
+    Parameters:
+    - path (str): Path to the file.
+    - known (dict): [size, mtime_ns, digest] from an earlier call, which is
+      reused when the size and modification time haven't changed.
+
+    Returns:
+    - list: [size, mtime_ns, digest] of the file.
+    """
+
+    stat = os.stat(path)
+    if known and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return known
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+
+
+def segment_recording_incremental(
+    audio_file: str,
+    output_folder: str,
+    fileId2split: dict,
+    min_duration: int = 2,
+    max_duration: int = 20,
+    output_mode: str = "files",
+    word_store: str = None,
+    timer: StageTimer = None,
+) -> list:
+    """
+    Segment a single recording unless it was segmented before from the same
+    audio, transcript and parameters.
+
+    A cache entry in `<output_folder>/.cache/` stores the
+    digests of the recording and its transcript, the segmentation parameters
+    and the resulting segment information. When the entry is out of date the
+    segments it lists are removed and the recording is segmented again.
+
+    Parameters are the same as for `segment_recording`.
+
+    Returns:
+    - list: One line of segment information per segment, in segment order.
+    """
+
+    timer = StageTimer() if timer is None else timer
+    file_id = os.path.basename(audio_file).rstrip(".wav")
+    transcript_file = audio_file.replace(".wav", ".json")
+    # Named after the path, as recordings of the same speaker share a file_id.
+    cache_file = os.path.join(
+        output_folder, ".cache", os.path.normpath(audio_file).replace(os.sep, "__")
+    )
+    cache_file = cache_file[: -len(".wav")] + ".json"
+
+    entry = {}
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            entry = json.load(f)
+
+    with timer.stage("hash"):
+        sources = {
+            path: file_digest(path, entry.get("sources", {}).get(path))
+            for path in [audio_file, transcript_file]
+        }
+    params = [fileId2split[file_id], min_duration, max_duration, output_mode]
+    key = hashlib.sha256(
+        json.dumps(
+            [sources[audio_file][2], sources[transcript_file][2], params]
+        ).encode("utf-8")
+    ).hexdigest()
+
+    previous_mode = entry.get("output_mode", "files")
+    if previous_mode == "files":
+        outputs = [line[7] for line in entry.get("info", [])]
+    elif previous_mode == "shards":
+        outputs = sorted({line[8][0] for line in entry.get("info", [])})
+    else:
+        outputs = []
+
+    if entry.get("key") == key and all(os.path.exists(f) for f in outputs):
+        logger.info(f"{audio_file} is unchanged, using cached segments")
+        info = entry["info"]
+        timer.count("cached")
+        timer.count("segments", len(info))
+    else:
+        for output in outputs:
+            out_f = output[: -len(".wav")]
+            for f in [output, out_f + ".txt", out_f + "_norm.txt"]:
+                if os.path.exists(f):
+                    os.remove(f)
+        info = segment_recording(
+            audio_file,
+            output_folder,
+            fileId2split,
+            min_duration=min_duration,
+            max_duration=max_duration,
+            output_mode=output_mode,
+            word_store=word_store,
+            timer=timer,
+        )
+
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file + ".tmp", "w") as f:
+        entry = {
+            "key": key,
+            "output_mode": output_mode,
+            "sources": sources,
+            "info": info,
+        }
+        json.dump(entry, f, ensure_ascii=False)
+    os.replace(cache_file + ".tmp", cache_file)
+    return info
+
+
+def segment_recordings(audio_files: list, segment=segment_recording, **kwargs) -> list:
+    """
+    Segment recordings one after the other.
+
+    Parameters:
+    - audio_files (list): Paths to the recordings.
+    - segment (callable): `segment_recording` or `segment_recording_incremental`.
+    - kwargs: Passed on to `segment`.
+
+    Returns:
+    - list: (segment information, metrics) of each recording, the metrics being
+      the summary of a `src.metrics.StageTimer` with the recording's path.
+    """
+    results = []
+    for audio_file in audio_files:
+        timer = StageTimer()
+        info = segment(audio_file, timer=timer, **kwargs)
+        results.append((info, {"recording": audio_file, **timer.summary()}))
+    return results
+
+
+def write_manifests(
+    info: list, output_folder: str, fileId2split: dict, output_mode: str = "files"
+) -> None:
+    """
+    Write the `.trans`, `.info` and, in virtual mode, `.segments` or, in
+    shards mode, `.shards` files of each split.
+
+    The manifests are written to temporary files and moved into place at the
+    end, so an interrupted run never leaves half written manifests behind.
+
+    Parameters:
+    - info (list): Segment information from `segment_recording`, in order.
+    - output_folder (str): Directory to write the manifests to.
+    - fileId2split (dict): Mapping from file_id to its respective split.
+    - output_mode (str): "files", "virtual" or "shards". Default is "files".
+    """
+
+    splits = ["test", "dev", "train"]
+    trans_files = {
+        s: open(os.path.join(output_folder, f"{s}.trans.tmp"), "w") for s in splits
+    }
+    info_files = {
+        s: open(os.path.join(output_folder, f"{s}.info.tmp"), "w") for s in splits
+    }
+    sidecars = {"virtual": ".segments", "shards": ".shards"}
+    for sidecar in sidecars.values():
+        for s in splits:
+            stale = os.path.join(output_folder, s + sidecar)
+            if sidecar != sidecars.get(output_mode) and os.path.exists(stale):
+                os.remove(stale)
+    segment_files = {}
+    if output_mode in sidecars:
+        segment_files = {
+            s: open(
+                os.path.join(output_folder, s + sidecars[output_mode] + ".tmp"), "w"
+            )
+            for s in splits
+        }
+
+    try:
+        header = " ".join(["file_id", "segment_id", "start", "end", "duration"]) + "\n"
+        for f in info_files.values():
+            f.write(header)
+        if output_mode == "shards":
+            header = " ".join(["segment", "shard", "offset", "size"]) + "\n"
+        else:
+            header = " ".join(["segment", "source", "start_frame", "end_frame"]) + "\n"
+        for f in segment_files.values():
+            f.write(header)
+
+        for line in info:
+            split = fileId2split[line[0]]
+            if split not in trans_files:
+                raise Exception("File not in splits")
+            trans_files[split].write("\t".join([line[7], line[2]]) + "\n")
+            info_files[split].write("\t".join(line[:2] + line[4:7]) + "\n")
+            if line[8] is not None:
+                fields = [line[7]] + [str(x) for x in line[8]]
+                segment_files[split].write("\t".join(fields) + "\n")
+    finally:
+        for files in [trans_files, info_files, segment_files]:
+            for f in files.values():
+                f.close()
+
+    for files in [trans_files, info_files, segment_files]:
+        for f in files.values():
+            os.replace(f.name, f.name[: -len(".tmp")])
+
+
 def run_segmentation(
     output_folder: str,
     splits_folder: str,
     min_duration: int = 2,
     max_duration: int = 20,
+    workers: int = 1,
+    output_mode: str = "files",
+    incremental: bool = False,
+    word_store: str = None,
+    verbose: int = 0,
+    progress: bool = False,
+    metrics_file: str = "segmentation_metrics.json",
 ) -> Tuple[str, str, str]:
     """
     Create short segments for each recording in the corpus.
 
+    With `incremental=True` only recordings whose audio, transcript or
+    segmentation parameters changed since the last run are segmented again,
+    see `segment_recording_incremental`, and the split manifests are always
+    regenerated from the per-recording results.
+
+    With `output_mode="virtual"` no audio or text files are written. Each split
+    instead gets a `.segments` manifest next to its `.trans` file that maps
+    every segment path in the `.trans` file to a frame range of its source
+    recording, see `src.audio.SegmentReader`. With `output_mode="shards"` the
+    segments of each recording are packed into one tar archive and each split
+    gets a `.shards` index of the offset and size of every segment's audio.
+
+    The time spent on each stage of every recording, the number of segments
+    and the bytes written are collected and saved as a JSON summary, see
+    `src.metrics.summarize`, in `metrics_file` in the output folder.
+
     Parameters:
     - output_folder (str): Directory to save segmented audio and its transcripts.
     - splits_folder (str): Folder containing split information.
     - min_duration (int): Minimum acceptable segment duration. Default is 2 seconds.
     - max_duration (int): Maximum acceptable segment duration. Default is 20 seconds.
+    - workers (int): Number of recordings to process in parallel. Default is 1.
+    - output_mode (str): "files" to cut the audio into files, "virtual" to only
+      write manifests or "shards" to pack the segments into tar archives.
+      Default is "files".
+    - incremental (bool): Whether to reuse the results of earlier runs. Default is False.
+    - word_store (str): Optional path to a word store, see `src.wordstore`, to read
+      the transcripts from instead of their JSON files.
+    - verbose (int): 0 to only print warnings, 1 for a line per recording and 2 for
+      a line per segment. Default is 0.
+    - progress (bool): Whether to show a progress bar over recordings. Default is False.
+    - metrics_file (str): Name of the JSON summary in the output folder, or None to
+      not write one. Default is "segmentation_metrics.json".
 
     Returns:
     - Tuple[str, str, str]: Paths to the transcript files for dev, test, and train splits.
@@ -242,6 +958,11 @@ def run_segmentation(
     if not os.path.exists(splits_folder):
         raise Exception(f"Folder {splits_folder} does not exist")
 
+    start = time.perf_counter()
+    set_verbosity(logger, verbose)
+    if output_mode not in ["files", "virtual", "shards"]:
+        raise ValueError(f"Unknown output mode {output_mode}")
+
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
@@ -254,169 +975,79 @@ def run_segmentation(
 
     fileId2split = open_splits_files(splits_folder)
 
-    info = []
-    for audio_file in compile_files():
+    audio_files = compile_files()
+    worker = partial(
+        segment_recordings,
+        segment=segment_recording_incremental if incremental else segment_recording,
+        output_folder=output_folder,
+        fileId2split=fileId2split,
+        min_duration=min_duration,
+        max_duration=max_duration,
+        output_mode=output_mode,
+        word_store=word_store,
+    )
+    # A few speakers appear in more than one conversation and their recordings
+    # share a file_id and an output folder, so those are handled by the same
+    # worker, one after the other.
+    groups = {}
+    for audio_file in audio_files:
         file_id = os.path.basename(audio_file).rstrip(".wav")
-        print(audio_file.replace(".wav", ".json"))
-        transcript = load_transcript(audio_file.replace(".wav", ".json"))
-
-        segments = []
-        segment = []
-
-        for idx, item in enumerate(transcript):
-            segment.append(item)
-            if segment and item["word"][-1] in [".", "?", "!"]:
-                if idx + 1 < len(transcript):
-                    segment[-1]["end"] = add_padding(
-                        segment[-1]["end"], transcript[idx + 1]["end"]
-                    )
-                segments.append(segment)
-                segment = []
-
-        if segment:
-            segments.append(segment)
-
-        total_segments_before = len(segments)
-        iterations = 1
-        while [seg for seg in segments if segment_duration(seg) > max_duration]:
-            print(
-                f"- Found {len([seg for seg in segments if segment_duration(seg) > max_duration])} segments that are too long."
-            )
-            idx = 0
-            while idx < len(segments):
-                seg = segments[idx]
-
-                if segment_duration(seg) > max_duration:
-                    print(f"-- Found segment that is {segment_duration(seg)}")
-                    a, b = split_in_half(seg)
-                    del segments[idx]
-                    segments.insert(
-                        idx, b
-                    )  # insert b first so that a remains at the same index
-                    segments.insert(idx, a)
-                    print(
-                        f"-- New segments are {segment_duration(a)} and {segment_duration(b)} seconds long"
-                    )
-                    idx += 2  # skip the two newly added segments
-                else:
-                    idx += 1
-
-            print(f"- Iteration num: {iterations}")
-            iterations += 1
-        iterations = 1
-
-        min_count = len(
-            [seg for seg in segments if segment_duration(seg) < min_duration]
-        )
-        print(f"Segment found based on sentence boundary: {total_segments_before}")
-        print(f"After splitting long sentences there are {len(segments)} segments")
-        print(f"Found {min_count} that where less then {min_duration}")
-
-        print(f"Flattening the segments")
-        segments = [flatten(seg) for seg in segments]
-
-        # Let's combine segments until we reach the maximum duration
-        idx = 0
-        while idx < len(segments) - 1:  # check until the second last segment
-            seg = segments[idx]
-            next_seg = segments[idx + 1]
-            combined_seg = merge_segments(seg, next_seg)
-
-            if combined_seg["duration"] <= max_duration:
-                segments[
-                    idx
-                ] = combined_seg  # replace the current segment with the merged one
-                del segments[
-                    idx + 1
-                ]  # delete the next segment which is now part of the merged one
-            else:
-                idx += 1
-
-        print(f"After combining there are {len(segments)} segments")
-        print(
-            f"Of which {len([seg for seg in segments if seg['duration'] < min_duration])} are less than {min_duration} seconds."
-        )
-        print(f"Remving segments that are less than {min_duration} seconds.")
-
-        segments = [seg for seg in segments if seg["duration"] >= min_duration]
-        print("Remvoing segments that only have <unk> or [hik: ...].")
-        segments = [seg for seg in segments if seg["text_norm"].strip().rstrip()]
-
-        out_folder = os.path.join(output_folder, fileId2split[file_id], file_id)
-        os.makedirs(out_folder, exist_ok=True)
-        print(f"Saving the segments to {out_folder}")
-        for idx, segment in enumerate(segments):
-            filename = f"{file_id}_{str(idx)}_{str(segment['duration'])}"
-
-            out_f = os.path.join(out_folder, filename)
-
-            extract_audio_segment(
-                audio_file, out_f + ".wav", segment["start"], segment["duration"]
-            )
-            norm_text = out_f + "_norm.txt"
-            text = out_f + ".txt"
-            if not os.path.exists(norm_text):
-                with open(norm_text, "w") as f:
-                    f.write(segment["text_norm"])
-            else:
-                print(f"{norm_text} exists, wont overwrite")
-
-            if not os.path.exists(text):
-                with open(text, "w") as f:
-                    f.write(segment["text"])
-            else:
-                print(f"{text} exists, wont overwrite")
-            line = [
-                file_id,
-                filename,
-                segment["text_norm"],
-                segment["text"],
-                str(segment["start"]),
-                str(segment["end"]),
-                str(segment["duration"]),
-                out_f + ".wav",
-            ]
-            info.append(line)
+        groups.setdefault(file_id, []).append(audio_file)
+    groups = list(groups.values())
+
+    run_timer = StageTimer()
+    with run_timer.stage("segment"):
+        if workers > 1:
+            pool = Pool(workers, initializer=set_verbosity, initargs=(logger, verbose))
+            outputs = pool.imap(worker, groups)
+        else:
+            pool = None
+            outputs = map(worker, groups)
+        if progress:
+            from tqdm import tqdm
+
+            outputs = tqdm(outputs, total=len(groups), unit="speaker")
+        try:
+            per_group = list(outputs)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    # Put the results back in the order of compile_files(), so the merged
+    # manifests are identical to a serial run for any number of workers.
+    per_file = {}
+    for group, results in zip(groups, per_group):
+        per_file.update(zip(group, results))
+    per_recording = [per_file[audio_file] for audio_file in audio_files]
+    info = [line for lines, _ in per_recording for line in lines]
 
     dev_trans = os.path.join(output_folder, "dev.trans")
     test_trans = os.path.join(output_folder, "test.trans")
     train_trans = os.path.join(output_folder, "train.trans")
 
-    if any(
+    if not incremental and any(
         [
             os.path.exists(dev_trans),
             os.path.exists(test_trans),
             os.path.exists(train_trans),
         ]
     ):
-        print(f"{dev_trans}, {test_trans} or {train_trans} exist, wont overwrite.")
-        return dev_trans, test_trans, train_trans
-
-    with open(test_trans, "w") as test, open(dev_trans, "w") as dev, open(
-        train_trans, "w"
-    ) as train, open(test_trans.replace(".trans", ".info"), "w") as test_info, open(
-        dev_trans.replace(".trans", ".info"), "w"
-    ) as dev_info, open(
-        train_trans.replace(".trans", ".info"), "w"
-    ) as train_info:
-        header = " ".join(["file_id", "segment_id", "start", "end", "duration"]) + "\n"
-        test_info.write(header)
-        dev_info.write(header)
-        train_info.write(header)
-
-        for line in info:
-            file_id = line[0]
-            info = "\t".join(line[:2] + line[4:-1]) + "\n"
-            line = "\t".join([line[-1], line[2]]) + "\n"
-            if fileId2split[file_id] == "test":
-                test.write(line)
-                test_info.write(info)
-            elif fileId2split[file_id] == "dev":
-                dev.write(line)
-                dev_info.write(info)
-            elif fileId2split[file_id] == "train":
-                train.write(line)
-                train_info.write(info)
-            else:
-                raise Exception("File not in splits")
+        logger.warning(
+            f"{dev_trans}, {test_trans} or {train_trans} exist, wont overwrite."
+        )
+    else:
+        with run_timer.stage("manifest"):
+            write_manifests(info, output_folder, fileId2split, output_mode)
+
+    summary = summarize(
+        [metrics for _, metrics in per_recording], time.perf_counter() - start
+    )
+    summary["run"] = run_timer.summary()
+    logger.info(
+        f"Segmented {len(audio_files)} recordings into {summary.get('segments', 0)} "
+        f"segments in {summary['wall_time']:.1f} seconds"
+    )
+    if metrics_file:
+        write_summary(summary, os.path.join(output_folder, metrics_file))
     return dev_trans, test_trans, train_trans
@@ -0,0 +1,524 @@
+########################################################################
+
+# Author   : Carlos Daniel Hernández Mena & David Erik Mollberg
+# Date     : November 1st, 2023
+# Location : Reykjavík University and Tiro ehf.
+
+# Description:
+
+# A local transcription server, so the model is loaded once instead of
+# by every script that transcribes something. It keeps warm replicas of
+# a Faster-Whisper model, collects concurrent requests into batches that
+# are decoded with transcribe_segments, waiting at most a few
+# milliseconds for a batch to fill, and reports latency and queue depth.
+# With a maximum batch size of 1 every segment is decoded on its own with
+# the options of transcribe_file, temperature fallback included.
+#
+# Endpoints, over HTTP on localhost or a Unix socket:
+#   POST /transcribe   WAV file in the body, returns {"hyp": ...}
+#   GET  /metrics      Latency percentiles, queue depth and batch sizes
+#   GET  /config       Model and decoding parameters of the server
+#
+# Usage: python -m src.serve <whisper_model> --port 8765 --replicas 2
+# and then transcribe_file(..., server="127.0.0.1:8765").
+
+########################################################################
+
+import argparse
+import asyncio
+import http.client
+import io
+import json
+import os
+import socket
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+from faster_whisper import WhisperModel
+
+from src.audio import SegmentReader, load_audio
+from src.transcribe import DECODE_OPTIONS, transcribe_segments
+
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+class _Request:
+    __slots__ = ["audio", "future", "arrival"]
+
+    def __init__(self, audio, future, arrival):
+        self.audio = audio
+        self.future = future
+        self.arrival = arrival
+
+
+class TranscriptionServer:
+    """
+    Transcribes audio sent over HTTP with warm model replicas.
+
+    Requests wait on a queue. Each replica takes the oldest request and any
+    that arrive within `max_latency` seconds of it, up to `max_batch_size`,
+    and decodes them in one batch with `transcribe_segments`, without
+    temperature fallback. Segments longer than the 30 second window of
+    Whisper are decoded on their own with `model.transcribe`. With
+    `max_batch_size` 1 every segment is decoded with `model.transcribe` and
+    the options of `transcribe_file`, so the hypotheses are the same as with
+    `transcribe_file` and `batch_size` 1.
+
+    Parameters:
+    - whisper_model (str): Path to the pretrained Faster-Whisper model.
+    - device (str, optional): Device to which the model is sent. Defaults to 'cpu'.
+    - compute_type (str, optional): Type of computation to be performed. Defaults to 'int8'.
+    - replicas (int, optional): Batches decoded at the same time, each by its own
+      CTranslate2 worker. Defaults to 2.
+    - cpu_threads (int, optional): Threads of each replica on CPU, 0 for the
+      CTranslate2 default.
+    - max_batch_size (int, optional): Maximum number of segments in a batch. Defaults to 8.
+    - max_latency (float, optional): Seconds the first request of a batch waits for
+      others to join it. Defaults to 0.05.
+    - beam_size (int, optional): Beam size. Defaults to that of `transcribe_file`.
+    - language (str, optional): Language of the segments, detected if None.
+    """
+
+    def __init__(
+        self,
+        whisper_model: str,
+        device: str = "cpu",
+        compute_type: str = "int8",
+        replicas: int = 2,
+        cpu_threads: int = 0,
+        max_batch_size: int = 8,
+        max_latency: float = 0.05,
+        beam_size: int = DECODE_OPTIONS["beam_size"],
+        language: str = None,
+    ):
+        self.whisper_model = whisper_model
+        self.device = device
+        self.compute_type = compute_type
+        self.replicas = replicas
+        self.cpu_threads = cpu_threads
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.beam_size = beam_size
+        self.language = language
+        self.model = None
+        self.load_time = 0.0
+
+        self._executor = ThreadPoolExecutor(replicas)
+        self._queue = None
+        self._tasks = []
+        self._started = time.monotonic()
+        self._latencies = deque(maxlen=10000)
+        self._waits = deque(maxlen=10000)
+        self._batch_sizes = Counter()
+        self._counts = Counter()
+        self._busy = 0.0
+        self._audio_seconds = 0.0
+        self._in_flight = 0
+        self._max_queue_depth = 0
+
+    def config(self) -> dict:
+        """Model and decoding parameters, everything that affects the hypotheses."""
+        return {
+            "model": self.whisper_model,
+            "device": self.device,
+            "compute_type": self.compute_type,
+            "batched": self.max_batch_size > 1,
+            "language": self.language,
+            **dict(DECODE_OPTIONS, beam_size=self.beam_size),
+        }
+
+    def metrics(self) -> dict:
+        """Request and batch counts, latency percentiles in ms and queue depth."""
+
+        def percentiles(values):
+            if not values:
+                return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+            p50, p95, p99 = np.percentile(np.asarray(values) * 1000, [50, 95, 99])
+            return {"p50": round(p50, 2), "p95": round(p95, 2), "p99": round(p99, 2)}
+
+        batches = sum(self._batch_sizes.values())
+        return {
+            "uptime": round(time.monotonic() - self._started, 3),
+            "model_load_time": round(self.load_time, 3),
+            "requests": self._counts["requests"],
+            "errors": self._counts["errors"],
+            "batches": batches,
+            "mean_batch_size": (
+                round(self._counts["decoded"] / batches, 3) if batches else 0.0
+            ),
+            "batch_sizes": dict(sorted(self._batch_sizes.items())),
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "max_queue_depth": self._max_queue_depth,
+            "in_flight": self._in_flight,
+            "latency_ms": percentiles(self._latencies),
+            "queue_wait_ms": percentiles(self._waits),
+            "audio_seconds": round(self._audio_seconds, 3),
+            "busy_time": round(self._busy, 3),
+            "rtf": (
+                round(self._busy / self._audio_seconds, 4)
+                if self._audio_seconds
+                else 0.0
+            ),
+        }
+
+    async def start(self):
+        """Load the model and start one batching task per replica."""
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        self.model = await loop.run_in_executor(
+            self._executor,
+            lambda: WhisperModel(
+                self.whisper_model,
+                device=self.device,
+                compute_type=self.compute_type,
+                cpu_threads=self.cpu_threads,
+                num_workers=self.replicas,
+            ),
+        )
+        self.load_time = time.monotonic() - start
+        self._queue = asyncio.Queue()
+        self._tasks = [
+            asyncio.create_task(self._batcher()) for _ in range(self.replicas)
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown()
+
+    async def transcribe(self, audio: np.ndarray) -> str:
+        """Queue one segment and wait for its hypothesis."""
+        loop = asyncio.get_running_loop()
+        request = _Request(audio, loop.create_future(), loop.time())
+        self._counts["requests"] += 1
+        self._queue.put_nowait(request)
+        self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+        return await request.future
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self._queue.get()
+            batch = [first]
+            deadline = first.arrival + self.max_latency
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            started = loop.time()
+            self._waits.extend(started - r.arrival for r in batch)
+            self._in_flight += len(batch)
+            try:
+                hyps = await loop.run_in_executor(
+                    self._executor, self._decode, [r.audio for r in batch]
+                )
+            except Exception as e:
+                self._counts["errors"] += len(batch)
+                for r in batch:
+                    if not r.future.done():
+                        r.future.set_exception(e)
+            else:
+                for r, hyp in zip(batch, hyps):
+                    if not r.future.done():
+                        r.future.set_result(hyp)
+            finally:
+                self._in_flight -= len(batch)
+            finished = loop.time()
+            self._busy += finished - started
+            self._audio_seconds += sum(
+                len(r.audio) / self.model.feature_extractor.sampling_rate for r in batch
+            )
+            self._latencies.extend(finished - r.arrival for r in batch)
+            self._batch_sizes[len(batch)] += 1
+            self._counts["decoded"] += len(batch)
+
+    def _decode(self, audio: list) -> list:
+        window = self.model.feature_extractor.n_samples
+        hyps = [None] * len(audio)
+        short = [i for i, samples in enumerate(audio) if len(samples) <= window]
+        if short and self.max_batch_size > 1:
+            batch = transcribe_segments(
+                self.model, [audio[i] for i in short], self.beam_size, self.language
+            )
+            for i, hyp in zip(short, batch):
+                hyps[i] = hyp
+        for i, samples in enumerate(audio):
+            if hyps[i] is None:
+                segments, _ = self.model.transcribe(
+                    samples,
+                    language=self.language,
+                    **dict(DECODE_OPTIONS, beam_size=self.beam_size),
+                )
+                hyps[i] = " ".join(segment.text for segment in segments)
+        return [" ".join(hyp.split()) for hyp in hyps]
+
+    async def _route(self, method: str, target: str, body: bytes) -> tuple:
+        path = target.split("?")[0]
+        if method == "POST" and path == "/transcribe":
+            if not body:
+                return 400, {"error": "Expected a WAV file in the request body"}
+            loop = asyncio.get_running_loop()
+            try:
+                audio = await loop.run_in_executor(
+                    None,
+                    load_audio,
+                    io.BytesIO(body),
+                    self.model.feature_extractor.sampling_rate,
+                )
+            except Exception as e:
+                return 400, {"error": f"Could not decode audio: {e}"}
+            return 200, {"hyp": await self.transcribe(audio)}
+        if method == "GET" and path == "/metrics":
+            return 200, self.metrics()
+        if method == "GET" and path == "/config":
+            return 200, self.config()
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        return 404, {"error": f"No endpoint {method} {path}"}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve HTTP/1.1 requests on one connection, kept alive between requests."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in [b"\r\n", b"\n", b""]:
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                try:
+                    status, payload = await self._route(method, target, body)
+                except Exception as e:
+                    status, payload = 500, {"error": str(e)}
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {STATUS[status]}\r\n"
+                        "Content-Type: application/json\r\n"
+                        f"Content-Length: {len(data)}\r\n\r\n"
+                    ).encode("latin-1")
+                    + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(
+    server: TranscriptionServer,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    unix_socket: str = None,
+) -> None:
+    """
+    Run a transcription server until it is interrupted.
+
+    Parameters:
+    - server (TranscriptionServer): The server.
+    - host (str, optional): Address to listen on. Defaults to localhost.
+    - port (int, optional): Port to listen on. Defaults to 8765.
+    - unix_socket (str, optional): Path of a Unix socket to listen on instead.
+    """
+
+    await server.start()
+    if unix_socket:
+        listener = await asyncio.start_unix_server(server.handle, path=unix_socket)
+        address = unix_socket
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+        address = f"{host}:{port}"
+    print(
+        f"Serving {server.whisper_model} on {address} with {server.replicas} replicas,"
+        f" model loaded in {server.load_time:.1f}s"
+    )
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await server.stop()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class TranscriptionClient:
+    """
+    Client of a `TranscriptionServer`. Can be shared between threads, each
+    thread keeps its own connection.
+
+    Parameters:
+    - address (str): "host:port" or the path of a Unix socket.
+    - timeout (float, optional): Seconds to wait for a response. Defaults to 600.
+    """
+
+    def __init__(self, address: str = "127.0.0.1:8765", timeout: float = 600):
+        self.address = address
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            host, _, port = self.address.rpartition(":")
+            if host and port.isdigit():
+                connection = http.client.HTTPConnection(
+                    host, int(port), timeout=self.timeout
+                )
+            else:
+                connection = _UnixHTTPConnection(self.address, self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def request(self, method: str, path: str, body: bytes = None) -> dict:
+        connection = self._connection()
+        try:
+            connection.request(method, path, body=body)
+            response = connection.getresponse()
+            payload = json.loads(response.read())
+        except (ConnectionError, http.client.HTTPException):
+            connection.close()
+            self._local.connection = None
+            raise
+        if response.status != 200:
+            raise Exception(
+                f"{method} {path} failed with {response.status}: {payload['error']}"
+            )
+        return payload
+
+    def transcribe(self, wav: bytes) -> str:
+        """Transcribe the audio of a WAV file."""
+        return self.request("POST", "/transcribe", wav)["hyp"]
+
+    def metrics(self) -> dict:
+        return self.request("GET", "/metrics")
+
+    def config(self) -> dict:
+        return self.request("GET", "/config")
+
+
+def transcribe_remote(
+    client: TranscriptionClient,
+    audio_files: list,
+    reader: SegmentReader,
+    concurrency: int = 8,
+    latencies: list = None,
+):
+    """
+    Transcribe segments with a server, `concurrency` requests at a time so the
+    server can batch them.
+
+    Parameters:
+    - client (TranscriptionClient): Client of the server.
+    - audio_files (list): Audio file paths and their transcriptions.
+    - reader (SegmentReader): Reader for virtual and sharded segments.
+    - concurrency (int, optional): Requests sent at the same time. Defaults to 8.
+    - latencies (list, optional): Gets the time of the request of each segment.
+
+    Yields:
+    - Tuple[int, str]: The index in `audio_files` and hypothesis of each segment,
+      in the order they are finished.
+    """
+
+    def read(wav_file):
+        if wav_file in reader.table:
+            return reader.wav_bytes(wav_file)
+        with open(wav_file, "rb") as f:
+            return f.read()
+
+    def transcribe(j, wav):
+        start = time.perf_counter()
+        hyp = client.transcribe(wav)
+        if latencies is not None:
+            latencies.append(time.perf_counter() - start)
+        return j, hyp
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        pending = set()
+        for j, (wav_file, _) in enumerate(audio_files):
+            if len(pending) >= concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            # The reader isn't thread safe, so the audio is read here.
+            wav = read(wav_file)
+            pending.add(pool.submit(transcribe, j, wav))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a Faster-Whisper model.")
+    parser.add_argument("whisper_model")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", default=None)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--compute-type", default="int8")
+    parser.add_argument("--replicas", type=int, default=2)
+    parser.add_argument("--cpu-threads", type=int, default=0)
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=8,
+        help="1 to decode every segment as transcribe_file does, with temperature fallback",
+    )
+    parser.add_argument(
+        "--max-latency-ms",
+        type=float,
+        default=50,
+        help="Milliseconds a request waits for others to batch with",
+    )
+    parser.add_argument("--beam-size", type=int, default=DECODE_OPTIONS["beam_size"])
+    parser.add_argument("--language", default=None)
+    args = parser.parse_args()
+
+    server = TranscriptionServer(
+        args.whisper_model,
+        device=args.device,
+        compute_type=args.compute_type,
+        replicas=args.replicas,
+        cpu_threads=args.cpu_threads,
+        max_batch_size=args.max_batch_size,
+        max_latency=args.max_latency_ms / 1000,
+        beam_size=args.beam_size,
+        language=args.language,
+    )
+    try:
+        asyncio.run(serve(server, args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,381 @@
+########################################################################
+
+# Author   : Carlos Daniel Hernández Mena & David Erik Mollberg
+# Date     : November 1st, 2023
+# Location : Reykjavík University and Tiro ehf.
+
+# Description:
+
+# Compares decoding configurations of Faster-Whisper on a split while
+# running the encoder only once per segment. Every batch of segments is
+# encoded, or its encoder output loaded from an optional on-disk cache of
+# bounded size, and then decoded with each configuration: beam size,
+# length penalty and temperature fallback. One hypothesis file is written per
+# configuration and all of them are scored with WER and CER.
+#
+# Usage: python -m src.sweep_decoding segmented/dev.trans <whisper_model> \
+#            --output-dir results/sweep --beam-sizes 1 5 8 \
+#            --temperatures 0 0,0.2,0.4,0.6,0.8,1.0
+
+########################################################################
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+
+import ctranslate2
+import numpy as np
+from faster_whisper import WhisperModel
+
+from src.audio import AudioPrefetcher, SegmentReader, load_segment_table
+from src.digests import DigestCache
+from src.metrics import StageTimer
+from src.score import score_file
+from src.transcribe import (
+    HypothesisWriter,
+    decode_segments,
+    encode_segments,
+    segment_languages,
+)
+
+# Thresholds of the temperature fallback of Faster-Whisper.
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOG_PROB_THRESHOLD = -1.0
+
+# Default size limit of an encoder cache. An encoder output is 1500 frames
+# of the model dimension in float16, e.g. 3.8 MB for large models and
+# 1.5 MB for small ones.
+ENCODER_CACHE_BYTES = 8 << 30
+
+
+def decoding_config(
+    beam_size: int = 8,
+    length_penalty: float = 1.0,
+    temperatures: list = (0.0,),
+    best_of: int = 5,
+    name: str = None,
+) -> dict:
+    """
+    A decoding configuration for `sweep_decoding`.
+
+    Parameters:
+    - beam_size (int): Beam size. Defaults to 8.
+    - length_penalty (float): Exponential length penalty. Defaults to 1.0.
+    - temperatures (list): Temperatures to fall back to, in order, when a
+      hypothesis is too repetitive or unlikely. Defaults to (0.0,), no fallback.
+    - best_of (int): Hypotheses sampled at temperatures above 0. Defaults to 5.
+    - name (str, optional): Name of the hypothesis file, derived from the
+      parameters if None.
+
+    Returns:
+    - dict: The configuration.
+    """
+
+    temperatures = [float(t) for t in temperatures]
+    if name is None:
+        name = f"beam{beam_size}_lp{length_penalty}_t" + "-".join(
+            str(t) for t in temperatures
+        )
+    return {
+        "name": name,
+        "beam_size": beam_size,
+        "length_penalty": length_penalty,
+        "temperatures": temperatures,
+        "best_of": best_of,
+    }
+
+
+def decode_with_fallback(
+    model: WhisperModel, encoder_output: np.ndarray, languages: list, config: dict
+) -> list:
+    """
+    Decode a batch of encoder outputs with one configuration.
+
+    Segments whose hypothesis has a compression ratio above 2.4 or an average
+    log probability below -1 are decoded again at the next temperature. If no
+    temperature gives a hypothesis within those thresholds, the one with the
+    highest average log probability is kept, as in Faster-Whisper.
+
+    Parameters:
+    - model (WhisperModel): The Faster-Whisper model.
+    - encoder_output (np.ndarray): Encoder output of the batch.
+    - languages (list): Language of each segment.
+    - config (dict): See `decoding_config`.
+
+    Returns:
+    - list: The hypothesis of each segment.
+    """
+
+    attempts = [[] for _ in languages]
+    hyps = [None] * len(languages)
+    todo = list(range(len(languages)))
+    temperatures = config["temperatures"]
+    for i, temperature in enumerate(temperatures):
+        results = decode_segments(
+            model,
+            ctranslate2.StorageView.from_array(
+                np.ascontiguousarray(encoder_output[todo])
+            ),
+            [languages[j] for j in todo],
+            beam_size=config["beam_size"],
+            length_penalty=config["length_penalty"],
+            temperature=temperature,
+            best_of=config["best_of"],
+        )
+        retry = []
+        for j, (text, avg_logprob, compression_ratio) in zip(todo, results):
+            if (
+                compression_ratio > COMPRESSION_RATIO_THRESHOLD
+                or avg_logprob < LOG_PROB_THRESHOLD
+            ):
+                attempts[j].append((avg_logprob, text))
+                retry.append(j)
+            else:
+                hyps[j] = text
+        todo = retry
+        if not todo:
+            break
+    for j in todo:
+        hyps[j] = max(attempts[j], key=lambda attempt: attempt[0])[1]
+    return [" ".join(hyp.split()) for hyp in hyps]
+
+
+def evict_encoder_cache(encoder_cache: str, max_bytes: int) -> int:
+    """
+    Remove the least recently used encoder outputs until the cache fits in
+    `max_bytes`. Returns how many were removed.
+    """
+    entries = []
+    for entry in os.scandir(encoder_cache):
+        if entry.name.endswith(".npy") and entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+        removed += 1
+    return removed
+
+
+def sweep_decoding(
+    data_path: str,
+    output_dir: str,
+    whisper_model: str,
+    configs: list,
+    device: str = "cpu",
+    compute_type: str = "int8",
+    batch_size: int = 16,
+    language: str = None,
+    encoder_cache: str = None,
+    encoder_cache_bytes: int = ENCODER_CACHE_BYTES,
+) -> list:
+    """
+    Transcribe a split with several decoding configurations, encoding each
+    segment once, and score the results.
+
+    Parameters:
+    - data_path (str): Path to a `.trans` file, e.g. segmented/dev.trans.
+    - output_dir (str): Folder for the hypothesis files, `<name>.hyp` per
+      configuration, and `sweep.json` with the scores.
+    - whisper_model (str): Path to the pretrained Faster-Whisper model.
+    - configs (list): Decoding configurations, see `decoding_config`.
+    - device (str, optional): Device to which the model is sent. Defaults to 'cpu'.
+    - compute_type (str, optional): Type of computation to be performed. Defaults to 'int8'.
+    - batch_size (int, optional): Number of segments encoded at a time. Defaults to 16.
+    - language (str, optional): Language of the segments, detected if None.
+    - encoder_cache (str, optional): Folder to store encoder outputs in, so
+      later sweeps with the same model skip the encoder. They are stored in
+      float16, and decoded from float16 whether cached or not, so results
+      don't depend on what was cached. Not used if None.
+    - encoder_cache_bytes (int, optional): Size limit of the encoder cache, the
+      least recently used outputs are removed at the end of the sweep beyond
+      it. Defaults to `ENCODER_CACHE_BYTES`, 8 GiB.
+
+    Returns:
+    - list: The configurations with their WER, CER and decoding time.
+    """
+
+    names = [config["name"] for config in configs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Configuration names must be unique: {names}")
+    os.makedirs(output_dir, exist_ok=True)
+    audio_files = [x.split("\t") for x in open(data_path)]
+
+    model_digest = None
+    if encoder_cache:
+        os.makedirs(encoder_cache, exist_ok=True)
+        with DigestCache() as digests:
+            model_digest = digests.model_digest(whisper_model)
+
+    start = time.monotonic()
+    model = WhisperModel(whisper_model, device=device, compute_type=compute_type)
+    load_time = time.monotonic() - start
+
+    writers = {
+        config["name"]: HypothesisWriter(
+            os.path.join(output_dir, config["name"] + ".hyp")
+        )
+        for config in configs
+    }
+    timer = StageTimer()
+    reader = SegmentReader(load_segment_table(data_path))
+    with reader, AudioPrefetcher(
+        audio_files,
+        resolve=lambda item: reader.resolve(item[0]),
+        sampling_rate=model.feature_extractor.sampling_rate,
+        depth=2 * batch_size,
+    ) as prefetcher:
+        prefetched = iter(prefetcher)
+        while True:
+            batch = list(itertools.islice(prefetched, batch_size))
+            if not batch:
+                break
+
+            with timer.stage("encode"):
+                outputs = [None] * len(batch)
+                paths = [None] * len(batch)
+                if encoder_cache:
+                    for i, (_, audio) in enumerate(batch):
+                        key = hashlib.sha256(audio.tobytes())
+                        key.update(
+                            f"{model_digest}:{device}:{compute_type}:float16".encode()
+                        )
+                        paths[i] = os.path.join(encoder_cache, key.hexdigest() + ".npy")
+                        if os.path.exists(paths[i]):
+                            outputs[i] = np.load(paths[i])
+                            # Marks it as recently used for eviction.
+                            os.utime(paths[i])
+                            timer.count("cached")
+                missing = [i for i, output in enumerate(outputs) if output is None]
+                if missing:
+                    encoded = encode_segments(model, [batch[i][1] for i in missing])
+                    if encoded.device != "cpu":
+                        encoded = encoded.to_device(ctranslate2.Device.cpu)
+                    encoded = np.array(encoded)
+                    for i, output in zip(missing, encoded):
+                        outputs[i] = output
+                        if encoder_cache:
+                            outputs[i] = output.astype(np.float16)
+                            np.save(paths[i] + ".tmp.npy", outputs[i])
+                            os.replace(paths[i] + ".tmp.npy", paths[i])
+                    timer.count("encoded", len(missing))
+                encoder_output = np.stack(outputs).astype(np.float32)
+
+            with timer.stage("language"):
+                languages = segment_languages(
+                    model,
+                    ctranslate2.StorageView.from_array(encoder_output),
+                    language,
+                )
+
+            for config in configs:
+                with timer.stage(config["name"]):
+                    hyps = decode_with_fallback(
+                        model, encoder_output, languages, config
+                    )
+                for ((wav_file, transcript), _), hyp in zip(batch, hyps):
+                    wav_id = os.path.basename(wav_file).rstrip(".wav")
+                    writers[config["name"]].write(wav_id, transcript.rstrip(), hyp)
+    for writer in writers.values():
+        writer.close()
+    if encoder_cache:
+        evicted = evict_encoder_cache(encoder_cache, encoder_cache_bytes)
+        if evicted:
+            print(f"Removed {evicted} encoder outputs from {encoder_cache}")
+
+    summary = timer.summary()
+    results = []
+    for config in configs:
+        hyp_file = writers[config["name"]].path
+        scores = score_file(hyp_file)
+        results.append(
+            dict(
+                config,
+                hyp_file=hyp_file,
+                wer=scores.wer(),
+                cer=scores.cer(),
+                decode_time=summary["stages"].get(config["name"], 0.0),
+            )
+        )
+
+    with open(os.path.join(output_dir, "sweep.json"), "w") as f:
+        json.dump(
+            {
+                "data_path": data_path,
+                "whisper_model": whisper_model,
+                "model_load_time": round(load_time, 3),
+                "encode_time": summary["stages"].get("encode", 0.0),
+                "encoded": summary.get("encoded", 0),
+                "cached": summary.get("cached", 0),
+                "results": results,
+            },
+            f,
+            indent=4,
+        )
+
+    print(f"Encoder: {summary['stages'].get('encode', 0.0):.1f}s")
+    print("name\twer\tcer\tdecode_time")
+    for r in results:
+        print(f"{r['name']}\t{r['wer']}\t{r['cer']}\t{r['decode_time']:.1f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score decoding configurations, encoding every segment once."
+    )
+    parser.add_argument("data_path", help="A .trans file, e.g. segmented/dev.trans")
+    parser.add_argument("whisper_model")
+    parser.add_argument("--output-dir", default="results/sweep")
+    parser.add_argument("--beam-sizes", type=int, nargs="+", default=[5, 8])
+    parser.add_argument("--length-penalties", type=float, nargs="+", default=[1.0])
+    parser.add_argument(
+        "--temperatures",
+        nargs="+",
+        default=["0"],
+        help="Comma separated fallback temperatures, e.g. 0 0,0.2,0.4,0.6,0.8,1.0",
+    )
+    parser.add_argument("--best-of", type=int, default=5)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--compute-type", default="int8")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--language", default=None)
+    parser.add_argument("--encoder-cache", default=None)
+    parser.add_argument(
+        "--encoder-cache-gb",
+        type=float,
+        default=ENCODER_CACHE_BYTES / (1 << 30),
+        help="Size limit of the encoder cache in GiB",
+    )
+    args = parser.parse_args()
+
+    configs = [
+        decoding_config(
+            beam_size,
+            length_penalty,
+            [float(t) for t in temperatures.split(",")],
+            args.best_of,
+        )
+        for beam_size in args.beam_sizes
+        for length_penalty in args.length_penalties
+        for temperatures in args.temperatures
+    ]
+    sweep_decoding(
+        args.data_path,
+        args.output_dir,
+        args.whisper_model,
+        configs,
+        device=args.device,
+        compute_type=args.compute_type,
+        batch_size=args.batch_size,
+        language=args.language,
+        encoder_cache=args.encoder_cache,
+        encoder_cache_bytes=int(args.encoder_cache_gb * (1 << 30)),
+    )
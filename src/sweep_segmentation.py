@@ -0,0 +1,439 @@
+########################################################################
+
+# Author   : David Erik Mollberg & Carlos Daniel Hernández Mena
+# Date     : November 1st, 2023
+# Location : Reykjavík University and Tiro ehf.
+
+# Parameter sweep for the segmentation. The word timestamps of the whole
+# corpus are loaded once into NumPy arrays and a grid of minimum and
+# maximum segment durations and end paddings is evaluated without cutting
+# any audio. For each setting the number of segments, a histogram of
+# their durations, the fraction of transcribed audio that is discarded
+# and the totals of each split are reported.
+#
+# Usage: python -m src.sweep_segmentation --min-durations 1 2 3 \
+#            --max-durations 15 20 30 --paddings 0 0.25 0.5 --output sweep.json
+#        python -m src.sweep_segmentation --check --min-durations 2 --max-durations 20
+
+########################################################################
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from src.segment import (
+    SENTENCE_END,
+    compile_files,
+    load_transcript_columns,
+    open_splits_files,
+    plan_segments,
+)
+from src.wordstore import WORD_STORE
+
+
+class Corpus:
+    """
+    Word timestamps of all recordings as flat arrays.
+
+    Words of recording `r` are `first[r]:last[r]`. `is_end` marks the last
+    word of a sentence, `has_text` words with a non-empty normalized form.
+    """
+
+    def __init__(self, transcript_files: list, splits: list, word_store: str = None):
+        starts, ends, is_end, has_text, counts = [], [], [], [], []
+        for transcript_file in transcript_files:
+            columns = load_transcript_columns(transcript_file, word_store)
+            starts.append(np.asarray(columns.start, dtype=np.float64))
+            ends.append(np.asarray(columns.end, dtype=np.float64))
+            is_end.append(
+                np.fromiter(
+                    (w[-1:] in SENTENCE_END for w in columns.word),
+                    bool,
+                    len(columns.word),
+                )
+            )
+            has_text.append(
+                np.fromiter(
+                    (bool(w.strip()) for w in columns.norm_word),
+                    bool,
+                    len(columns.norm_word),
+                )
+            )
+            counts.append(len(columns.word))
+
+        self.recordings = list(transcript_files)
+        self.word_store = word_store
+        self.split = np.asarray(splits)
+        self.start = np.concatenate(starts) if starts else np.zeros(0)
+        self.end = np.concatenate(ends) if ends else np.zeros(0)
+        self.is_end = np.concatenate(is_end) if is_end else np.zeros(0, bool)
+        self.has_text = np.concatenate(has_text) if has_text else np.zeros(0, bool)
+        self.last = np.cumsum(counts, dtype=np.int64)
+        self.first = self.last - np.asarray(counts, dtype=np.int64)
+        self.recording = np.repeat(np.arange(len(counts)), counts)
+
+    @classmethod
+    def load(cls, splits_folder: str, word_store: str = None) -> "Corpus":
+        """
+        Load every recording that `run_segmentation` would segment.
+
+        Parameters:
+        - splits_folder (str): Folder containing split information.
+        - word_store (str): Optional path to a word store to read transcripts from.
+
+        Returns:
+        - Corpus: The word timestamps of the corpus.
+        """
+        fileId2split = open_splits_files(splits_folder)
+        audio_files = compile_files()
+        splits = [fileId2split[os.path.basename(f).rstrip(".wav")] for f in audio_files]
+        transcripts = [f.replace(".wav", ".json") for f in audio_files]
+        return cls(transcripts, splits, word_store)
+
+
+def round2(x: np.ndarray) -> np.ndarray:
+    """
+    Round to two decimals as Python's `round` does, which `src.segment` uses.
+    `np.round` can round the other way when a value is within a hair of a tie.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    rounded = np.round(x, 2)
+    scaled = x * 100
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    rounded[near_tie] = [round(v, 2) for v in x[near_tie].tolist()]
+    return rounded
+
+
+def bisect_right(a: np.ndarray, x: np.ndarray, lo: np.ndarray, hi: np.ndarray):
+    """
+    `bisect.bisect_right(a, x[i], lo[i], hi[i])` for every i at once, with the
+    same steps, so the results are the same even where `a` isn't sorted.
+    """
+    lo, hi = lo.copy(), hi.copy()
+    while True:
+        active = lo < hi
+        if not active.any():
+            return lo
+        mid = (lo + hi) // 2
+        left = active & (x < a[np.where(active, mid, 0)])
+        hi = np.where(left, mid, hi)
+        lo = np.where(active & ~left, mid + 1, lo)
+
+
+def pad_ends(corpus: Corpus, padding: float = 0.5) -> np.ndarray:
+    """
+    Pad the end of the last word of every sentence, as `add_padding` does with
+    0.5 seconds, for any amount of padding.
+
+    Parameters:
+    - corpus (Corpus): The corpus.
+    - padding (float): Seconds to add where the gap to the next word allows it.
+      0 leaves the end times as they are.
+
+    Returns:
+    - np.ndarray: End time of each word after padding.
+    """
+
+    ends = corpus.end.copy()
+    if padding <= 0:
+        return ends
+    last_words = corpus.last - 1
+    has_next = np.ones(len(ends), bool)
+    has_next[last_words[corpus.last > corpus.first]] = False
+    idx = np.flatnonzero(corpus.is_end & has_next)
+    curr_end, next_end = ends[idx], ends[idx + 1]
+    # The same operations in the same order as add_padding, for equal results.
+    shortened = curr_end + next_end - curr_end - 0.1
+    ends[idx] = np.where(
+        next_end - curr_end > padding,
+        curr_end + padding,
+        np.where(shortened < next_end, shortened, curr_end + next_end - curr_end),
+    )
+    return ends
+
+
+def sentence_ranges(corpus: Corpus) -> tuple:
+    """
+    Word index ranges of all sentences in the corpus, as `src.segment.sentence_ranges`.
+
+    Returns:
+    - tuple: Arrays of the first and last (exclusive) word of each sentence.
+    """
+
+    boundary = corpus.is_end.copy()
+    nonempty = corpus.last > corpus.first
+    boundary[corpus.last[nonempty] - 1] = True
+    # The last word of a recording always ends a sentence, so sentences never
+    # span two recordings.
+    last = np.flatnonzero(boundary) + 1
+    first = np.concatenate([[0], last[:-1]])
+    return first, last
+
+
+def split_long_ranges(
+    corpus: Corpus, first: np.ndarray, last: np.ndarray, ends: np.ndarray, max_duration
+) -> tuple:
+    """
+    Halve every range longer than `max_duration` until all are short enough,
+    as `src.segment.split_long_ranges` does, one level of halving at a time
+    for all ranges at once.
+
+    Returns:
+    - tuple: Arrays of the first and last word of each range, in order.
+    """
+
+    done_first, done_last = [], []
+    while len(first):
+        duration = round2(ends[last - 1] - corpus.start[first])
+        long = duration > max_duration
+        middle_timestamp = corpus.start[first] + duration / 2
+        # The padded last word always ends after the middle of the range.
+        middle = bisect_right(ends, middle_timestamp, first, last - 1)
+        # A single word longer than half the range can't be split.
+        long &= middle > first
+
+        done_first.append(first[~long])
+        done_last.append(last[~long])
+        first = np.concatenate([first[long], middle[long]])
+        last = np.concatenate([middle[long], last[long]])
+
+    first = np.concatenate(done_first)
+    last = np.concatenate(done_last)
+    order = np.argsort(first, kind="stable")
+    return first[order], last[order]
+
+
+def merge_ranges(
+    corpus: Corpus, first: np.ndarray, last: np.ndarray, ends: np.ndarray, max_duration
+) -> tuple:
+    """
+    Combine consecutive ranges up to `max_duration` as `src.segment.merge_ranges`
+    does. Every recording is merged at the same time, one segment per step.
+
+    Returns:
+    - tuple: Arrays of the first and last word of each merged range.
+    """
+
+    if not len(first):
+        return first, last
+    recording = corpus.recording[first]
+    range_end = ends[last - 1]
+    bounds = np.searchsorted(recording, np.arange(len(corpus.first) + 1))
+    # The maximum of range_end over the 2**k ranges from each one on.
+    maxima = [range_end]
+    while 1 << len(maxima) <= len(range_end):
+        step = 1 << (len(maxima) - 1)
+        maxima.append(np.maximum(maxima[-1][:-step], maxima[-1][step:]))
+
+    merged_first, merged_last = [], []
+    current = bounds[:-1][bounds[:-1] < bounds[1:]]
+    while len(current):
+        # The merged range ends before the first range of the recording that
+        # ends too late. The rounded duration only grows with the end time,
+        # so whole blocks of ranges that end early enough are skipped at once.
+        start = corpus.start[first[current]]
+        bound = bounds[recording[current] + 1]
+        stop = current + 1
+        for k in reversed(range(len(maxima))):
+            fits = stop + (1 << k) <= bound
+            block_end = maxima[k][np.where(fits, stop, 0)]
+            fits &= round2(block_end - start) <= max_duration
+            stop = np.where(fits, stop + (1 << k), stop)
+        merged_first.append(first[current])
+        merged_last.append(last[stop - 1])
+        current = stop[stop < bound]
+
+    merged_first = np.concatenate(merged_first)
+    merged_last = np.concatenate(merged_last)
+    order = np.argsort(merged_first, kind="stable")
+    return merged_first[order], merged_last[order]
+
+
+def plan_ranges(corpus: Corpus, ends: np.ndarray, max_duration) -> tuple:
+    """
+    Word ranges of the segments of the whole corpus, before the minimum
+    duration and empty text filter of `src.segment.plan_segments`.
+
+    Parameters:
+    - corpus (Corpus): The corpus.
+    - ends (np.ndarray): Padded end times, see `pad_ends`.
+    - max_duration (float): Maximum segment duration, in seconds.
+
+    Returns:
+    - tuple: Arrays of the first and last word of each segment, and its duration.
+    """
+
+    first, last = sentence_ranges(corpus)
+    first, last = split_long_ranges(corpus, first, last, ends, max_duration)
+    first, last = merge_ranges(corpus, first, last, ends, max_duration)
+    return first, last, round2(ends[last - 1] - corpus.start[first])
+
+
+def check_plan(corpus: Corpus, min_duration: float = 2, max_duration: float = 20):
+    """
+    Check that the sweep plans the same segments as `src.segment.plan_segments`
+    with the 0.5 seconds of padding that `run_segmentation` uses, recording by
+    recording. Raises an AssertionError at the first recording that differs.
+
+    Returns:
+    - int: Number of segments, the same for both.
+    """
+
+    has_text = np.concatenate([[0], np.cumsum(corpus.has_text)])
+    ends = pad_ends(corpus, 0.5)
+    first, last, duration = plan_ranges(corpus, ends, max_duration)
+    kept = (has_text[last] > has_text[first]) & (duration >= min_duration)
+    first, last = first[kept], last[kept]
+    recording = corpus.recording[first]
+    for r, transcript_file in enumerate(corpus.recordings):
+        columns = load_transcript_columns(transcript_file, corpus.word_store)
+        planned = [
+            (seg["start"], seg["end"])
+            for seg in plan_segments(
+                columns.word,
+                columns.norm_word,
+                columns.start,
+                columns.end,
+                min_duration,
+                max_duration,
+            )
+        ]
+        swept = [
+            (float(corpus.start[i]), float(ends[j - 1]))
+            for i, j in zip(first[recording == r], last[recording == r])
+        ]
+        assert swept == planned, (
+            f"{transcript_file}: {len(swept)} segments in the sweep,"
+            f" {len(planned)} from plan_segments"
+        )
+    return len(first)
+
+
+def sweep(
+    corpus: Corpus,
+    min_durations: list,
+    max_durations: list,
+    paddings: list,
+    bin_width: float = 1.0,
+) -> list:
+    """
+    Evaluate every combination of segmentation parameters.
+
+    Segments are planned once per maximum duration and padding, after which
+    every minimum duration only needs a different filter.
+
+    Parameters:
+    - corpus (Corpus): The corpus.
+    - min_durations (list): Minimum segment durations, in seconds.
+    - max_durations (list): Maximum segment durations, in seconds.
+    - paddings (list): Seconds of padding at the end of sentences.
+    - bin_width (float): Width of the duration histogram bins in seconds.
+
+    Returns:
+    - list: One dict of statistics per combination.
+    """
+
+    has_text = np.concatenate([[0], np.cumsum(corpus.has_text)])
+    results = []
+    for padding in paddings:
+        ends = pad_ends(corpus, padding)
+        for max_duration in max_durations:
+            first, last, duration = plan_ranges(corpus, ends, max_duration)
+            text = has_text[last] > has_text[first]
+            split = corpus.split[corpus.recording[first]]
+            total = float(duration.sum())
+            bins = np.arange(0, max(duration.max(initial=0), max_duration), bin_width)
+            bins = np.append(bins, bins[-1] + bin_width)
+
+            for min_duration in min_durations:
+                kept = text & (duration >= min_duration)
+                counts, edges = np.histogram(duration[kept], bins=bins)
+                kept_seconds = float(duration[kept].sum())
+                results.append(
+                    {
+                        "min_duration": min_duration,
+                        "max_duration": max_duration,
+                        "padding": padding,
+                        "segments": int(kept.sum()),
+                        "hours": round(kept_seconds / 3600, 3),
+                        "discarded_fraction": (
+                            round(1 - kept_seconds / total, 4) if total else 0.0
+                        ),
+                        "histogram": {
+                            "edges": [round(float(e), 3) for e in edges],
+                            "counts": counts.tolist(),
+                        },
+                        "splits": {
+                            s: {
+                                "segments": int((kept & (split == s)).sum()),
+                                "hours": round(
+                                    float(duration[kept & (split == s)].sum()) / 3600,
+                                    3,
+                                ),
+                            }
+                            for s in ["train", "dev", "test"]
+                        },
+                    }
+                )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Sweep segmentation parameters without cutting any audio."
+    )
+    parser.add_argument("--splits-folder", default="splits")
+    parser.add_argument("--min-durations", type=float, nargs="+", default=[1, 2, 3])
+    parser.add_argument(
+        "--max-durations", type=float, nargs="+", default=[10, 15, 20, 25, 30]
+    )
+    parser.add_argument(
+        "--paddings",
+        type=float,
+        nargs="+",
+        default=[0, 0.25, 0.5],
+        help="Seconds of padding at sentence ends, 0.5 is what run_segmentation uses",
+    )
+    parser.add_argument("--bin-width", type=float, default=1.0)
+    parser.add_argument("--word-store", default=WORD_STORE)
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Check that the sweep plans the same segments as plan_segments",
+    )
+    args = parser.parse_args()
+
+    corpus = Corpus.load(args.splits_folder, args.word_store)
+    if args.check:
+        for max_duration in args.max_durations:
+            for min_duration in args.min_durations:
+                segments = check_plan(corpus, min_duration, max_duration)
+                print(
+                    f"min {min_duration} max {max_duration}: {segments} segments match"
+                )
+    results = sweep(
+        corpus, args.min_durations, args.max_durations, args.paddings, args.bin_width
+    )
+    print("min\tmax\tpadding\tsegments\thours\tdiscarded\ttrain\tdev\ttest")
+    for r in results:
+        print(
+            "\t".join(
+                str(x)
+                for x in [
+                    r["min_duration"],
+                    r["max_duration"],
+                    r["padding"],
+                    r["segments"],
+                    r["hours"],
+                    r["discarded_fraction"],
+                ]
+                + [r["splits"][s]["hours"] for s in ["train", "dev", "test"]]
+            )
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
@@ -13,11 +13,314 @@
 
 import os
 import re
-from multiprocessing import Manager, Process
+import threading
+import time
+from multiprocessing import Process, Queue, current_process
+from queue import Empty
 
+import ctranslate2
+import numpy as np
 from faster_whisper import WhisperModel
+from faster_whisper.tokenizer import Tokenizer
+from faster_whisper.transcribe import get_compression_ratio, get_suppressed_tokens
 from tqdm import tqdm
 
+from src.audio import AudioPrefetcher, SegmentReader, load_segment_table
+from src.digests import DigestCache, audio_digest
+from src.transcription_cache import TranscriptionCache
+
+# Decoding options of `transcribe_file` and of the workers of
+# `transcribe_file_parallel`. They are part of the cache keys too, so
+# hypotheses decoded with other options are never taken from the cache.
+DECODE_OPTIONS = dict(beam_size=8)
+PARALLEL_DECODE_OPTIONS = dict(
+    beam_size=5,
+    vad_filter=True,
+    vad_parameters=dict(min_silence_duration_ms=1000),
+)
+
+
+def segment_durations(data_path: str) -> dict:
+    """
+    Read the duration of each segment from the `.info` file next to a `.trans` file.
+
+    Parameters:
+    - data_path (str): Path to the `.trans` file.
+
+    Returns:
+    - dict: Mapping from segment id to duration in seconds. Empty if there is
+      no `.info` file.
+    """
+
+    info_path = data_path.replace(".trans", ".info")
+    if info_path == data_path or not os.path.exists(info_path):
+        return {}
+    durations = {}
+    with open(info_path) as f:
+        next(f)
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            durations[fields[1]] = float(fields[4])
+    return durations
+
+
+def encode_segments(model: WhisperModel, audio: list) -> ctranslate2.StorageView:
+    """
+    Run short segments through the encoder as one batch.
+
+    The log-Mel features of all segments are padded to one 30 second window
+    and stacked. Every segment must fit in the window, which holds for the
+    output of `run_segmentation`.
+
+    Parameters:
+    - model (WhisperModel): The Faster-Whisper model.
+    - audio (list): 16 kHz audio of each segment as float32 arrays.
+
+    Returns:
+    - ctranslate2.StorageView: The encoder output of the batch.
+    """
+
+    n_frames = model.feature_extractor.nb_max_frames
+    features = []
+    for samples in audio:
+        mel = model.feature_extractor(samples)[:, :n_frames]
+        features.append(np.pad(mel, ((0, 0), (0, n_frames - mel.shape[-1]))))
+    features = ctranslate2.StorageView.from_array(
+        np.ascontiguousarray(np.stack(features), dtype=np.float32)
+    )
+    return model.model.encode(features)
+
+
+def segment_languages(
+    model: WhisperModel, encoder_output: ctranslate2.StorageView, language: str = None
+) -> list:
+    """The language of each segment of a batch, detected if `language` is None."""
+    if language is not None:
+        return [language] * encoder_output.shape[0]
+    return [
+        result[0][0][2:-2] for result in model.model.detect_language(encoder_output)
+    ]
+
+
+def decode_segments(
+    model: WhisperModel,
+    encoder_output: ctranslate2.StorageView,
+    languages: list,
+    beam_size: int = 8,
+    length_penalty: float = 1.0,
+    temperature: float = 0.0,
+    best_of: int = 5,
+) -> list:
+    """
+    Decode a batch of encoder outputs without timestamps.
+
+    With a temperature above 0, `best_of` hypotheses are sampled instead of
+    using beam search and the one with the highest score is kept, as
+    Faster-Whisper does in its temperature fallback.
+
+    Parameters:
+    - model (WhisperModel): The Faster-Whisper model.
+    - encoder_output (ctranslate2.StorageView): Output of `encode_segments`.
+    - languages (list): Language of each segment.
+    - beam_size (int): Beam size. Defaults to 8.
+    - length_penalty (float): Exponential length penalty. Defaults to 1.0.
+    - temperature (float): Sampling temperature, 0 for beam search. Defaults to 0.
+    - best_of (int): Number of hypotheses sampled when temperature is above 0.
+
+    Returns:
+    - list: (hypothesis, average log probability, compression ratio) of each segment.
+    """
+
+    tokenizers = {
+        lang: Tokenizer(
+            model.hf_tokenizer,
+            model.model.is_multilingual,
+            task="transcribe",
+            language=lang,
+        )
+        for lang in set(languages)
+    }
+    prompts = [
+        model.get_prompt(tokenizers[lang], [], without_timestamps=True)
+        for lang in languages
+    ]
+    if temperature > 0:
+        options = dict(
+            beam_size=1,
+            num_hypotheses=best_of,
+            sampling_topk=0,
+            sampling_temperature=temperature,
+        )
+    else:
+        options = dict(beam_size=beam_size)
+    results = model.model.generate(
+        encoder_output,
+        prompts,
+        length_penalty=length_penalty,
+        max_length=448,
+        return_scores=True,
+        suppress_blank=True,
+        suppress_tokens=get_suppressed_tokens(tokenizers[languages[0]], [-1]),
+        **options,
+    )
+
+    decoded = []
+    for lang, result in zip(languages, results):
+        best = max(range(len(result.sequences_ids)), key=lambda i: result.scores[i])
+        tokens = result.sequences_ids[best]
+        # The score is normalized by the length penalty, as in Faster-Whisper.
+        cum_logprob = result.scores[best] * (len(tokens) ** length_penalty)
+        text = tokenizers[lang].decode(tokens)
+        decoded.append(
+            (text, cum_logprob / (len(tokens) + 1), get_compression_ratio(text))
+        )
+    return decoded
+
+
+def transcribe_segments(
+    model: WhisperModel, audio: list, beam_size: int = 8, language: str = None
+) -> list:
+    """
+    Transcribe short segments as one batch.
+
+    The segments are run through the encoder in a single call and decoded
+    together with beam search, see `encode_segments` and `decode_segments`,
+    instead of one `model.transcribe` call per segment. Timestamps and
+    temperature fallback are not used.
+
+    Parameters:
+    - model (WhisperModel): The Faster-Whisper model.
+    - audio (list): 16 kHz audio of each segment as float32 arrays.
+    - beam_size (int): Beam size. Defaults to 8.
+    - language (str, optional): Language code, detected for each segment if None.
+
+    Returns:
+    - list: The hypothesis of each segment, in the same order.
+    """
+
+    encoder_output = encode_segments(model, audio)
+    languages = segment_languages(model, encoder_output, language)
+    return [
+        text
+        for text, _, _ in decode_segments(model, encoder_output, languages, beam_size)
+    ]
+
+
+class HypothesisWriter:
+    """
+    Appends `wav_id\tref\thyp` lines to a hypothesis file as results come in.
+
+    Every line is flushed when written and the file is synced to disk at most
+    every `fsync_interval` seconds and when closed, so an interrupted run loses
+    little. With `resume=True` an existing file is kept, apart from a last line
+    that was cut off, and `done` holds the wav_ids that are already in it.
+    """
+
+    def __init__(self, hyp_output: str, resume: bool = False, fsync_interval=30.0):
+        self.path = hyp_output
+        self.fsync_interval = fsync_interval
+        self.done = set()
+        if resume and os.path.exists(hyp_output):
+            with open(hyp_output, "rb+") as f:
+                data = f.read()
+                complete = data.rfind(b"\n") + 1
+                f.truncate(complete)
+            for line in data[:complete].decode("utf-8").splitlines():
+                self.done.add(line.split("\t")[0])
+            self._file = open(hyp_output, "a")
+        else:
+            self._file = open(hyp_output, "w")
+        self._last_sync = time.monotonic()
+
+    def write(self, wav_id: str, transcript: str, hyp: str):
+        self._file.write(f"{wav_id}\t{transcript}\t{hyp}\n")
+        self._file.flush()
+        self.done.add(wav_id)
+        if time.monotonic() - self._last_sync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_sync = time.monotonic()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def reorder_hypotheses(hyp_output: str, audio_files: list) -> None:
+    """
+    Sort a hypothesis file in the order of the `.trans` file it was decoded from.
+
+    Lines of wav_ids that aren't in `audio_files` are kept at the end and
+    repeated wav_ids, from a run that was resumed, are written once.
+
+    Parameters:
+    - hyp_output (str): Path to the hypothesis file.
+    - audio_files (list): Audio file paths and their transcriptions, in order.
+    """
+
+    lines = {}
+    with open(hyp_output) as f:
+        for line in f:
+            lines.setdefault(line.split("\t")[0], line)
+    with open(hyp_output + ".tmp", "w") as f_out:
+        for wav_file, _ in audio_files:
+            line = lines.pop(os.path.basename(wav_file).rstrip(".wav"), None)
+            if line is not None:
+                f_out.write(line)
+        f_out.writelines(lines.values())
+        f_out.flush()
+        os.fsync(f_out.fileno())
+    os.replace(hyp_output + ".tmp", hyp_output)
+
+
+def lookup_cache(
+    cache: TranscriptionCache,
+    reader: SegmentReader,
+    audio_files: list,
+    writer: HypothesisWriter,
+    whisper_model: str,
+    params: dict,
+) -> tuple:
+    """
+    Write the hypotheses of files that are in the cache.
+
+    Parameters:
+    - cache (TranscriptionCache): The cache.
+    - reader (SegmentReader): Reader for virtual and sharded segments.
+    - audio_files (list): Audio file paths and their transcriptions.
+    - writer (HypothesisWriter): Writer of the hypothesis file.
+    - whisper_model (str): Path to the pretrained Faster-Whisper model.
+    - params (dict): Decoding parameters that affect the hypotheses.
+
+    Returns:
+    - Tuple[list, dict]: The files that still need to be transcribed and the
+      cache key of each of them, by wav_id.
+    """
+
+    todo, keys = [], {}
+    with DigestCache() as digests:
+        model_digest = digests.model_digest(whisper_model)
+        audio_digests = [
+            audio_digest(reader, wav_file, digests) for wav_file, _ in audio_files
+        ]
+    for (wav_file, transcript), digest in zip(audio_files, audio_digests):
+        wav_id = os.path.basename(wav_file).rstrip(".wav")
+        key = cache.key(digest, model_digest, params)
+        hyp = cache.get(key)
+        if hyp is None:
+            todo.append((wav_file, transcript))
+            keys[wav_id] = key
+        else:
+            writer.write(wav_id, transcript.rstrip(), hyp)
+    return todo, keys
+
 
 def transcribe_file(
     data_path: str,
@@ -25,63 +328,329 @@ def transcribe_file(
     whisper_model: str,
     device: str = "cpu",
     compute_type: str = "int8",
-) -> None:
+    batch_size: int = 1,
+    language: str = None,
+    cpu_threads: int = 0,
+    resume: bool = False,
+    prefetch: int = 8,
+    cache: str = None,
+    server: str = None,
+) -> dict:
     """
     Transcribes audio files using Faster-Whisper.
 
+    With `batch_size` above 1 the segments are sorted by duration, using the
+    `.info` file next to `data_path`, and transcribed in batches of similar
+    length with `transcribe_segments`. Results are written to `hyp_output` as
+    they are ready and put in the order of `data_path` at the end. Audio is
+    read and decoded on a background thread, see `src.audio.AudioPrefetcher`,
+    while the model transcribes. With `cache` set, files that were transcribed
+    before with the same audio, model and parameters are taken from the cache,
+    see `src.transcription_cache`, and the model is only loaded if needed.
+    With `server` set the segments are sent to a `src.serve` server, which
+    already has the model loaded, instead. The model, device, compute type
+    and decoding of the server are used then: with its `--max-batch-size 1`
+    the segments are decoded as they are here with `batch_size` 1, otherwise
+    in batches without temperature fallback, as with `batch_size` above 1.
+
     Parameters:
     - data_path (str): Path to the input data file containing paths to audio files and their transcriptions.
     - hyp_output (str): Path to the output file where transcriptions will be written.
     - whisper_model (str): Path to the pretrained Faster-Whisper model.
     - device (str, optional): Device to which the model is sent. Defaults to 'cpu'.
     - compute_type (str, optional): Type of computation to be performed. Defaults to 'int8'.
+    - batch_size (int, optional): Number of segments to transcribe at a time. Defaults to 1.
+    - language (str, optional): Language of the segments in batched mode, detected if None.
+    - cpu_threads (int, optional): Threads to use on CPU, 0 for the CTranslate2 default.
+    - resume (bool, optional): Whether to keep the results in an existing `hyp_output`
+      and only transcribe the files that are missing. Defaults to False.
+    - prefetch (int, optional): Number of files to decode ahead, at least two
+      batches in batched mode. Defaults to 8.
+    - cache (str, optional): Path to a transcription cache, e.g.
+      `src.transcription_cache.TRANSCRIPTION_CACHE`. Not used if None.
+    - server (str, optional): Address of a transcription server, "host:port" or
+      a Unix socket, see `src.serve`. `prefetch` requests are sent at a time.
+      `device`, `compute_type`, `batch_size`, `language` and `cpu_threads` are
+      set by the server and can't be passed with it.
+
+    Returns:
+    - dict: Model load time and the decoding time of each file transcribed,
+      in batched mode the time of its batch and with a server that of its request.
     """
 
-    model = WhisperModel(whisper_model, device=device, compute_type=compute_type)
     audio_files = [x.split("\t") for x in open(data_path)]
-    with open(hyp_output, "w") as f_out:
-        for wav_file, transcript in tqdm(audio_files, total=len(audio_files)):
-            wav_id = os.path.basename(wav_file).rstrip(".wav")
-            hyp = ""
-            segments, _ = model.transcribe(wav_file, beam_size=8)
-            for segment in segments:
-                hyp += segment.text + " "
-            hyp = re.sub("\s+", " ", hyp).strip().rstrip()
-            f_out.write(f"{wav_id}\t{transcript.rstrip()}\t{hyp}\n")
+    if server:
+        local = dict(
+            device=(device, "cpu"),
+            compute_type=(compute_type, "int8"),
+            batch_size=(batch_size, 1),
+            language=(language, None),
+            cpu_threads=(cpu_threads, 0),
+        )
+        passed = [name for name, (value, default) in local.items() if value != default]
+        if passed:
+            raise ValueError(
+                f"{', '.join(passed)} can't be used with server={server}, they are"
+                " set when the server is started, see src.serve"
+            )
+        from src.serve import TranscriptionClient, transcribe_remote
+
+        client = TranscriptionClient(server)
+    cache = TranscriptionCache(cache) if cache else None
+    try:
+        keys = {}
+        reader = SegmentReader(load_segment_table(data_path))
+        with HypothesisWriter(hyp_output, resume=resume) as writer, reader:
+            todo = [
+                (wav_file, transcript)
+                for wav_file, transcript in audio_files
+                if os.path.basename(wav_file).rstrip(".wav") not in writer.done
+            ]
+            if writer.done:
+                print(f"Resuming {hyp_output}, {len(todo)} files left")
+            if cache is not None:
+                params = {
+                    "device": device,
+                    "compute_type": compute_type,
+                    "batched": batch_size > 1,
+                    "language": language,
+                    **DECODE_OPTIONS,
+                }
+                if server:
+                    params = client.config()
+                    whisper_model = params.pop("model")
+                todo, keys = lookup_cache(
+                    cache, reader, todo, writer, whisper_model, params
+                )
+            stats = {"load_time": 0.0, "latencies": []}
+
+            def emit(wav_id, transcript, hyp):
+                writer.write(wav_id, transcript, hyp)
+                if wav_id in keys:
+                    cache.put(keys[wav_id], hyp)
+
+            if todo and not server:
+                load_start = time.perf_counter()
+                model = WhisperModel(
+                    whisper_model,
+                    device=device,
+                    compute_type=compute_type,
+                    cpu_threads=cpu_threads,
+                )
+                stats["load_time"] = time.perf_counter() - load_start
+            if todo and server:
+                for j, hyp in tqdm(
+                    transcribe_remote(
+                        client, todo, reader, prefetch, stats["latencies"]
+                    ),
+                    total=len(todo),
+                ):
+                    wav_file, transcript = todo[j]
+                    wav_id = os.path.basename(wav_file).rstrip(".wav")
+                    emit(wav_id, transcript.rstrip(), hyp)
+            elif todo and batch_size > 1:
+                for j, hyp in transcribe_sorted(
+                    model,
+                    todo,
+                    reader,
+                    batch_size,
+                    language,
+                    segment_durations(data_path),
+                    max(prefetch, 2 * batch_size),
+                    stats["latencies"],
+                ):
+                    wav_file, transcript = todo[j]
+                    wav_id = os.path.basename(wav_file).rstrip(".wav")
+                    emit(wav_id, transcript.rstrip(), hyp)
+            elif todo:
+                with AudioPrefetcher(
+                    todo,
+                    resolve=lambda item: reader.resolve(item[0]),
+                    sampling_rate=model.feature_extractor.sampling_rate,
+                    depth=prefetch,
+                ) as prefetcher:
+                    for (wav_file, transcript), audio in tqdm(
+                        prefetcher, total=len(todo)
+                    ):
+                        item_start = time.perf_counter()
+                        wav_id = os.path.basename(wav_file).rstrip(".wav")
+                        hyp = ""
+                        segments, _ = model.transcribe(audio, **DECODE_OPTIONS)
+                        for segment in segments:
+                            hyp += segment.text + " "
+                        hyp = re.sub("\s+", " ", hyp).strip().rstrip()
+                        stats["latencies"].append(time.perf_counter() - item_start)
+                        emit(wav_id, transcript.rstrip(), hyp)
+        reorder_hypotheses(hyp_output, audio_files)
+    finally:
+        if cache is not None:
+            print(f"Transcription cache: {cache.stats()}")
+            cache.close()
+    return stats
+
+
+def transcribe_sorted(
+    model: WhisperModel,
+    audio_files: list,
+    reader: SegmentReader,
+    batch_size: int = 16,
+    language: str = None,
+    durations: dict = None,
+    prefetch: int = 32,
+    latencies: list = None,
+):
+    """
+    Transcribe segments in batches of similar duration, longest first.
+
+    The audio of upcoming segments is decoded on a background thread while
+    the current batch is transcribed.
+
+    Parameters:
+    - model (WhisperModel): The Faster-Whisper model.
+    - audio_files (list): Audio file paths and their transcriptions.
+    - reader (SegmentReader): Reader for virtual and sharded segments.
+    - batch_size (int): Number of segments per batch. Defaults to 16.
+    - language (str, optional): Language of the segments, detected if None.
+    - durations (dict, optional): Duration of each segment id, see `segment_durations`.
+    - prefetch (int, optional): Number of segments to decode ahead. Defaults to 32.
+    - latencies (list, optional): Gets the decoding time of the batch of each segment.
+
+    Yields:
+    - Tuple[int, str]: The index in `audio_files` and hypothesis of each segment,
+      a batch at a time.
+    """
+
+    wav_ids = [os.path.basename(wav_file).rstrip(".wav") for wav_file, _ in audio_files]
+    durations = durations or {}
+    order = sorted(range(len(audio_files)), key=lambda i: -durations.get(wav_ids[i], 0))
+    sampling_rate = model.feature_extractor.sampling_rate
+
+    prefetcher = AudioPrefetcher(
+        order,
+        resolve=lambda j: reader.resolve(audio_files[j][0]),
+        sampling_rate=sampling_rate,
+        depth=prefetch,
+    )
+    batch, audio = [], []
+    with tqdm(total=len(audio_files)) as progress, prefetcher:
+        for n, (j, samples) in enumerate(prefetcher, 1):
+            batch.append(j)
+            audio.append(samples)
+            if len(batch) < batch_size and n < len(order):
+                continue
+            batch_start = time.perf_counter()
+            hyps = transcribe_segments(
+                model, audio, DECODE_OPTIONS["beam_size"], language
+            )
+            if latencies is not None:
+                latencies.extend([time.perf_counter() - batch_start] * len(batch))
+            for j, hyp in zip(batch, hyps):
+                yield j, re.sub(r"\s+", " ", hyp).strip()
+            progress.update(len(batch))
+            batch, audio = [], []
 
 
 def transcribe_batch(
-    sub_audio_files: list,
+    sub_audio_files,
     whisper_model: str,
-    results: list,
+    results,
     device: str,
     compute_type: str,
+    segment_table: dict = None,
+    cpu_threads: int = 0,
+    num_workers: int = 1,
+    prefetch: int = 2,
 ) -> None:
     """
     Transcribes a batch of audio files in parallel.
 
+    With `num_workers` above 1 the model is loaded once and that many threads
+    transcribe files concurrently, sharing its weights. Each of them reads and
+    decodes its next `prefetch` files on a background thread, see
+    `src.audio.AudioPrefetcher`, while it transcribes the current one.
+
     Parameters:
-    - sub_audio_files (list): List of audio file paths and their transcriptions.
+    - sub_audio_files (list or Queue): List of audio file paths and their
+      transcriptions, or a queue of them shared by all workers that ends with
+      one None for each process.
     - whisper_model (str): Path to the pretrained Faster-Whisper model.
-    - results (list): List to collect results from the processes.
+    - results (Queue): Gets ("result", wav_id, transcript, hyp) as each file is
+      transcribed and, at the end, ("done", name, utilization) with the load
+      time, start and end time, busy time, number of files and decoding time
+      of each file of this worker.
     - device (str): Device to which the model is sent.
     - compute_type (str): Type of computation to be performed.
+    - segment_table (dict, optional): Virtual segments, see `src.audio.load_segment_table`.
+    - cpu_threads (int, optional): Threads used by each model replica on CPU,
+      0 for the CTranslate2 default. Defaults to 0.
+    - num_workers (int, optional): Number of files transcribed at the same time.
+      Defaults to 1.
+    - prefetch (int, optional): Number of files each worker decodes ahead. Kept
+      small, as those files are taken from the shared queue. Defaults to 2.
     """
 
-    model = WhisperModel(whisper_model, device=device, compute_type=compute_type)
-    for wav_file, transcript in sub_audio_files:
-        wav_id = os.path.basename(wav_file).rstrip(".wav")
-        hyp = ""
-        segments, _ = model.transcribe(
-            wav_file,
-            beam_size=5,
-            vad_filter=True,
-            vad_parameters=dict(min_silence_duration_ms=1000),
-        )
-        for segment in segments:
-            hyp += segment.text + " "
-        hyp = re.sub("\s+", " ", hyp).strip().rstrip()
-        results.append((wav_id, transcript.rstrip(), hyp))
+    load_start = time.time()
+    model = WhisperModel(
+        whisper_model,
+        device=device,
+        compute_type=compute_type,
+        cpu_threads=cpu_threads,
+        num_workers=num_workers,
+    )
+    start = time.time()
+    if isinstance(sub_audio_files, list):
+        items = iter(sub_audio_files)
+    else:
+        items = iter(sub_audio_files.get, None)
+    lock = threading.Lock()
+    busy = []
+    latencies = []
+
+    def next_item():
+        with lock:
+            return next(items, None)
+
+    def work():
+        thread_busy = 0.0
+        count = 0
+        with SegmentReader(segment_table or {}) as reader, AudioPrefetcher(
+            iter(next_item, None),
+            resolve=lambda item: reader.resolve(item[0]),
+            sampling_rate=model.feature_extractor.sampling_rate,
+            depth=prefetch,
+        ) as prefetcher:
+            for (wav_file, transcript), audio in prefetcher:
+                item_start = time.perf_counter()
+                wav_id = os.path.basename(wav_file).rstrip(".wav")
+                hyp = ""
+                segments, _ = model.transcribe(audio, **PARALLEL_DECODE_OPTIONS)
+                for segment in segments:
+                    hyp += segment.text + " "
+                hyp = re.sub("\s+", " ", hyp).strip().rstrip()
+                results.put(("result", wav_id, transcript.rstrip(), hyp))
+                latencies.append(time.perf_counter() - item_start)
+                thread_busy += time.perf_counter() - item_start
+                count += 1
+        busy.append((thread_busy, count))
+
+    if num_workers > 1:
+        threads = [threading.Thread(target=work) for _ in range(num_workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    else:
+        work()
+
+    utilization = {
+        "load_time": start - load_start,
+        "start": start,
+        "end": time.time(),
+        "busy": sum(b for b, _ in busy) / num_workers,
+        "files": sum(c for _, c in busy),
+        "latencies": latencies,
+    }
+    results.put(("done", current_process().name, utilization))
 
 
 def transcribe_file_parallel(
@@ -91,49 +660,157 @@ def transcribe_file_parallel(
     device: str = "cpu",
     compute_type: str = "int8",
     batches: int = 5,
-) -> None:
+    cpu_threads: int = None,
+    num_workers: int = 1,
+    resume: bool = False,
+    cache: str = None,
+) -> dict:
     """
     Transcribes audio files in parallel using Faster-Whisper.
 
+    The files are put on a queue, longest first according to the `.info` file
+    next to `data_path`, and each worker takes the next file as soon as it is
+    done with the previous one, so all workers stay busy until the end.
+    Results are sent back on another queue and written to `hyp_output` as
+    they arrive, see `HypothesisWriter`, and put in the order of `data_path`
+    at the end.
+
+    On CPU the cores are divided between the `batches` processes and the
+    `num_workers` threads of each, unless `cpu_threads` is given, so they don't
+    compete for the same cores. `src.autotune` finds a good combination.
+
+    With `cache` set, files found in the transcription cache are written
+    right away and only the rest are sent to the workers. The cache is only
+    used by this process.
+
     Parameters:
     - data_path (str): Path to the input data file containing paths to audio files and their transcriptions.
     - hyp_output (str): Path to the output file where transcriptions will be written.
     - whisper_model (str): Path to the pretrained Faster-Whisper model.
     - device (str, optional): Device to which the model is sent. Defaults to 'cpu'.
     - compute_type (str, optional): Type of computation to be performed. Defaults to 'int8'.
-    - batches (int, optional): Number of parallel batches to be processed. Defaults to 5.
+    - batches (int, optional): Number of worker processes. Defaults to 5.
+    - cpu_threads (int, optional): Threads of each model replica on CPU. Defaults
+      to the number of cores divided by `batches` times `num_workers`.
+    - num_workers (int, optional): Files transcribed at the same time by each
+      process, with one copy of the model. Defaults to 1.
+    - resume (bool, optional): Whether to keep the results in an existing `hyp_output`
+      and only transcribe the files that are missing. Defaults to False.
+    - cache (str, optional): Path to a transcription cache, e.g.
+      `src.transcription_cache.TRANSCRIPTION_CACHE`. Not used if None.
+
+    Returns:
+    - dict: Load time, busy time, number of files, utilization and decoding time
+      of each file of each worker.
     """
 
-    # Get the model
     audio_files = [x.split("\t") for x in open(data_path)]
+    segment_table = load_segment_table(data_path)
+    if cpu_threads is None:
+        cpu_threads = (
+            max(1, os.cpu_count() // (batches * num_workers)) if device == "cpu" else 0
+        )
 
-    # Split the audio_files into chunks for parallel processing
-    chunk_size = len(audio_files) // batches
-    audio_file_chunks = [
-        audio_files[i : i + chunk_size] for i in range(0, len(audio_files), chunk_size)
+    writer = HypothesisWriter(hyp_output, resume=resume)
+    todo = [
+        (wav_file, transcript)
+        for wav_file, transcript in audio_files
+        if os.path.basename(wav_file).rstrip(".wav") not in writer.done
     ]
+    if writer.done:
+        print(f"Resuming {hyp_output}, {len(todo)} files left")
+    cache = TranscriptionCache(cache) if cache else None
+    try:
+        keys = {}
+        if cache is not None:
+            params = {
+                "device": device,
+                "compute_type": compute_type,
+                **PARALLEL_DECODE_OPTIONS,
+            }
+            with SegmentReader(segment_table) as reader:
+                todo, keys = lookup_cache(
+                    cache, reader, todo, writer, whisper_model, params
+                )
 
-    # Use a Manager list to collect results from processes
-    manager = Manager()
-    results = manager.list()
-    # Create and start processes
-
-    print(f"Decoding {data_path} in {batches} batches")
-    processes = []
-    for i in range(batches):
-        p = Process(
-            target=transcribe_batch,
-            args=(audio_file_chunks[i], whisper_model, results, device, compute_type),
+        # Longest first, so no worker is left with a long file at the end.
+        durations = segment_durations(data_path)
+        queue = Queue()
+        for wav_file, transcript in sorted(
+            todo,
+            key=lambda x: -durations.get(os.path.basename(x[0]).rstrip(".wav"), 0),
+        ):
+            queue.put((wav_file, transcript))
+        for _ in range(batches):
+            queue.put(None)
+        results = Queue()
+
+        print(
+            f"Decoding {data_path} with {batches} processes of {num_workers} workers"
+            f" and {cpu_threads} threads"
+        )
+        processes = []
+        for i in range(batches if todo else 0):
+            p = Process(
+                target=transcribe_batch,
+                args=(
+                    queue,
+                    whisper_model,
+                    results,
+                    device,
+                    compute_type,
+                    segment_table,
+                    cpu_threads,
+                    num_workers,
+                ),
+            )
+            processes.append(p)
+            p.start()
+
+        # Write the results as they come in until every worker is done or has died.
+        workers = {}
+        decoded = 0
+        with writer, tqdm(total=len(todo)) as progress:
+            while len(workers) < len(processes):
+                try:
+                    message = results.get(timeout=1)
+                except Empty:
+                    if not any(p.is_alive() for p in processes):
+                        break
+                    continue
+                if message[0] == "done":
+                    workers[message[1]] = message[2]
+                else:
+                    writer.write(*message[1:])
+                    if message[1] in keys:
+                        cache.put(keys[message[1]], message[3])
+                    decoded += 1
+                    progress.update()
+
+        for p in processes:
+            p.join()
+        reorder_hypotheses(hyp_output, audio_files)
+    finally:
+        if cache is not None:
+            print(f"Transcription cache: {cache.stats()}")
+            cache.close()
+
+    if decoded != len(todo):
+        raise Exception(
+            f"Only {decoded} of {len(todo)} files in {data_path} were decoded,"
+            " run again with resume=True to decode the rest"
         )
-        processes.append(p)
-        p.start()
-
-    # Wait for processes to complete
-    for p in processes:
-        p.join()
-
-    print(f"Writing the results to {hyp_output}")
-    # Write the results to hyp_output
-    with open(hyp_output, "w") as f_out:
-        for wav_id, transcript, hyp in results:
-            f_out.write(f"{wav_id}\t{transcript}\t{hyp}\n")
+
+    # Busy time relative to the time from the first worker being ready until
+    # the last one finished.
+    if workers:
+        first = min(w["start"] for w in workers.values())
+        last = max(w["end"] for w in workers.values())
+        for name, w in sorted(workers.items()):
+            w["utilization"] = w["busy"] / (last - first) if last > first else 1.0
+            print(
+                f"{name}: {w['files']} files, {w['busy']:.1f}s busy, "
+                f"{100 * w['utilization']:.1f}% utilization, "
+                f"model loaded in {w['load_time']:.1f}s"
+            )
+    return workers
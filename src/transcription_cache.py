@@ -0,0 +1,149 @@
+########################################################################
+
+# Author   : Carlos Daniel Hernández Mena & David Erik Mollberg
+# Date     : November 1st, 2023
+# Location : Reykjavík University and Tiro ehf.
+
+# Description:
+
+# A persistent cache of transcriptions, so segments are not decoded again
+# when neither their audio, the model nor the decoding parameters changed.
+# Entries are keyed by the SHA-256 of the audio, a digest of the files of
+# the CTranslate2 model directory, see src.digests, and the decoding
+# parameters, stored in SQLite and evicted least recently used first when
+# the cache grows past its size limit.
+
+########################################################################
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+TRANSCRIPTION_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "spjallromur", "transcriptions.sqlite"
+)
+
+
+class TranscriptionCache:
+    """
+    A size bounded, least recently used cache of hypotheses in SQLite.
+
+    Only the process that writes the hypothesis file should use it, the
+    workers of `transcribe_file_parallel` never do. Every change is committed
+    right away and the database is in WAL mode, so other runs can read and
+    write the same cache at the same time and an interrupted run keeps what
+    it cached.
+    """
+
+    def __init__(self, path: str = TRANSCRIPTION_CACHE, max_bytes: int = 256 << 20):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts = 0
+        self._db = sqlite3.connect(path, timeout=60.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                hyp TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+            """)
+
+    @staticmethod
+    def key(audio_digest: str, model_digest: str, params: dict) -> str:
+        """
+        Cache key of a segment.
+
+        Parameters:
+        - audio_digest (str): SHA-256 of the audio, see `src.digests.audio_digest`.
+        - model_digest (str): Digest of the model, see `src.digests.DigestCache`.
+        - params (dict): Decoding parameters, e.g. beam_size, VAD parameters
+          and compute_type.
+
+        Returns:
+        - str: The key.
+        """
+        return hashlib.sha256(
+            json.dumps([audio_digest, model_digest, params], sort_keys=True).encode(
+                "utf-8"
+            )
+        ).hexdigest()
+
+    def get(self, key: str):
+        """The cached hypothesis for a key, or None."""
+        row = self._db.execute(
+            "SELECT hyp FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._db.execute(
+            "UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        self._db.commit()
+        return row[0]
+
+    def put(self, key: str, hyp: str):
+        """Store a hypothesis, evicting old entries now and then."""
+        self._db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+            (key, hyp, len(key) + len(hyp.encode("utf-8")), time.time()),
+        )
+        self._db.commit()
+        self._puts += 1
+        if self._puts % 1000 == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in `max_bytes`."""
+        (total,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        if total > self.max_bytes:
+            removed = 0
+            keys = []
+            for key, size in self._db.execute(
+                "SELECT key, size FROM entries ORDER BY last_used"
+            ):
+                if total - removed <= self.max_bytes:
+                    break
+                keys.append((key,))
+                removed += size
+            self._db.executemany("DELETE FROM entries WHERE key = ?", keys)
+            self.evictions += len(keys)
+        self._db.commit()
+
+    def stats(self) -> dict:
+        """Hits, misses and evictions so far, and the current size of the cache."""
+        entries, size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def close(self):
+        self.evict()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
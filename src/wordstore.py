@@ -0,0 +1,259 @@
+########################################################################
+
+# Author   : David Erik Mollberg & Carlos Daniel Hernández Mena
+# Date     : November 1st, 2023
+# Location : Reykjavík University and Tiro ehf.
+
+# A compact, memory-mappable columnar store of the word timestamps of
+# all transcripts in the corpus. The per-speaker JSON files are converted
+# once, after which segmentation and diarization preparation read start
+# and end times as float arrays straight from the mapping and words from
+# a table of interned strings, instead of parsing a dict per word.
+#
+# Usage: python -m src.wordstore [output_file]
+
+########################################################################
+
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import namedtuple
+from glob import glob
+
+WORD_STORE = "words.store"
+MAGIC = b"SPJWORDS"
+VERSION = 1
+
+# One transcript (or several merged transcripts) as parallel columns.
+WordColumns = namedtuple("WordColumns", ["word", "norm_word", "start", "end", "spk"])
+
+
+def transcript_files() -> list:
+    """
+    Retrieve the paths of all transcripts in the corpus.
+
+    Returns:
+    - list: List of transcript JSON paths.
+    """
+    return sorted(
+        glob("full_conversations/*/*.json") + glob("half_conversations/*/*.json")
+    )
+
+
+def _source_signature(path: str) -> list:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _align(f, alignment: int = 8):
+    f.write(b"\0" * (-f.tell() % alignment))
+
+
+def build_word_store(output_file: str = WORD_STORE, files: list = None) -> str:
+    """
+    Convert transcripts into a single columnar word store.
+
+    The file holds a JSON header followed by 8 byte aligned columns:
+    float64 start and end times, uint32 indices of the word and normalized
+    word into the string table, uint8 speaker codes and the string table
+    itself as uint64 offsets into a UTF-8 blob.
+
+    Parameters:
+    - output_file (str): Path of the store. Default is "words.store".
+    - files (list): Transcript JSON files to convert. Defaults to all transcripts.
+
+    Returns:
+    - str: Path of the store.
+    """
+
+    files = transcript_files() if files is None else files
+    if not files:
+        raise Exception("No transcripts found")
+
+    strings = {}
+    speakers = {}
+    recordings = {}
+    starts, ends = array("d"), array("d")
+    words, norm_words, spks = array("I"), array("I"), array("B")
+
+    for path in files:
+        with open(path) as f:
+            data = json.load(f)
+        speaker = data["metadata"].get("speaker", "")
+        code = speakers.setdefault(speaker, len(speakers))
+        recordings[os.path.normpath(path)] = {
+            "offset": len(starts),
+            "count": len(data["words"]),
+            "metadata": data["metadata"],
+            "source": _source_signature(path),
+        }
+        for w in data["words"]:
+            starts.append(w["start"])
+            ends.append(w["end"])
+            words.append(strings.setdefault(w["word"], len(strings)))
+            norm_words.append(strings.setdefault(w["norm_word"], len(strings)))
+            spks.append(code)
+
+    blob = bytearray()
+    string_offsets = array("Q", [0])
+    for s in strings:
+        blob += s.encode("utf-8")
+        string_offsets.append(len(blob))
+
+    header = json.dumps(
+        {
+            "version": VERSION,
+            "byteorder": sys.byteorder,
+            "words": len(starts),
+            "strings": len(strings),
+            "speakers": sorted(speakers, key=speakers.get),
+            "recordings": recordings,
+        },
+        ensure_ascii=False,
+    ).encode("utf-8")
+
+    with open(output_file + ".tmp", "wb") as f:
+        f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+        for column in [starts, ends, string_offsets, words, norm_words, spks]:
+            _align(f)
+            column.tofile(f)
+        f.write(blob)
+    os.replace(output_file + ".tmp", output_file)
+    print(
+        f"Wrote {len(starts)} words of {len(recordings)} transcripts to {output_file}"
+    )
+    return output_file
+
+
+class WordStore:
+    """
+    Read-only access to a store written by `build_word_store`.
+
+    Time columns are memoryviews into the mapped file and the string table
+    is decoded once, so every occurrence of a word shares one str object.
+    """
+
+    def __init__(self, path: str = WORD_STORE):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:8] != MAGIC:
+            raise Exception(f"{path} is not a word store")
+        (header_size,) = struct.unpack("<Q", self._mmap[8:16])
+        self.header = json.loads(self._mmap[16 : 16 + header_size].decode("utf-8"))
+        if self.header["version"] != VERSION:
+            raise Exception(f"{path} has an unsupported version")
+        if self.header["byteorder"] != sys.byteorder:
+            raise Exception(f"{path} was written on a machine of other byte order")
+
+        n_words, n_strings = self.header["words"], self.header["strings"]
+        view = memoryview(self._mmap)
+        pos = 16 + header_size
+        columns = []
+        for fmt, count in [
+            ("d", n_words),
+            ("d", n_words),
+            ("Q", n_strings + 1),
+            ("I", n_words),
+            ("I", n_words),
+            ("B", n_words),
+        ]:
+            pos += -pos % 8
+            size = count * struct.calcsize(fmt)
+            columns.append(view[pos : pos + size].cast(fmt))
+            pos += size
+        self._start, self._end, offsets, self._word, self._norm_word, self._spk = (
+            columns
+        )
+
+        blob = bytes(view[pos:])
+        self.strings = [
+            blob[offsets[i] : offsets[i + 1]].decode("utf-8") for i in range(n_strings)
+        ]
+        self.speakers = self.header["speakers"]
+        offsets.release()
+
+    def __contains__(self, transcript_file: str) -> bool:
+        return os.path.normpath(transcript_file) in self.header["recordings"]
+
+    def is_current(self, transcript_file: str) -> bool:
+        """
+        Check that a transcript is in the store and unchanged since it was added.
+
+        Parameters:
+        - transcript_file (str): Path of the transcript JSON file.
+
+        Returns:
+        - bool: Whether the store can be used instead of the JSON file.
+        """
+        if transcript_file not in self:
+            return False
+        recording = self.header["recordings"][os.path.normpath(transcript_file)]
+        return (
+            not os.path.exists(transcript_file)
+            or _source_signature(transcript_file) == recording["source"]
+        )
+
+    def metadata(self, transcript_file: str) -> dict:
+        """Metadata of a transcript, as in its JSON file."""
+        return self.header["recordings"][os.path.normpath(transcript_file)]["metadata"]
+
+    def columns(self, transcript_file: str) -> WordColumns:
+        """
+        The words of a transcript as columns.
+
+        Parameters:
+        - transcript_file (str): Path of the transcript JSON file.
+
+        Returns:
+        - WordColumns: Words and normalized words as lists of shared strings,
+          start and end times as zero-copy float views and speaker codes.
+        """
+        recording = self.header["recordings"][os.path.normpath(transcript_file)]
+        first = recording["offset"]
+        last = first + recording["count"]
+        strings = self.strings
+        return WordColumns(
+            [strings[i] for i in self._word[first:last]],
+            [strings[i] for i in self._norm_word[first:last]],
+            self._start[first:last],
+            self._end[first:last],
+            self._spk[first:last],
+        )
+
+    def close(self):
+        for column in [self._start, self._end, self._word, self._norm_word, self._spk]:
+            column.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_open_stores = {}
+
+
+def open_word_store(path: str) -> WordStore:
+    """
+    Open a word store once per process and reuse it afterwards.
+
+    Parameters:
+    - path (str): Path of the store.
+
+    Returns:
+    - WordStore: The opened store.
+    """
+    if path not in _open_stores:
+        _open_stores[path] = WordStore(path)
+    return _open_stores[path]
+
+
+if __name__ == "__main__":
+    build_word_store(*sys.argv[1:2])